@@ -0,0 +1,73 @@
+import math
+import hashlib
+import threading
+
+# 布隆过滤器的目标误判率
+bloom_false_positive_rate = 0.01
+# 布隆过滤器的内存上限，单位为字节，超出时减小位数组，误判率随之升高
+bloom_max_bytes = 64 * 1024 * 1024
+
+
+class BloomFilter:
+    """
+    布隆过滤器
+    判断一个键是否“一定不存在”：might_contain 返回 False 时键一定未被加入过，返回 True 时键可能存在
+    """
+
+    def __init__(self, capacity, false_positive_rate=None, max_bytes=None):
+        """
+        :param capacity: 预计加入的键的数量
+        :param false_positive_rate: 目标误判率，为 None 时使用 bloom_false_positive_rate
+        :param max_bytes: 内存上限，为 None 时使用 bloom_max_bytes
+        """
+        false_positive_rate = bloom_false_positive_rate if false_positive_rate is None else false_positive_rate
+        max_bytes = bloom_max_bytes if max_bytes is None else max_bytes
+        capacity = max(1, capacity)
+        # m = -n * ln(p) / (ln2)^2，k = m / n * ln2
+        bits = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        bits = max(64, min(bits, max_bytes * 8))
+        self.bit_count = bits
+        self.hash_count = max(1, int(round(bits / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        """
+        使用双重散列由一个摘要生成 hash_count 个位置
+        :param key: 键
+        :return: 位置的生成器
+        """
+        digest = hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, key):
+        """
+        加入一个键
+        :param key: 键
+        :return: None
+        """
+        positions = list(self._positions(key))
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def might_contain(self, key):
+        """
+        :param key: 键
+        :return: 键可能存在时返回 True，一定不存在时返回 False
+        """
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __contains__(self, key):
+        return self.might_contain(key)
+
+    def estimated_false_positive_rate(self):
+        """
+        :return: 按当前键数量估计的误判率
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
@@ -1,11 +1,27 @@
 import os
 import time
+import queue
 import logging
 import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from sortedcontainers import SortedList
 
 import utils
+import transfer
+import chunk_store
 from cfs import CloudFileSystem
+from stat_cache import StatCache
+from dedup_index import DedupIndex
+
+# 云端元信息树的构建方式 (可选 bulk | tree)
+# - bulk: 不使用分隔符一次性分页列出 cloud_path 下的所有对象，只对列举信息发生变化的对象发送 HEAD 请求
+# - tree: 逐个目录列举，并对每个对象发送 HEAD 请求，列举和 HEAD 请求并发进行
+cloud_listing_mode = 'bulk'
+# tree 模式下同时进行中的列举和 HEAD 请求的最大数量
+crawl_workers = 16
+# 并行扫描本地目录的工作者数量
+scan_workers = 4
 
 
 class Catalog:
@@ -21,12 +37,15 @@ class Catalog:
     mtime = ''
     # 文件的 hash
     file_id = ''
+    # 云端文件的 uuid 元信息，本地文件为空
+    uuid = ''
 
-    def __init__(self, file_type, filename, mtime, file_id):
+    def __init__(self, file_type, filename, mtime, file_id, uuid=None):
         self.file_type = file_type
         self.filename = filename
         self.mtime = mtime if mtime is not None else ''
         self.file_id = file_id if file_id is not None else ''
+        self.uuid = uuid if uuid is not None else ''
 
     def __eq__(self, other):
         return self.filename == str(other.filename)
@@ -47,9 +66,9 @@ class DirectoryStatus(Catalog):
     """
     children = []
 
-    def __init__(self, filename, mtime=None, file_id=None, children=None):
+    def __init__(self, filename, mtime=None, file_id=None, children=None, uuid=None):
         filename += '/' if not filename.endswith('/') else ''
-        super().__init__(Catalog.IS_FOLDER, filename, mtime, file_id)
+        super().__init__(Catalog.IS_FOLDER, filename, mtime, file_id, uuid)
         self.children = children if isinstance(children, SortedList) else SortedList([])
 
     def insert(self, catalog):
@@ -73,8 +92,8 @@ class FileStatus(Catalog):
     存储文件元信息的结构
     """
 
-    def __init__(self, filename, mtime=None, file_id=None):
-        super().__init__(Catalog.IS_FILE, filename, mtime, file_id)
+    def __init__(self, filename, mtime=None, file_id=None, uuid=None):
+        super().__init__(Catalog.IS_FILE, filename, mtime, file_id, uuid)
 
     def __str__(self):
         return '[FileStatus: filename={filename} mtime={mtime} file_id={file_id}]'.format(
@@ -84,17 +103,324 @@ class FileStatus(Catalog):
         )
 
 
-def initialize_metatree_local(local_path: str, local_dict: dict):
+def get_directory_fingerprint(directory: DirectoryStatus):
+    """
+    由孩子的相对名称和 file_id 计算单个目录的 Merkle 指纹，要求子目录的指纹已经计算完毕
+    :param directory: 目录状态
+    :return: 目录指纹
+    """
+    prefix_length = len(directory.filename)
+    return utils.get_buffer_hash(''.join(
+        '{name}\0{file_id}\n'.format(name=child.filename[prefix_length:], file_id=child.file_id)
+        for child in directory.children
+    ).encode())
+
+
+def update_fingerprints(root: DirectoryStatus):
+    """
+    自底向上计算目录子树中每个目录的 Merkle 指纹，并保存在目录状态的 file_id 中
+    目录指纹由其孩子的相对名称和 file_id 决定，与目录自身的位置无关，
+    因此指纹相同的两棵子树内容相同，对比时可以整体跳过
+    :param root: 目录状态
+    :return: 根目录的指纹
+    """
+    # 先序遍历得到所有目录，逆序处理即可保证子目录先于父目录计算
+    directories = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        directories.append(directory)
+        stack.extend(child for child in directory.children if child.file_type == Catalog.IS_FOLDER)
+    for directory in reversed(directories):
+        directory.file_id = get_directory_fingerprint(directory)
+    return root.file_id
+
+
+def find_child(directory: DirectoryStatus, filename: str):
+    """
+    在目录的孩子列表中二分查找文件(夹)
+    :param directory: 目录状态
+    :param filename: 要查找的完整文件名，目录以 / 结尾
+    :return: 文件(夹)状态，不存在时返回 None
+    """
+    index = directory.children.bisect_left(FileStatus(filename))
+    if index < len(directory.children) and directory.children[index].filename == filename:
+        return directory.children[index]
+    return None
+
+
+def copy_path(root: DirectoryStatus, dirname: str):
+    """
+    复制从根目录到指定目录路径上的所有目录状态，其余节点与原树共享
+    修改复制出的目录后，原树（例如已经作为历史记录的树）不受影响
+    :param root: 根目录状态
+    :param dirname: 以 / 结尾的目录路径，必须位于根目录之下
+    :return: (新的根目录状态, 从新根目录到指定目录的目录状态列表)，指定目录不存在时返回 (root, None)
+    """
+    path = [root]
+    index = len(root.filename) - 1
+    while len(path[-1].filename) < len(dirname):
+        index = dirname.find('/', index + 1)
+        child = find_child(path[-1], dirname[:index + 1])
+        if child is None or child.file_type != Catalog.IS_FOLDER:
+            return root, None
+        path.append(child)
+
+    copied = [DirectoryStatus(directory.filename, mtime=directory.mtime, file_id=directory.file_id,
+                              children=SortedList(directory.children), uuid=directory.uuid)
+              for directory in path]
+    for parent, child in zip(copied, copied[1:]):
+        parent.children.remove(child)
+        parent.children.add(child)
+    return copied[0], copied
+
+
+def update_path_fingerprints(path: list):
+    """
+    自底向上重新计算路径上各个目录的指纹
+    :param path: 从根目录到某个目录的目录状态列表
+    :return: None
+    """
+    for directory in reversed(path):
+        directory.file_id = get_directory_fingerprint(directory)
+
+
+def find_catalog(root: DirectoryStatus, filename: str):
+    """
+    在元信息树中查找文件(夹)
+    :param root: 根目录状态
+    :param filename: 要查找的完整文件名，目录以 / 结尾
+    :return: 文件(夹)状态，不存在时返回 None
+    """
+    if filename == root.filename:
+        return root
+    dirname = filename[:filename.rstrip('/').rfind('/') + 1]
+    directory = root
+    index = len(root.filename) - 1
+    while len(directory.filename) < len(dirname):
+        index = dirname.find('/', index + 1)
+        directory = find_child(directory, dirname[:index + 1])
+        if directory is None or directory.file_type != Catalog.IS_FOLDER:
+            return None
+    return find_child(directory, filename)
+
+
+def rebase_catalog(catalog: Catalog, filename: str):
+    """
+    复制文件(夹)状态，并将其（以及子树中所有文件(夹)）的路径前缀替换为 filename
+    :param catalog: 文件(夹)状态
+    :param filename: 新的完整文件名，目录以 / 结尾
+    :return: 复制得到的文件(夹)状态
+    """
+    if catalog.file_type == Catalog.IS_FILE:
+        return FileStatus(filename, mtime=catalog.mtime, file_id=catalog.file_id, uuid=catalog.uuid)
+    root = DirectoryStatus(filename, mtime=catalog.mtime, file_id=catalog.file_id, uuid=catalog.uuid)
+    stack = [(catalog, root)]
+    while stack:
+        source, target = stack.pop()
+        for child in source.children:
+            child_filename = target.filename + child.filename[len(source.filename):]
+            if child.file_type == Catalog.IS_FOLDER:
+                copied = DirectoryStatus(child_filename, mtime=child.mtime, file_id=child.file_id, uuid=child.uuid)
+                stack.append((child, copied))
+            else:
+                copied = FileStatus(child_filename, mtime=child.mtime, file_id=child.file_id, uuid=child.uuid)
+            target.children.add(copied)
+    return root
+
+
+def replace_catalog(root: DirectoryStatus, filename: str, catalog):
+    """
+    将元信息树中的一个文件(夹)替换为 catalog，返回新树，原树保持不变
+    :param root: 根目录状态
+    :param filename: 被替换的完整文件名，目录以 / 结尾
+    :param catalog: 新的文件(夹)状态，路径必须为 filename；为 None 时删除该文件(夹)
+    :return: 新的根目录状态，父目录不在树中时返回原树
+    """
+    new_root, path = copy_path(root, filename[:filename.rstrip('/').rfind('/') + 1])
+    if path is None:
+        return root
+    parent = path[-1]
+    existing = find_child(parent, filename)
+    if existing is not None:
+        parent.children.remove(existing)
+    if catalog is not None:
+        parent.children.add(catalog)
+    update_path_fingerprints(path)
+    return new_root
+
+
+def diff_directory(current: DirectoryStatus, history: DirectoryStatus):
+    """
+    对比同一目录的当前状态和历史状态
+    两边的孩子列表都是按文件名排序的 SortedList，因此只需像归并连接一样同时向前扫描两个列表，一次线性遍历即可完成对比
+    :param current: 当前目录状态
+    :param history: 历史目录状态，为 None 时当前目录的所有孩子都视为新增
+    :return: (新增项列表, 删除项列表, 修改项列表)，修改项为 file_id 不同的 (当前项, 历史项)，目录的 file_id 即为其指纹
+    """
+    added = []
+    removed = []
+    modified = []
+    current_children = iter(current.children if current is not None else [])
+    history_children = iter(history.children if history is not None else [])
+    current_child = next(current_children, None)
+    history_child = next(history_children, None)
+    while current_child is not None and history_child is not None:
+        if current_child.filename < history_child.filename:
+            added.append(current_child)
+            current_child = next(current_children, None)
+        elif current_child.filename > history_child.filename:
+            removed.append(history_child)
+            history_child = next(history_children, None)
+        else:
+            if current_child.file_id != history_child.file_id:
+                modified.append((current_child, history_child))
+            current_child = next(current_children, None)
+            history_child = next(history_children, None)
+    if current_child is not None:
+        added.append(current_child)
+        added.extend(current_children)
+    if history_child is not None:
+        removed.append(history_child)
+        removed.extend(history_children)
+    return added, removed, modified
+
+
+def initialize_metatree_local(local_path: str, dedup_index: DedupIndex, stat_cache: StatCache = None):
     """
     初始化本地元信息树
+    先遍历目录构建树结构，再将摘要缓存未命中的文件交给 utils.get_local_files_hash 并行计算摘要
+    有目录遍历失败时抛出异常，不返回缺少部分子项的元信息树，否则 PUSH 会把未遍历到的文件当作本地已删除
     :param local_path: 元信息树的根目录
-    :param local_dict: 用于加速查找的字典
+    :param dedup_index: 本地去重索引，以本次扫描结果重建，从而淘汰已经不存在的文件
+    :param stat_cache: 本地文件摘要缓存，文件 stat 信息未变化时复用缓存中的摘要
+    :return: 以 local_path 为根的元信息树
+    """
+    # 需要计算摘要的文件，元素为 (文件状态, stat 信息)
+    pending = []
+    root = _build_metatree_local(local_path, stat_cache, pending)
+    _hash_pending_files(pending, stat_cache)
+    dedup_index.rebuild(iter_files(root, recursive=True))
+    update_fingerprints(root)
+    return root
+
+
+def refresh_metatree_local(root: DirectoryStatus, dirname: str, dedup_index: DedupIndex,
+                           stat_cache: StatCache = None, recursive=False):
+    """
+    重新扫描本地元信息树中的一个目录，返回更新后的新树，原树保持不变
+    只复制从根目录到该目录路径上的目录状态，并重新计算这条路径上的指纹，代价与目录大小和深度有关，与整棵树的大小无关
+    有目录遍历失败时抛出异常，原树保持不变
+    :param root: 本地元信息树
+    :param dirname: 要重新扫描的目录，以 / 结尾
+    :param dedup_index: 本地去重索引，重新扫描的目录中的记录被替换
+    :param stat_cache: 本地文件摘要缓存
+    :param recursive: 是否重新扫描整个子树，为 False 时只扫描目录本身，已有子目录的子树保持不变，新出现的子目录整体扫描
+    :return: 更新后的本地元信息树，目录不在树中时返回 None
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    new_root, path = copy_path(root, dirname)
+    if path is None:
+        return None
+    directory = path[-1]
+    pending = []
+    if recursive:
+        logger.info('重新扫描本地子树 {dirname}'.format(dirname=dirname))
+        fresh = _build_metatree_local(dirname, stat_cache, pending)
+        new_subtrees = [fresh]
+    else:
+        logger.info('重新扫描本地目录 {dirname}'.format(dirname=dirname))
+        fresh = DirectoryStatus(dirname, mtime=str(int(os.path.getmtime(dirname))))
+        discovered = queue.Queue()
+        _scan_local_directory(fresh, stat_cache, pending, threading.Lock(), discovered)
+        new_subtrees = []
+        while not discovered.empty():
+            subdir = discovered.get()
+            old_subdir = find_child(directory, subdir.filename)
+            fresh.children.remove(subdir)
+            if old_subdir is not None:
+                # 已有子目录的内部变化由它自己的事件负责，这里沿用原来的子树
+                fresh.children.add(old_subdir)
+            else:
+                subtree = _build_metatree_local(subdir.filename, stat_cache, pending)
+                fresh.children.add(subtree)
+                new_subtrees.append(subtree)
+    _hash_pending_files(pending, stat_cache)
+
+    directory.mtime = fresh.mtime
+    directory.children = fresh.children
+    _reindex_files(dedup_index, directory, recursive=False)
+    for subtree in new_subtrees:
+        _reindex_files(dedup_index, subtree, recursive=True)
+        update_fingerprints(subtree)
+    update_path_fingerprints(path)
+    return new_root
+
+
+def _hash_pending_files(pending: list, stat_cache: StatCache):
+    """
+    并行计算摘要缓存未命中的文件的摘要，并写入摘要缓存
+    :param pending: 需要计算摘要的文件列表，元素为 (文件状态, stat 信息或 None)
+    :param stat_cache: 本地文件摘要缓存
+    :return: None
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    if len(pending) == 0:
+        return
+    logger.info('并行计算 {count} 个本地文件的摘要'.format(count=len(pending)))
+    file_ids = utils.get_local_files_hash([child_file.filename for child_file, _ in pending])
+    for (child_file, stat_result), file_id in zip(pending, file_ids):
+        child_file.file_id = file_id
+        # 扫描时 stat 失败的文件没有 stat 信息，只计算摘要，不写入缓存
+        if stat_cache is not None and stat_result is not None:
+            stat_cache.update(stat_result, file_id, child_file.filename)
+
+
+def iter_files(root: DirectoryStatus, recursive: bool):
+    """
+    遍历目录中的文件
+    :param root: 目录状态
+    :param recursive: 是否包含子目录中的文件
+    :return: (文件路径, 文件摘要) 的生成器
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        for child in directory.children:
+            if child.file_type == Catalog.IS_FOLDER:
+                if recursive:
+                    stack.append(child)
+            else:
+                yield child.filename, child.file_id
+
+
+def _reindex_files(dedup_index: DedupIndex, root: DirectoryStatus, recursive: bool):
+    """
+    用目录的扫描结果替换去重索引中该目录下的记录，已被删除的文件随之移除
+    :param dedup_index: 去重索引
+    :param root: 目录状态
+    :param recursive: 是否包含子目录中的文件
+    :return: None
+    """
+    dedup_index.remove_tree(root.filename, recursive)
+    for filename, file_id in iter_files(root, recursive):
+        dedup_index.add(filename, file_id)
+
+
+def _build_metatree_local(local_path: str, stat_cache: StatCache, pending: list):
+    """
+    构建本地元信息树的结构，摘要缓存未命中的文件加入 pending 中，稍后统一计算摘要
+    目录通过工作队列分发给 scan_workers 个工作线程并行遍历，不使用递归，因此不受目录深度的限制
+    任一目录遍历失败时停止遍历并抛出该异常，不返回缺少部分子项的元信息树
+    :param local_path: 元信息树的根目录
+    :param stat_cache: 本地文件摘要缓存
+    :param pending: 需要计算摘要的文件列表
     :return: 以 local_path 为根的元信息树
     """
     logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
     logger.info('构建本地当前目录状态 {local_path}'.format(local_path=local_path))
-    # 构建该目录的目录状态
-    mtime = file_id = ''
+    # 构建根目录的目录状态
+    mtime = ''
     try:
         logger.debug('获取本地目录的修改时间')
         mtime = str(int(os.path.getmtime(local_path)))
@@ -103,98 +429,341 @@ def initialize_metatree_local(local_path: str, local_dict: dict):
         logger.exception('获取本地目录的修改时间 失败, 错误信息为: {err}'.format(err=err))
     root = DirectoryStatus(local_path, mtime=mtime)
 
-    # 遍历目录下的子目录及子文件，并添加到 child 中
-    # files_hash_sum = ''
-    logger.info('遍历本地目录 {local_path} 下的子目录和子文件，将它们加入当前目录的孩子列表中'.format(local_path=local_path))
-    for filename in os.listdir(local_path):
-        filename = local_path + filename
-        if os.path.isdir(filename):
-            # 插入目录
-            filename += '/'
-            logger.debug('发现子目录 {filename}'.format(filename=filename))
-            subdir = initialize_metatree_local(filename, local_dict)
-            # files_hash_sum += subdir.file_id
-            root.insert(subdir)
-            logger.info('将子目录 {filename} 的目录状态插入到当前目录 {local_path}'.format(filename=filename, local_path=local_path))
-        elif os.path.isfile(filename):
-            # 插入文件
-            logger.debug('发现子文件 {filename}'.format(filename=filename))
-            mtime = ''
+    # 工作线程从队列中取出目录进行遍历，发现的子目录再放回队列
+    work_queue = queue.Queue()
+    pending_lock = threading.Lock()
+    # 第一个遍历失败的目录的异常；缺少子项的目录会被 PUSH 当作其中的内容已在本地删除，因此放弃本次构建
+    errors = []
+
+    def worker():
+        while True:
+            directory = work_queue.get()
+            if directory is None:
+                work_queue.task_done()
+                return
             try:
-                logger.debug('获取本地文件的修改时间和文件 ID')
-                mtime = str(int(os.path.getmtime(filename)))
-                file_id = utils.get_local_file_hash(filename)
-                # files_hash_sum += file_id
-                logger.debug('获取本地文件的修改时间和文件 ID 成功')
+                # 已有目录遍历失败时，只清空队列，不再遍历
+                if not errors:
+                    _scan_local_directory(directory, stat_cache, pending, pending_lock, work_queue)
             except Exception as err:
-                logger.exception('获取本地文件的修改时间和文件 ID 失败, 错误信息为: {err}'.format(err=err))
-            child_file = FileStatus(filename, mtime=mtime, file_id=file_id)
-            root.insert(child_file)
-            local_dict[child_file.file_id] = local_dict.get(child_file.file_id, set()).union({child_file.filename})
-            logger.info('将子文件 {filename} 的文件状态插入到当前目录 {local_path}'.format(filename=filename, local_path=local_path))
-            logger.debug('子文件 {filename} 的文件状态为: {child_file}'.format(filename=filename, child_file=child_file))
-        else:
-            logger.error('未知的的文件: {filename}'.format(filename=filename))
+                logger.exception('遍历本地目录 {filename} 失败, 错误信息为: {err}'
+                                 .format(filename=directory.filename, err=err))
+                with pending_lock:
+                    errors.append(err)
+            finally:
+                work_queue.task_done()
+
+    work_queue.put(root)
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, scan_workers))]
+    for thread in workers:
+        thread.start()
+    work_queue.join()
+    for _ in workers:
+        work_queue.put(None)
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
 
-    # 计算目录 hash
-    # root.file_id = utils.get_buffer_hash(files_hash_sum.encode())
     logger.info('构建本地当前目录状态 {local_path} 完成'.format(local_path=local_path))
     return root
 
 
-def initialize_metatree_cloud(cloud_path: str, cfs: CloudFileSystem, cloud_dict: dict):
+def _scan_local_directory(root: DirectoryStatus, stat_cache: StatCache, pending: list,
+                          pending_lock: threading.Lock, work_queue: queue.Queue):
+    """
+    使用 os.scandir 遍历单个本地目录，将子目录和子文件插入该目录的孩子列表中，子目录放入工作队列等待遍历
+    :param root: 要遍历的目录的目录状态
+    :param stat_cache: 本地文件摘要缓存
+    :param pending: 需要计算摘要的文件列表
+    :param pending_lock: 保护 pending 的锁
+    :param work_queue: 目录工作队列
+    :return: None
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    local_path = root.filename
+    logger.info('遍历本地目录 {local_path} 下的子目录和子文件，将它们加入当前目录的孩子列表中'.format(local_path=local_path))
+    with os.scandir(local_path) as entries:
+        for entry in entries:
+            filename = local_path + entry.name
+            if transfer.is_temp_name(entry.name):
+                # 跳过写入中的临时文件，中断后遗留的过期临时文件直接删除
+                if transfer.remove_if_stale(filename):
+                    logger.info('删除中断后遗留的临时文件 {filename}'.format(filename=filename))
+                else:
+                    logger.debug('跳过写入中的临时文件 {filename}'.format(filename=filename))
+                continue
+            if entry.is_dir():
+                # 插入目录
+                filename += '/'
+                logger.debug('发现子目录 {filename}'.format(filename=filename))
+                mtime = ''
+                try:
+                    mtime = str(int(entry.stat().st_mtime))
+                except Exception as err:
+                    logger.exception('获取本地目录的修改时间 失败, 错误信息为: {err}'.format(err=err))
+                subdir = DirectoryStatus(filename, mtime=mtime)
+                root.insert(subdir)
+                work_queue.put(subdir)
+                logger.info('将子目录 {filename} 的目录状态插入到当前目录 {local_path}'.format(filename=filename, local_path=local_path))
+            elif entry.is_file():
+                # 插入文件
+                logger.debug('发现子文件 {filename}'.format(filename=filename))
+                mtime = file_id = ''
+                stat_result = None
+                try:
+                    logger.debug('获取本地文件的修改时间和文件 ID')
+                    stat_result = entry.stat()
+                    mtime = str(int(stat_result.st_mtime))
+                    file_id = stat_cache.lookup(stat_result, filename) if stat_cache is not None else None
+                    logger.debug('获取本地文件的修改时间和文件 ID 成功')
+                except Exception as err:
+                    logger.exception('获取本地文件的修改时间和文件 ID 失败, 错误信息为: {err}'.format(err=err))
+                child_file = FileStatus(filename, mtime=mtime, file_id=file_id)
+                root.insert(child_file)
+                if file_id is None:
+                    with pending_lock:
+                        pending.append((child_file, stat_result))
+                logger.info('将子文件 {filename} 的文件状态插入到当前目录 {local_path}'.format(filename=filename, local_path=local_path))
+                logger.debug('子文件 {filename} 的文件状态为: {child_file}'.format(filename=filename, child_file=child_file))
+            else:
+                logger.error('未知的的文件: {filename}'.format(filename=filename))
+
+
+def initialize_metatree_cloud(cloud_path: str, cfs: CloudFileSystem, dedup_index: DedupIndex,
+                              history: DirectoryStatus = None):
     """
-    初始化云端元信息树
+    初始化云端元信息树，构建方式由 cloud_listing_mode 决定
+    列举失败时抛出异常，不返回缺少部分对象的元信息树，否则 PULL 会把未列举到的对象当作云端已删除
     :param cloud_path: 元信息树的根目录
     :param cfs: 云文件系统，包含 stat_file 等函数
-    :param cloud_dict: 用于加速查找的字典
+    :param dedup_index: 云端去重索引，以本次列举结果重建
+    :param history: 云端历史元信息树，对象的元信息获取失败时沿用其中的记录
+    :return: 以 cloud_path 为根的元信息树
+    """
+    if cloud_listing_mode == 'bulk':
+        return _build_metatree_cloud_bulk(cloud_path, cfs, dedup_index, history)
+    return _build_metatree_cloud_tree(cloud_path, cfs, dedup_index, history)
+
+
+def _fallback_stat(filename: str, previous: dict, history: DirectoryStatus):
+    """
+    云端对象的元信息获取失败时使用的替代元信息
+    对象仍然列举得到，必须留在元信息树中，因此依次沿用上一轮扫描的元信息、历史元信息树中的记录，
+    都没有时使用空的摘要和最早的修改时间，下一轮取得真实的元信息后按云端更新处理
+    :param filename: 对象路径
+    :param previous: 上一轮扫描得到的元信息，没有时为 None
+    :param history: 云端历史元信息树，没有时为 None
+    :return: 含有 hash、mtime、uuid 的字典
+    """
+    if previous is not None:
+        return previous
+    catalog = find_catalog(history, filename) if history is not None else None
+    if catalog is not None:
+        return {'hash': catalog.file_id, 'mtime': catalog.mtime, 'uuid': catalog.uuid}
+    return {'hash': '', 'mtime': '0', 'uuid': ''}
+
+
+def _build_metatree_cloud_bulk(cloud_path: str, cfs: CloudFileSystem, dedup_index: DedupIndex,
+                               history: DirectoryStatus = None):
+    """
+    通过一次不使用分隔符的分页列举，初始化云端元信息树
+    对象的 ETag、大小、最后修改时间与上一轮扫描相同时，复用上一轮的元信息，否则发送 HEAD 请求获取元信息
+    HEAD 请求失败的对象沿用已知的元信息，下一轮扫描时重试
+    :param cloud_path: 元信息树的根目录
+    :param cfs: 云文件系统，包含 iter_all_files、stat_file 等函数
+    :param dedup_index: 云端去重索引，以本次列举结果重建
+    :param history: 云端历史元信息树，对象的元信息获取失败时沿用其中的记录
     :return: 以 cloud_path 为根的元信息树
     """
     logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
-    logger.info('构建云端当前目录状态 {cloud_path}'.format(cloud_path=cloud_path))
-    # 构建该目录的目录状态
-    mtime = file_id = ''
-    try:
-        logger.debug('获取云端目录的元信息(修改时间)')
-        stat = cfs.stat_file(cloud_path)
-        mtime = stat['mtime']
-        logger.debug('获取云端目录的元信息(修改时间)成功')
-    except Exception as err:
-        logger.exception('获取云端目录的元信息(修改时间)失败, 错误信息为: {err}'.format(err=err))
-    root = DirectoryStatus(cloud_path, mtime=mtime)
-
-    # 遍历目录下的子目录及子文件，并添加到 child 中
-    # files_hash_sum = ''
-    logger.info('遍历云端目录 {cloud_path} 下的子目录和子文件，将它们加入当前目录的孩子列表中'.format(cloud_path=cloud_path))
-    for filename in cfs.list_files(cloud_path):
-        filename = cloud_path + filename
+    logger.info('批量列举云端目录 {cloud_path} 下的所有对象'.format(cloud_path=cloud_path))
+    start_time = time.time()
+    root = DirectoryStatus(cloud_path)
+    directories = {root.filename: root}
+    listing_cache = dict()
+    # 分块存储的清单对象，有对象只能沿用历史元信息时为 None（无法得知其是否为清单对象）
+    manifests = set()
+    entry_count = head_count = 0
+
+    # 以本轮列举结果为准，丢弃该前缀下的旧缓存
+    cfs.metadata_cache.invalidate_prefix(root.filename)
+    cfs.chunk_manifests = None
+    for entry in cfs.iter_all_files(cloud_path):
+        entry_count += 1
+        filename = entry['key']
+        # 分块存储的块对象不属于同步目录
+        if not filename.startswith(root.filename) or filename.startswith(root.filename + chunk_store.chunk_prefix):
+            continue
+        signature = (entry['etag'], entry['size'], entry['last_modified'])
+        cached = cfs.listing_cache.get(filename)
+        if cached is not None and cached[0] == signature:
+            stat = cached[1]
+        else:
+            logger.debug('对象 {filename} 的列举信息发生变化，获取其元信息'.format(filename=filename))
+            head_count += 1
+            try:
+                stat = cfs.stat_file(filename, cached=False)
+            except Exception as err:
+                logger.exception('获取云端文件 {filename} 的元信息失败, 错误信息为: {err}'.format(filename=filename, err=err))
+                stat = None
+        if stat is not None:
+            listing_cache[filename] = (signature, stat)
+            cfs.remember_stat(filename, stat)
+        else:
+            # 不记录本轮的列举信息，下一轮扫描会重新发送 HEAD 请求
+            if cached is None:
+                manifests = None
+            stat = _fallback_stat(filename, cached[1] if cached is not None else None, history)
+            listing_cache[filename] = (None, stat)
+            cfs.metadata_cache.invalidate(filename)
+            logger.warning('未能获取云端对象 {filename} 的元信息，沿用已知的元信息'.format(filename=filename))
+        if manifests is not None and stat.get('chunked'):
+            manifests.add(filename)
+
         if filename.endswith('/'):
             # 插入目录
-            logger.debug('发现子目录 {filename}'.format(filename=filename))
-            subdir = initialize_metatree_cloud(filename, cfs, cloud_dict)
-            # files_hash_sum += subdir.file_id
-            root.insert(subdir)
-            logger.info('将子目录 {filename} 的目录状态插入到当前目录 {cloud_path}'.format(filename=filename, cloud_path=cloud_path))
+            directory = _ensure_directory(directories, filename)
+            directory.mtime = stat['mtime']
+            directory.uuid = stat['uuid']
+            logger.debug('发现云端目录 {filename}'.format(filename=filename))
         else:
             # 插入文件
-            logger.debug('发现子文件 {filename}'.format(filename=filename))
-            mtime = ''
-            try:
-                logger.debug('获取云端文件的修改时间')
-                stat = cfs.stat_file(filename)
-                mtime = stat['mtime']
-                file_id = stat['hash']
-                # files_hash_sum += file_id
-                logger.debug('获取云端文件的修改时间成功')
-            except Exception as err:
-                logger.exception('获取云端文件的修改时间失败, 错误信息为: {err}'.format(err=err))
-            child_file = FileStatus(filename, mtime=mtime, file_id=file_id)
-            root.insert(child_file)
-            cloud_dict[child_file.file_id] = cloud_dict.get(child_file.file_id, set()).union({child_file.filename})
-            logger.info('将子文件 {filename} 的文件状态插入到当前目录 {cloud_path}'.format(filename=filename, cloud_path=cloud_path))
-            logger.debug('子文件 {filename} 的文件状态为: {child_file}'.format(filename=filename, child_file=child_file))
-
-    # 计算目录 hash
-    # root.file_id = utils.get_buffer_hash(files_hash_sum.encode())
-    logger.info('构建云端当前目录状态 {cloud_path} 完成'.format(cloud_path=cloud_path))
+            child_file = FileStatus(filename, mtime=stat['mtime'], file_id=stat['hash'], uuid=stat['uuid'])
+            _ensure_directory(directories, filename[:filename.rfind('/') + 1]).insert(child_file)
+            logger.debug('云端文件 {filename} 的文件状态为: {child_file}'.format(filename=filename, child_file=child_file))
+
+    cfs.listing_cache = listing_cache
+    cfs.chunk_manifests = manifests
+    cfs.rebuild_key_filter(root.filename, listing_cache.keys())
+    dedup_index.rebuild(iter_files(root, recursive=True))
+    update_fingerprints(root)
+    logger.info('批量列举云端目录 {cloud_path} 完成，耗时 {seconds:.2f} 秒，共 {count} 个对象，发送 HEAD 请求 {head_count} 次'
+                .format(cloud_path=cloud_path, seconds=time.time() - start_time, count=entry_count, head_count=head_count))
+    return root
+
+
+def _ensure_directory(directories: dict, dirname: str):
+    """
+    获取路径对应的目录状态，若不存在则创建该目录及其各级父目录，并插入到父目录中
+    :param directories: 目录路径到目录状态的映射，必须包含根目录
+    :param dirname: 以 / 结尾的目录路径
+    :return: 目录状态
+    """
+    missing = []
+    while dirname not in directories:
+        missing.append(dirname)
+        dirname = dirname[:dirname.rstrip('/').rfind('/') + 1]
+    parent = directories[dirname]
+    for dirname in reversed(missing):
+        directory = DirectoryStatus(dirname)
+        directories[dirname] = directory
+        parent.insert(directory)
+        parent = directory
+    return parent
+
+
+def _build_metatree_cloud_tree(cloud_path: str, cfs: CloudFileSystem, dedup_index: DedupIndex,
+                               history: DirectoryStatus = None):
+    """
+    逐个目录列举，初始化云端元信息树
+    目录列举和对象元信息查询提交到线程池并发执行，同时进行中的请求数不超过 crawl_workers，
+    请求结果由调用线程统一组装成元信息树
+    任一目录列举失败时取消其余请求并抛出异常；元信息获取失败的对象沿用已知的元信息
+    :param cloud_path: 元信息树的根目录
+    :param cfs: 云文件系统，包含 iter_files、stat_file 等函数
+    :param dedup_index: 云端去重索引，以本次列举结果重建
+    :param history: 云端历史元信息树，对象的元信息获取失败时沿用其中的记录
+    :return: 以 cloud_path 为根的元信息树
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    logger.info('构建云端当前目录状态 {cloud_path}'.format(cloud_path=cloud_path))
+    start_time = time.time()
+    counter = {'list': 0, 'head': 0}
+    counter_lock = threading.Lock()
+    root = DirectoryStatus(cloud_path)
+    # 以本轮列举结果为准，丢弃该前缀下的旧缓存
+    cfs.metadata_cache.invalidate_prefix(root.filename)
+    cfs.chunk_manifests = None
+
+    # 列举到的所有对象键，用于重建布隆过滤器，根目录本身不会出现在列举结果中
+    listed_keys = [root.filename]
+    # 分块存储的清单对象，有文件只能沿用历史元信息时为 None（无法得知其是否为清单对象）
+    manifests = set()
+
+    def list_directory(directory):
+        with counter_lock:
+            counter['list'] += 1
+        return [directory.filename + filename for filename in cfs.iter_files(directory.filename)
+                if not (directory.filename + filename).startswith(root.filename + chunk_store.chunk_prefix)]
+
+    def stat_catalog(catalog):
+        with counter_lock:
+            counter['head'] += 1
+        return cfs.stat_file(catalog.filename, cached=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, crawl_workers)) as executor:
+        tasks = {
+            executor.submit(list_directory, root): ('list', root),
+            executor.submit(stat_catalog, root): ('stat', root)
+        }
+        while tasks:
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_type, catalog = tasks.pop(future)
+                try:
+                    result = future.result()
+                except Exception as err:
+                    logger.exception('获取云端 {filename} 的信息失败, 错误信息为: {err}'
+                                     .format(filename=catalog.filename, err=err))
+                    if task_type == 'list':
+                        # 缺少子项的目录会被 PULL 当作其中的内容已在云端删除，因此放弃本次构建
+                        for pending in tasks:
+                            pending.cancel()
+                        raise
+                    result = None
+
+                if task_type == 'stat':
+                    # 填充文件(夹)的元信息
+                    if result is None and catalog.file_type == Catalog.IS_FOLDER:
+                        logger.debug('云端不存在对象 {filename}'.format(filename=catalog.filename))
+                        continue
+                    if result is None:
+                        # 文件已被列举到，获取元信息失败时也保留在树中
+                        logger.warning('未能获取云端对象 {filename} 的元信息，沿用已知的元信息'
+                                       .format(filename=catalog.filename))
+                        result = _fallback_stat(catalog.filename, None, history)
+                        cfs.metadata_cache.invalidate(catalog.filename)
+                        manifests = None
+                    elif manifests is not None and result.get('chunked'):
+                        manifests.add(catalog.filename)
+                    catalog.mtime = result['mtime']
+                    catalog.uuid = result['uuid']
+                    if catalog.file_type == Catalog.IS_FILE:
+                        catalog.file_id = result['hash']
+                        logger.debug('子文件 {filename} 的文件状态为: {child_file}'
+                                     .format(filename=catalog.filename, child_file=catalog))
+                    continue
+
+                # 将子目录和子文件插入当前目录，并继续提交它们的请求
+                logger.info('遍历云端目录 {cloud_path} 下的子目录和子文件，将它们加入当前目录的孩子列表中'
+                            .format(cloud_path=catalog.filename))
+                listed_keys.extend(result)
+                for filename in result:
+                    if filename.endswith('/'):
+                        logger.debug('发现子目录 {filename}'.format(filename=filename))
+                        child = DirectoryStatus(filename)
+                        tasks[executor.submit(list_directory, child)] = ('list', child)
+                    else:
+                        logger.debug('发现子文件 {filename}'.format(filename=filename))
+                        child = FileStatus(filename)
+                    catalog.insert(child)
+                    tasks[executor.submit(stat_catalog, child)] = ('stat', child)
+
+    cfs.chunk_manifests = manifests
+    cfs.rebuild_key_filter(root.filename, listed_keys)
+    dedup_index.rebuild(iter_files(root, recursive=True))
+    update_fingerprints(root)
+    logger.info('构建云端当前目录状态 {cloud_path} 完成，耗时 {seconds:.2f} 秒，列举请求 {list} 次，HEAD 请求 {head} 次'
+                .format(cloud_path=cloud_path, seconds=time.time() - start_time, **counter))
     return root
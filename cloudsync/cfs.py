@@ -1,4 +1,11 @@
 import os
+import logging
+import inspect
+import threading
+
+from metadata_cache import MetadataCache
+from bloom_filter import BloomFilter
+from chunk_store import ChunkStore
 
 
 class CloudFileSystem:
@@ -15,24 +22,313 @@ class CloudFileSystem:
                      云文件系统函数的文件名需符合 cfs_<csp>.py 这个格式，云存储提供商的名字则为中间的 csp
         """
         self.csp = csp_
+        # 批量列举模式下，上一轮扫描得到的对象列举信息及元信息，键为对象路径
+        self.listing_cache = dict()
+        # 对象元信息缓存，由目录扫描填充，并在本程序写入云端时同步更新
+        self.metadata_cache = MetadataCache()
+        # 扫描得到的云端对象键的布隆过滤器，判断对象一定不存在时无需发送 HEAD 请求
+        self.key_filter = None
+        self.key_filter_prefix = None
+        # 过滤器重建之前，这些前缀下可能出现过滤器不知道的对象（例如目录重命名的目标），不能据此省去 HEAD 请求
+        self._unfiltered_prefixes = []
+        # 上一轮完整扫描得到的分块存储清单对象路径，扫描时有对象的元信息未能获取则为 None
+        self.chunk_manifests = None
+        # 因布隆过滤器而省去的 HEAD 请求次数
+        self.head_skips = 0
+        self._head_skips_lock = threading.Lock()
         if not os.path.exists('cfs_{csp}.py'.format(csp=self.csp)):
             # todo: 报个警
             print('error!')
             return
         cfs = __import__('cfs_{csp}'.format(csp=self.csp))
         cfs = cfs.CloudFileSystem()
-        self.upload = cfs.upload
-        self.download = cfs.download
-        self.delete = cfs.delete
-        self.update = cfs.update
-        self.rename = cfs.rename
-        self.copy = cfs.copy
-        self.create_folder = cfs.create_folder
+        self._cfs = cfs
         self.list_files = cfs.list_files
-        self.stat_file = cfs.stat_file
-        self.set_stat = cfs.set_stat
-        self.set_hash = cfs.set_hash
-        self.set_mtime = cfs.set_mtime
+        self.iter_files = cfs.iter_files
+        self.list_all_files = cfs.list_all_files
+        self.iter_all_files = cfs.iter_all_files
         self.config['history_path'] = cfs.path_config['history_path']
         self.config['local_path'] = cfs.path_config['local_path']
         self.config['cloud_path'] = cfs.path_config['cloud_path']
+        # 分块存储，大文件的上传和下载只传输与另一版本不同的块
+        self.chunk_store = ChunkStore(cfs, self.config['cloud_path'])
+
+    def stat_file(self, cloud_path, cached=True):
+        """
+        查询并返回文件元信息，优先使用元信息缓存
+        缓存和布隆过滤器给出的“不存在”只反映上一次云端扫描时的状态，写入前判断目标是否已存在时必须使用 cached=False
+        :param cloud_path: 云端文件路径
+        :param cached: 是否使用缓存和布隆过滤器，为 False 时总是发送 HEAD 请求，并用结果刷新缓存
+        :return: None 或 含有文件元信息（包括 hash、mtime、uuid）的字典
+        """
+        if cached:
+            hit, stat = self.metadata_cache.get(cloud_path)
+            if hit:
+                return dict(stat) if stat is not None else None
+            if self._definitely_absent(cloud_path):
+                with self._head_skips_lock:
+                    self.head_skips += 1
+                return None
+        stat = self._cfs.stat_file(cloud_path)
+        self.metadata_cache.put(cloud_path, stat)
+        return stat
+
+    def remember_stat(self, cloud_path, stat):
+        """
+        将目录扫描得到的元信息写入缓存
+        :param cloud_path: 云端文件路径
+        :param stat: 文件元信息
+        :return: None
+        """
+        self.metadata_cache.put(cloud_path, stat)
+
+    def rebuild_key_filter(self, prefix, cloud_paths):
+        """
+        根据一次完整扫描得到的对象键重建布隆过滤器
+        容量预留一倍的余量，供本轮之后写入的对象使用
+        :param prefix: 扫描的路径前缀，过滤器只对该前缀下的键作出判断
+        :param cloud_paths: 该前缀下的所有对象键
+        :return: None
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        cloud_paths = list(cloud_paths)
+        key_filter = BloomFilter(capacity=2 * len(cloud_paths) + 1024)
+        for cloud_path in cloud_paths:
+            key_filter.add(cloud_path)
+        self.key_filter, self.key_filter_prefix = key_filter, prefix
+        self._unfiltered_prefixes = []
+        logger.info('重建云端对象键过滤器，共 {count} 个键，{bits} 位，{hash_count} 个散列函数，估计误判率 {rate:.4%}'
+                    .format(count=len(cloud_paths), bits=key_filter.bit_count, hash_count=key_filter.hash_count,
+                            rate=key_filter.estimated_false_positive_rate()))
+
+    def upload(self, cloud_path, local_path, file_hash=None):
+        """
+        上传文件，并缓存写入的元信息
+        启用分块存储且文件足够大时，以分块存储的方式上传
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息
+        """
+        if not local_path.endswith('/') and self.chunk_store.should_chunk(local_path):
+            return self._write_through(cloud_path, lambda: self.chunk_store.upload(cloud_path, local_path))
+        return self._write_through(cloud_path, lambda: self._cfs.upload(cloud_path, local_path, file_hash=file_hash))
+
+    def update(self, cloud_path, local_path, file_hash=None):
+        """
+        使用本地文件的内容更新云端文件的内容，被更新文件的元信息优先从缓存中获取
+        启用分块存储且文件足够大时，以分块存储的方式上传
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息，云端文件不存在时返回 None
+        """
+        stat = self.stat_file(cloud_path)
+        if stat is None:
+            return None
+        if stat.get('chunked'):
+            # 被覆盖的清单所引用的块可能成为垃圾
+            self.chunk_store.garbage_pending = True
+        if self.chunk_store.should_chunk(local_path):
+            # 云端当前版本也是分块存储时，以其清单为参考，只上传新的块
+            reference = self.chunk_store.load_manifest(cloud_path) if stat.get('chunked') else None
+            return self._write_through(cloud_path, lambda: self.chunk_store.upload(
+                cloud_path, local_path, file_uuid=stat['uuid'], reference=reference))
+        return self._write_through(cloud_path,
+                                   lambda: self._cfs.update(cloud_path, local_path, stat=stat, file_hash=file_hash))
+
+    def download(self, cloud_path, local_path):
+        """
+        下载文件，云端文件是分块存储的清单对象时，只下载本地文件中没有的块
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :return: (文件摘要, 下载完成后本地文件的 stat 信息)
+        """
+        stat = self.stat_file(cloud_path)
+        if stat is not None and stat.get('chunked'):
+            return self.chunk_store.download(cloud_path, local_path, stat)
+        return self._cfs.download(cloud_path, local_path)
+
+    def create_folder(self, cloud_path):
+        """
+        创建一个空目录，并缓存写入的元信息
+        :param cloud_path: 云端目录路径
+        :return: 写入的目录元信息
+        """
+        if not cloud_path.endswith('/'):
+            cloud_path += '/'
+        return self._write_through(cloud_path, lambda: self._cfs.create_folder(cloud_path))
+
+    def copy(self, src_path, dist_path, file_uuid=None):
+        """
+        复制文件，并缓存目标文件的元信息
+        源文件的元信息优先从缓存中获取，复制只需一次服务端复制请求
+        :param src_path: 复制的源文件
+        :param dist_path: 复制的目标文件
+        :param file_uuid: 目标文件的文件ID，为 None 时生成新的文件ID
+        :return: 目标文件的元信息，云端未返回时为 None
+        """
+        stat = self._get_cached_stat(src_path)
+        return self._write_through(dist_path,
+                                   lambda: self._cfs.copy(src_path, dist_path, stat=stat, file_uuid=file_uuid))
+
+    def delete(self, cloud_path):
+        """
+        删除文件，并在缓存中记录该文件已不存在
+        :param cloud_path: 云端文件路径
+        :return: None
+        """
+        self._release_chunks([cloud_path])
+        try:
+            self._cfs.delete(cloud_path)
+        except Exception:
+            self.metadata_cache.invalidate(cloud_path)
+            raise
+        self.metadata_cache.put(cloud_path, None)
+
+    def delete_many(self, cloud_paths):
+        """
+        批量删除文件，并在缓存中记录删除成功的文件已不存在
+        :param cloud_paths: 云端文件路径列表
+        :return: 删除失败的云端文件路径列表
+        """
+        cloud_paths = list(cloud_paths)
+        self._release_chunks(cloud_paths)
+        failed = self._cfs.delete_many(cloud_paths)
+        failed_set = set(failed)
+        for cloud_path in cloud_paths:
+            if cloud_path in failed_set:
+                self.metadata_cache.invalidate(cloud_path)
+            else:
+                self.metadata_cache.put(cloud_path, None)
+        return failed
+
+    def abort_multipart_upload(self, cloud_path, upload_id):
+        """
+        取消分片上传，删除已上传的分片
+        :param cloud_path: 云端文件路径
+        :param upload_id: 分片上传 ID
+        :return: None
+        """
+        self._cfs.abort_multipart_upload(cloud_path, upload_id)
+
+    def collect_chunk_garbage(self):
+        """
+        以上一轮完整扫描得到的清单对象为根，回收不再被引用的块对象
+        扫描不完整时无法确定所有的清单对象，跳过本次回收
+        :return: 删除的块对象数量
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if self.chunk_manifests is None:
+            logger.info('上一轮云端扫描不完整，跳过块对象垃圾回收')
+            return 0
+        return self.chunk_store.collect_garbage(self.chunk_manifests)
+
+    def set_stat(self, cloud_path, stat):
+        """
+        修改文件元信息，并缓存新的元信息
+        :param cloud_path: 云端文件路径
+        :param stat: 文件元信息
+        :return: None
+        """
+        self._cfs.set_stat(cloud_path, stat)
+        self.metadata_cache.put(cloud_path, stat)
+
+    def set_hash(self, cloud_path, hash_value):
+        """
+        设置文件摘要 hash，当前元信息优先从缓存中获取
+        :param cloud_path: 云端文件路径
+        :param hash_value: 文件内容摘要
+        :return: None
+        """
+        stat = self.stat_file(cloud_path)
+        stat['hash'] = hash_value
+        self.set_stat(cloud_path, stat)
+
+    def set_mtime(self, cloud_path, mtime):
+        """
+        设置最近修改时间，当前元信息优先从缓存中获取
+        :param cloud_path: 云端文件路径
+        :param mtime: 修改时间
+        :return: None
+        """
+        stat = self.stat_file(cloud_path)
+        stat['mtime'] = mtime
+        self.set_stat(cloud_path, stat)
+
+    def rename(self, old_cloud_path: str, new_cloud_path: str):
+        """
+        重命名文件或目录
+        对象的元信息优先使用缓存中的结果，从而在复制请求中直接写入新的修改时间，无需逐个发送 HEAD 请求
+        :param old_cloud_path: 重命名前的云端文件路径
+        :param new_cloud_path: 重命名后的云端文件路径
+        :return: None
+        """
+        if old_cloud_path.endswith('/'):
+            try:
+                self._cfs.rename(old_cloud_path, new_cloud_path, stat_of=self._get_cached_stat)
+            finally:
+                self.metadata_cache.invalidate_prefix(old_cloud_path)
+                self.metadata_cache.invalidate_prefix(new_cloud_path)
+                self._unfiltered_prefixes.append(new_cloud_path)
+            return
+        self._write_through(new_cloud_path,
+                            lambda: self._cfs.rename(old_cloud_path, new_cloud_path, stat_of=self._get_cached_stat))
+        self.metadata_cache.put(old_cloud_path, None)
+
+    def _release_chunks(self, cloud_paths):
+        """
+        被删除的文件中可能有清单对象时，标记有待回收的块对象
+        元信息未缓存的文件无法确定是否为清单对象，按清单对象处理
+        :param cloud_paths: 将被删除的云端文件路径
+        :return: None
+        """
+        for cloud_path in cloud_paths:
+            hit, stat = self.metadata_cache.get(cloud_path)
+            if not hit or (stat is not None and stat.get('chunked')):
+                self.chunk_store.garbage_pending = True
+                return
+
+    def _get_cached_stat(self, cloud_path):
+        """
+        从缓存中获取对象元信息，不发送网络请求
+        :param cloud_path: 云端文件路径
+        :return: None 或 含有文件元信息（包括 hash、mtime、uuid）的字典
+        """
+        hit, stat = self.metadata_cache.get(cloud_path)
+        return stat if hit else None
+
+    def _write_through(self, cloud_path, write):
+        """
+        执行写入云端的操作并更新缓存，写入失败或云端未返回元信息时使缓存失效
+        :param cloud_path: 被写入的云端文件路径
+        :param write: 执行写入的函数，返回写入的元信息
+        :return: 写入的元信息
+        """
+        # 写入失败时对象也可能已经存在，因此先加入过滤器
+        if self.key_filter is not None:
+            self.key_filter.add(cloud_path)
+        try:
+            stat = write()
+        except Exception:
+            self.metadata_cache.invalidate(cloud_path)
+            raise
+        if stat is not None:
+            self.metadata_cache.put(cloud_path, stat)
+        else:
+            self.metadata_cache.invalidate(cloud_path)
+        return stat
+
+    def _definitely_absent(self, cloud_path):
+        """
+        :param cloud_path: 云端文件路径
+        :return: 布隆过滤器能否断定对象不存在
+        """
+        key_filter, prefix = self.key_filter, self.key_filter_prefix
+        if key_filter is None or not cloud_path.startswith(prefix):
+            return False
+        if any(cloud_path.startswith(unfiltered) for unfiltered in self._unfiltered_prefixes):
+            return False
+        return not key_filter.might_contain(cloud_path)
@@ -1,9 +1,11 @@
+import os
 import time
 import logging
 import oss2
 from uuid import uuid1 as uuid
 
 import utils
+import transfer
 
 
 class CloudFileSystem:
@@ -34,51 +36,68 @@ class CloudFileSystem:
             'cloud_path': cos_config.ali['cloud_path']
         }
 
-    def upload(self, cloud_path, local_path):
+    def upload(self, cloud_path, local_path, file_hash=None):
         """
         上传文件
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对文件内容计算散列值而得，由 _put_file 在上传的同时计算
         - 文件ID 使用 uuid.uuid1() 函数生成
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :param file_hash: 已知的本地文件摘要（例如来自本地摘要缓存），为 None 时在上传的同时计算
+        :return: 写入的文件元信息（包括 hash、mtime、uuid）
         """
         if local_path.endswith('/'):
-            self.create_folder(cloud_path)
+            return self.create_folder(cloud_path)
         else:
-            # get file metadata
-            file_hash = ''
-            try:
-                file_hash = utils.get_local_file_hash(local_path)
-            except Exception as e:
-                print(e)
-            file_mtime = str(int(time.time()))
-            file_id = str(uuid())
+            return self._put_file(cloud_path, local_path, {
+                'hash': file_hash or '',
+                'mtime': str(int(time.time())),
+                'uuid': str(uuid())
+            })
 
-            # upload file
-            with open(local_path, 'rb') as f:
-                self._client.put_object(key=cloud_path,
-                                        data=f,
-                                        headers={
-                                            'x-oss-meta-hash': file_hash,
-                                            'x-oss-meta-mtime': file_mtime,
-                                            'x-oss-meta-uuid': file_id
-                                        })
+    def open_object(self, cloud_path):
+        """
+        打开对象的内容流
+        :param cloud_path: 云端文件路径
+        :return: (响应流, 对象大小, ETag, 摘要元信息)，对象没有摘要元信息时为空字符串
+        """
+        response = self._client.get_object(key=cloud_path)
+        return response, response.content_length, response.etag, response.headers.get('x-oss-meta-hash', '')
+
+    def head_object(self, cloud_path):
+        """
+        通过 HEAD 请求获取对象信息，不传输对象内容
+        :param cloud_path: 云端文件路径
+        :return: (对象大小, ETag, 摘要元信息)，对象没有摘要元信息时为空字符串
+        """
+        response = self._client.head_object(key=cloud_path)
+        return response.content_length, response.etag, response.headers.get('x-oss-meta-hash', '')
+
+    def put_object(self, cloud_path, data, stat=None):
+        """
+        将内存中的数据写入对象
+        :param cloud_path: 云端文件路径
+        :param data: 对象内容
+        :param stat: 对象的元信息，为 None 时不写入自定义元信息
+        :return: None
+        """
+        headers = self._make_headers(stat) if stat is not None else None
+        self._client.put_object(key=cloud_path, data=data, headers=headers)
 
     def download(self, cloud_path, local_path):
         """
-        下载文件
+        下载文件，下载的同时计算摘要，并与对象的摘要元信息校验
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :return: (文件摘要, 下载完成后本地文件的 stat 信息)
         """
-        import shutil
-        response = self._client.get_object(key=cloud_path)
-        # 写入本地文件
-        with open(local_path, 'wb') as f:
-            shutil.copyfileobj(response, f)
+        # 先下载到临时文件，再替换。大文件分段并行下载，并支持断点续传
+        return transfer.download_object(
+            cloud_path, local_path, lambda: self.head_object(cloud_path), lambda: self.open_object(cloud_path),
+            get_range=lambda start, end: self._client.get_object(key=cloud_path, byte_range=(start, end)).read()
+        )
 
     def delete(self, cloud_path):
         """
@@ -88,74 +107,162 @@ class CloudFileSystem:
         """
         self._client.delete_object(key=cloud_path)
 
-    def update(self, cloud_path, local_path):
+    def delete_many(self, cloud_paths):
+        """
+        批量删除文件
+        使用批量删除接口，每次请求最多删除 1000 个文件
+        :param cloud_paths: 云端文件路径列表
+        :return: 删除失败的云端文件路径列表
+        """
+        cloud_paths = list(cloud_paths)
+        failed = []
+        for index in range(0, len(cloud_paths), 1000):
+            batch = cloud_paths[index:index + 1000]
+            try:
+                deleted = set(self._client.batch_delete_objects(batch).deleted_keys)
+            except oss2.exceptions.OssError:
+                deleted = set()
+            failed += [cloud_path for cloud_path in batch if cloud_path not in deleted]
+        return failed
+
+    def abort_multipart_upload(self, cloud_path, upload_id):
+        """
+        取消分片上传，删除已上传的分片
+        :param cloud_path: 云端文件路径
+        :param upload_id: 分片上传 ID
+        :return: None
+        """
+        self._client.abort_multipart_upload(key=cloud_path, upload_id=upload_id)
+
+    def update(self, cloud_path, local_path, stat=None, file_hash=None):
         """
         使用本地文件的内容更新云端文件的内容
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得，由 _put_file 在上传的同时计算
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :param stat: 被更新的云端文件当前的元信息，为 None 时通过 stat_file 获取
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息，云端文件不存在时返回 None
         """
-        if cloud_path.endswith('/') or not self._client.object_exists(key=cloud_path):
-            return
+        if cloud_path.endswith('/'):
+            return None
+        if stat is None:
+            stat = self.stat_file(cloud_path)
+            if stat is None:
+                return None
 
-        # get file metadata
-        file_hash = ''
-        try:
-            file_hash = utils.get_local_file_hash(local_path)
-        except Exception as e:
-            print(e)
-        file_mtime = str(int(time.time()))
-        file_id = self.stat_file(cloud_path)['uuid']
+        return self._put_file(cloud_path, local_path, {
+            'hash': file_hash or '',
+            'mtime': str(int(time.time())),
+            'uuid': stat['uuid']
+        })
 
-        # upload file
-        with open(local_path, 'rb') as f:
-            self._client.put_object(key=cloud_path,
-                                    data=f,
-                                    headers={
-                                        'x-oss-meta-hash': file_hash,
-                                        'x-oss-meta-mtime': file_mtime,
-                                        'x-oss-meta-uuid': file_id
-                                    })
+    def _put_file(self, cloud_path, local_path, stat):
+        """
+        上传本地文件的内容，并写入元信息
+        - 文件大小小于 transfer.multipart_threshold 时，上传的同时计算摘要，文件只读取一次；
+          实际摘要与 stat 中给出的摘要不一致（未给出或文件在上传前发生了变化）时，上传完成后再修改一次元信息
+        - 否则使用可断点续传的分片并行上传，元信息在初始化时写入，未给出摘要时先计算摘要
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param stat: 要写入的元信息（包括 hash、mtime、uuid），hash 可以为空
+        :return: 实际写入的文件元信息
+        """
+        if os.path.getsize(local_path) < transfer.multipart_threshold:
+            with open(local_path, 'rb') as f:
+                reader = utils.HashingReader(f)
+                self._client.put_object(key=cloud_path, data=reader, headers=self._make_headers(stat))
+            file_hash = reader.hexdigest() or utils.get_local_file_hash(local_path)
+            if file_hash != stat['hash']:
+                stat = dict(stat, hash=file_hash)
+                self.set_stat(cloud_path, stat)
+            return stat
 
-    def rename(self, old_cloud_path: str, new_cloud_path: str):
+        if not stat['hash']:
+            stat = dict(stat, hash=utils.get_local_file_hash(local_path))
+        headers = transfer.multipart_upload(
+            cloud_path, local_path, self._make_headers(stat),
+            init_upload=lambda metadata: self._client.init_multipart_upload(key=cloud_path, headers=metadata).upload_id,
+            upload_part=lambda upload_id, part_number, data: self._client.upload_part(
+                key=cloud_path, upload_id=upload_id, part_number=part_number, data=data).etag,
+            complete_upload=lambda upload_id, parts: self._client.complete_multipart_upload(
+                key=cloud_path, upload_id=upload_id,
+                parts=[oss2.models.PartInfo(part_number, etag) for part_number, etag in parts]),
+            abort_upload=lambda upload_id: self._client.abort_multipart_upload(key=cloud_path, upload_id=upload_id)
+        )
+        # 从断点处继续上传时，对象使用的是断点记录中的元信息
+        return {
+            'hash': headers['x-oss-meta-hash'],
+            'mtime': headers['x-oss-meta-mtime'],
+            'uuid': headers['x-oss-meta-uuid']
+        }
+
+    @staticmethod
+    def _make_headers(stat):
+        """
+        :param stat: 文件元信息（包括 hash、mtime、uuid，分块存储的清单对象另有 chunked）
+        :return: 对象的自定义元信息请求头
+        """
+        headers = {
+            'x-oss-meta-hash': stat['hash'],
+            'x-oss-meta-mtime': stat['mtime'],
+            'x-oss-meta-uuid': stat['uuid']
+        }
+        if stat.get('chunked'):
+            headers['x-oss-meta-chunked'] = stat['chunked']
+        return headers
+
+    def rename(self, old_cloud_path: str, new_cloud_path: str, stat_of=None):
         """
         重命名文件或目录
         如果是目录，需要对目录下的所有子文件都重命名
         要求重命名完成后，设置最新的修改时间 mtime
         :param old_cloud_path: 重命名前的云端文件路径
         :param new_cloud_path: 重命名后的云端文件路径
-        :return: None
+        :param stat_of: 获取对象元信息的函数，未提供或返回 None 时通过 stat_file 获取
+        :return: 重命名文件时返回新文件的元信息，重命名目录时返回 None
         """
-        if old_cloud_path.endswith('/'):
-            # 对目录下的文件进行递归重命名
-            for filename in self.list_files(old_cloud_path):
-                self.rename(old_cloud_path + filename, new_cloud_path + filename)
-            self._client.copy_object(source_bucket_name=self._bucket_name,
-                                     source_key=old_cloud_path,
-                                     target_key=new_cloud_path)
-        else:
-            self._client.copy_object(source_bucket_name=self._bucket_name,
-                                     source_key=old_cloud_path,
-                                     target_key=new_cloud_path)
+        def get_stat(cloud_path):
+            stat = stat_of(cloud_path) if stat_of is not None else None
+            return stat if stat is not None else self.stat_file(cloud_path)
 
+        if old_cloud_path.endswith('/'):
+            # 并行复制目录下的所有对象，复制的同时设置新的修改时间，再批量删除旧对象
+            cloud_paths = [entry['key'] for entry in self.iter_all_files(old_cloud_path)]
+            transfer.rename_folder(old_cloud_path, new_cloud_path, cloud_paths,
+                                   get_stat, self._copy_object, self.delete_many)
+            return None
+        stat = dict(get_stat(old_cloud_path))
+        stat['mtime'] = str(int(time.time()))
+        self._copy_object(old_cloud_path, new_cloud_path, stat)
         self.delete(old_cloud_path)
-        self.set_mtime(cloud_path=new_cloud_path, mtime=str(int(time.time())))
+        return stat
 
-    def copy(self, src_path: str, dist_path: str):
+    def copy(self, src_path: str, dist_path: str, stat=None, file_uuid=None):
         """
         复制文件
+        通过一次服务端复制写入目标文件，同时写入源文件的摘要、当前时间作为修改时间 mtime，以及目标文件的文件ID
         :param src_path: 复制的源文件
         :param dist_path: 复制的目标文件
-        :return: None
+        :param stat: 源文件的元信息，为 None 时通过 stat_file 获取
+        :param file_uuid: 目标文件的文件ID，为 None 时使用 uuid.uuid1() 生成新的文件ID
+        :return: 目标文件的元信息（包括 hash、mtime、uuid，源文件是清单对象时另有 chunked）
         """
-        self._client.copy_object(source_bucket_name=self._bucket_name,
-                                 source_key=src_path,
-                                 target_key=dist_path)
-        self.set_mtime(cloud_path=dist_path, mtime=str(int(time.time())))
+        if stat is None:
+            stat = self.stat_file(src_path)
+        dist_stat = {
+            'hash': stat['hash'],
+            'mtime': str(int(time.time())),
+            'uuid': file_uuid if file_uuid is not None else str(uuid())
+        }
+        if stat.get('chunked'):
+            # 复制清单对象即复制整个文件，块对象由两个清单共享
+            dist_stat['chunked'] = stat['chunked']
+        self._copy_object(src_path, dist_path, dist_stat)
+        return dist_stat
 
     def create_folder(self, cloud_path: str):
         """
@@ -165,7 +272,7 @@ class CloudFileSystem:
         - 摘要 hash 使用选定算法对空字符串计算散列值而得
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端目录路径
-        :return: None
+        :return: 写入的目录元信息（包括 hash、mtime、uuid）
         """
         # cloud_path 结尾若不是 / , 上传之后不会表现为文件夹
         if not cloud_path.endswith('/'):
@@ -184,6 +291,7 @@ class CloudFileSystem:
                                     'x-oss-meta-mtime': file_mtime,
                                     'x-oss-meta-uuid': file_id
                                 })
+        return {'hash': file_hash, 'mtime': file_mtime, 'uuid': file_id}
 
     def list_files(self, cloud_path):
         """
@@ -192,20 +300,76 @@ class CloudFileSystem:
         :param cloud_path: 云端目录路径
         :return: 由子目录名和子文件名组成的数组
         """
-        files = []
-        items = oss2.ObjectIterator(self._client, prefix=cloud_path, delimiter='/')
-        items = [item for item in items]
-        # 添加目录名
-        files += [item.key.split('/')[-2] + '/' for item in items if item.is_prefix()]
-        # 添加文件名
-        files += [item.key.split('/')[-1] for item in items if not item.key.endswith('/')]
-        return files
+        return list(self.iter_files(cloud_path))
+
+    def iter_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        分页迭代子目录和文件，逐页产出子目录名（以 / 结尾）和子文件名
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出子目录名和子文件名的生成器
+        """
+        for result in self._iter_pages(cloud_path, '/', page_size, prefetch):
+            # 产出目录名
+            for prefix in result.prefix_list:
+                yield prefix.split('/')[-2] + '/'
+            # 产出文件名
+            for item in result.object_list:
+                if not item.key.endswith('/'):
+                    yield item.key.split('/')[-1]
+
+    def list_all_files(self, cloud_path):
+        """
+        不使用分隔符，分页列出 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        要求返回值为对象信息字典所组成的数组，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :return: 由对象信息字典组成的数组
+        """
+        return list(self.iter_all_files(cloud_path))
+
+    def iter_all_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        不使用分隔符，分页迭代 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        逐页产出对象信息字典，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出对象信息字典的生成器
+        """
+        for result in self._iter_pages(cloud_path, '', page_size, prefetch):
+            for item in result.object_list:
+                yield {
+                    'key': item.key,
+                    'etag': item.etag,
+                    'size': item.size,
+                    'last_modified': item.last_modified
+                }
+
+    def _iter_pages(self, cloud_path, delimiter, page_size, prefetch):
+        """
+        分页列举 cloud_path 前缀下的对象，逐页产出 oss2 的列举结果
+        :param cloud_path: 云端目录路径
+        :param delimiter: 分隔符，为空字符串时列出所有层级的对象
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出 oss2.models.ListObjectsResult 的生成器
+        """
+        page_size = utils.list_page_size if page_size is None else page_size
+
+        def fetch_page(marker):
+            result = self._client.list_objects(prefix=cloud_path, delimiter=delimiter,
+                                               marker=marker, max_keys=page_size)
+            return result, result.next_marker if result.is_truncated else None
+
+        return utils.iterate_pages(fetch_page, prefetch)
 
     def stat_file(self, cloud_path):
         """
         查询并返回文件元信息
         若文件不存在，则返回 None
         若文件元信息存在空值，则设置该文件的此项的元信息
+        分块存储的清单对象另有 chunked 标记，其 hash 是整个文件的摘要
         :param cloud_path: 云端文件路径
         :return: None 或 含有文件元信息（包括 hash、mtime、uuid）的字典
         """
@@ -215,20 +379,23 @@ class CloudFileSystem:
         except oss2.exceptions.NotFound:
             return None
 
-        # get hash
-        if 'x-oss-meta-hash' in metadata.headers:
+        # get hash，空值视为缺失
+        if metadata.headers.get('x-oss-meta-hash'):
             hash_value = metadata.headers['x-oss-meta-hash']
+        elif utils.cloud_hash_mode == 'crc64' and metadata.headers.get('x-oss-hash-crc64ecma'):
+            # 使用云端计算的 CRC64 作为指纹，不写回元信息
+            hash_value = utils.crc64_prefix + metadata.headers['x-oss-hash-crc64ecma']
         else:
             hash_value = utils.get_cloud_file_hash(cloud_path, self)
             set_stat_flag = True
         # get mtime
-        if 'x-oss-meta-mtime' in metadata.headers:
+        if metadata.headers.get('x-oss-meta-mtime'):
             mtime = metadata.headers['x-oss-meta-mtime']
         else:
             mtime = str(int(time.time()))
             set_stat_flag = True
         # get uuid
-        if 'x-oss-meta-uuid' in metadata.headers:
+        if metadata.headers.get('x-oss-meta-uuid'):
             file_id = metadata.headers['x-oss-meta-uuid']
         else:
             file_id = str(uuid())
@@ -239,8 +406,10 @@ class CloudFileSystem:
             'mtime': mtime,
             'uuid': file_id
         }
+        if metadata.headers.get('x-oss-meta-chunked'):
+            stat['chunked'] = metadata.headers['x-oss-meta-chunked']
         if set_stat_flag:
-            self.set_stat(cloud_path, stat)
+            self.set_stat(cloud_path, dict(stat, hash='') if utils.is_crc64_fingerprint(hash_value) else stat)
         return stat
 
     def set_stat(self, cloud_path, stat):
@@ -250,15 +419,22 @@ class CloudFileSystem:
         :param stat: 文件元信息
         :return: None
         """
-        metadata = {
-            'x-oss-meta-hash': stat['hash'],
-            'x-oss-meta-mtime': stat['mtime'],
-            'x-oss-meta-uuid': stat['uuid'],
-        }
+        self._copy_object(cloud_path, cloud_path, stat)
+
+    def _copy_object(self, src_path, dist_path, stat):
+        """
+        复制对象，并在同一个请求中将目标对象的元信息替换为 stat
+        :param src_path: 复制的源文件
+        :param dist_path: 复制的目标文件
+        :param stat: 目标对象的元信息
+        :return: None
+        """
+        headers = self._make_headers(stat)
+        headers['x-oss-metadata-directive'] = 'REPLACE'
         self._client.copy_object(source_bucket_name=self._bucket_name,
-                                 source_key=cloud_path,
-                                 target_key=cloud_path,
-                                 headers=metadata)
+                                 source_key=src_path,
+                                 target_key=dist_path,
+                                 headers=headers)
 
     def set_hash(self, cloud_path, hash_value):
         """
@@ -11,15 +11,42 @@ class CloudFileSystem:
         """
         pass
 
-    def upload(self, cloud_path, local_path):
+    def upload(self, cloud_path, local_path, file_hash=None):
         """
         上传文件
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对文件内容计算散列值而得，应通过 utils.HashingReader 在上传的同时计算，避免重复读取文件
         - 文件ID 使用 uuid.uuid1() 函数生成
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息（包括 hash、mtime、uuid）
+        """
+        pass
+
+    def head_object(self, cloud_path):
+        """
+        通过 HEAD 请求获取对象信息，不传输对象内容，用于在下载前决定下载方式
+        :param cloud_path: 云端文件路径
+        :return: (对象大小, ETag, 摘要元信息)，对象没有摘要元信息时摘要元信息为空字符串
+        """
+        pass
+
+    def open_object(self, cloud_path):
+        """
+        打开对象的内容流，用于流式下载和流式计算摘要
+        :param cloud_path: 云端文件路径
+        :return: (响应流, 对象大小, ETag, 摘要元信息)，响应流需提供 read 方法，对象没有摘要元信息时摘要元信息为空字符串
+        """
+        pass
+
+    def put_object(self, cloud_path, data, stat=None):
+        """
+        将内存中的数据写入对象，用于写入分块存储的块对象和清单对象
+        :param cloud_path: 云端文件路径
+        :param data: 对象内容
+        :param stat: 对象的元信息，为 None 时不写入自定义元信息；包含 chunked 时需一并写入
         :return: None
         """
         pass
@@ -27,9 +54,10 @@ class CloudFileSystem:
     def download(self, cloud_path, local_path):
         """
         下载文件
+        要求通过 transfer.download_object 下载，下载的同时计算摘要，摘要与对象的摘要元信息不一致时抛出异常
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :return: (文件摘要, 下载完成后本地文件的 stat 信息)
         """
         pass
 
@@ -41,36 +69,64 @@ class CloudFileSystem:
         """
         pass
 
-    def update(self, cloud_path, local_path):
+    def delete_many(self, cloud_paths):
+        """
+        批量删除文件
+        使用批量删除接口，每次请求最多删除 1000 个文件
+        :param cloud_paths: 云端文件路径列表
+        :return: 删除失败的云端文件路径列表
+        """
+        pass
+
+    def abort_multipart_upload(self, cloud_path, upload_id):
+        """
+        取消分片上传，删除已上传的分片
+        :param cloud_path: 云端文件路径
+        :param upload_id: 分片上传 ID
+        :return: None
+        """
+        pass
+
+    def update(self, cloud_path, local_path, stat=None, file_hash=None):
         """
         使用本地文件的内容更新云端文件的内容
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得，应在上传的同时计算
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :param stat: 被更新的云端文件当前的元信息，为 None 时通过 stat_file 获取
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息，云端文件不存在时返回 None
         """
         pass
 
-    def rename(self, old_cloud_path: str, new_cloud_path: str):
+    def rename(self, old_cloud_path: str, new_cloud_path: str, stat_of=None):
         """
         重命名文件或目录
         如果是目录，需要对目录下的所有子文件都重命名
         要求重命名完成后，设置最新的修改时间 mtime
         :param old_cloud_path: 重命名前的云端文件路径
         :param new_cloud_path: 重命名后的云端文件路径
-        :return: None
+        :param stat_of: 获取对象元信息的函数，未提供或返回 None 时通过 stat_file 获取
+        :return: 重命名文件时返回新文件的元信息，重命名目录时返回 None
         """
         pass
 
-    def copy(self, src_path: str, dist_path: str):
+    def copy(self, src_path: str, dist_path: str, stat=None, file_uuid=None):
         """
         复制文件
+        要求通过一次服务端复制完成，目标文件的元信息在同一个请求中写入：
+        - 摘要 hash 使用源文件的摘要
+        - 修改时间 mtime 使用当前的时间
+        - 文件ID 使用 file_uuid，未提供时使用 uuid.uuid1() 函数生成
+        - 源文件是分块存储的清单对象时，保留 chunked 标记
         :param src_path: 复制的源文件
         :param dist_path: 复制的目标文件
-        :return: None
+        :param stat: 源文件的元信息，为 None 时通过 stat_file 获取
+        :param file_uuid: 目标文件的文件ID
+        :return: 目标文件的元信息（包括 hash、mtime、uuid）
         """
         pass
 
@@ -82,7 +138,7 @@ class CloudFileSystem:
         - 摘要 hash 使用选定算法对空字符串计算散列值而得
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端目录路径
-        :return: None
+        :return: 写入的目录元信息（包括 hash、mtime、uuid）
         """
         pass
 
@@ -95,11 +151,44 @@ class CloudFileSystem:
         """
         pass
 
+    def iter_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        分页迭代子目录和文件，逐页产出子目录名（以 / 结尾）和子文件名
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出子目录名和子文件名的生成器
+        """
+        pass
+
+    def list_all_files(self, cloud_path):
+        """
+        不使用分隔符，分页列出 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        要求返回值为对象信息字典所组成的数组，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :return: 由对象信息字典组成的数组
+        """
+        pass
+
+    def iter_all_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        不使用分隔符，分页迭代 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        逐页产出对象信息字典，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出对象信息字典的生成器
+        """
+        pass
+
     def stat_file(self, cloud_path):
         """
         查询并返回文件元信息
         若文件不存在，则返回 None
         若文件元信息存在空值，则设置该文件的此项的元信息
+        缺少摘要时通过 utils.get_cloud_file_hash 流式计算，utils.cloud_hash_mode 为 crc64 时改用云端的 CRC64 作为指纹，
+        该指纹不写回元信息
+        对象带有 chunked 自定义元信息时（分块存储的清单对象），结果中包含 chunked
         :param cloud_path: 云端文件路径
         :return: None 或 含有文件元信息（包括 hash、mtime、uuid）的字典
         """
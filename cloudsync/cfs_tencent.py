@@ -4,6 +4,7 @@ import qcloud_cos
 from uuid import uuid1 as uuid
 
 import utils
+import transfer
 
 
 class CloudFileSystem:
@@ -35,52 +36,74 @@ class CloudFileSystem:
             'cloud_path': cos_config.tencent['cloud_path']
         }
 
-    def upload(self, cloud_path, local_path):
+    def upload(self, cloud_path, local_path, file_hash=None):
         """
         上传文件
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对文件内容计算散列值而得，由 _put_file 在上传的同时计算
         - 文件ID 使用 uuid.uuid1() 函数生成
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :param file_hash: 已知的本地文件摘要（例如来自本地摘要缓存），为 None 时在上传的同时计算
+        :return: 写入的文件元信息（包括 hash、mtime、uuid）
         """
         if local_path.endswith('/'):
-            self.create_folder(cloud_path)
+            return self.create_folder(cloud_path)
         else:
-            # get file metadata
-            file_hash = ''
-            try:
-                file_hash = utils.get_local_file_hash(local_path)
-            except Exception as e:
-                print(e)
-            file_mtime = str(int(time.time()))
-            file_id = str(uuid())
+            return self._put_file(cloud_path, local_path, {
+                'hash': file_hash or '',
+                'mtime': str(int(time.time())),
+                'uuid': str(uuid())
+            })
 
-            # upload file
-            with open(local_path, 'rb') as f:
-                self._client.put_object(Bucket=self._bucket,
-                                        Key=cloud_path,
-                                        Body=f,
-                                        Metadata={
-                                            'x-cos-meta-hash': file_hash,
-                                            'x-cos-meta-mtime': file_mtime,
-                                            'x-cos-meta-uuid': file_id
-                                        })
+    def open_object(self, cloud_path):
+        """
+        打开对象的内容流
+        :param cloud_path: 云端文件路径
+        :return: (响应流, 对象大小, ETag, 摘要元信息)，对象没有摘要元信息时为空字符串
+        """
+        response = self._client.get_object(Bucket=self._bucket, Key=cloud_path)
+        return response['Body'].get_raw_stream(), int(response['Content-Length']), response['ETag'], \
+            response.get('x-cos-meta-hash', '')
+
+    def head_object(self, cloud_path):
+        """
+        通过 HEAD 请求获取对象信息，不传输对象内容
+        :param cloud_path: 云端文件路径
+        :return: (对象大小, ETag, 摘要元信息)，对象没有摘要元信息时为空字符串
+        """
+        response = self._client.head_object(Bucket=self._bucket, Key=cloud_path)
+        return int(response['Content-Length']), response['ETag'], response.get('x-cos-meta-hash', '')
+
+    def put_object(self, cloud_path, data, stat=None):
+        """
+        将内存中的数据写入对象
+        :param cloud_path: 云端文件路径
+        :param data: 对象内容
+        :param stat: 对象的元信息，为 None 时不写入自定义元信息
+        :return: None
+        """
+        if stat is None:
+            self._client.put_object(Bucket=self._bucket, Key=cloud_path, Body=data)
+        else:
+            self._client.put_object(Bucket=self._bucket, Key=cloud_path, Body=data, Metadata=self._make_metadata(stat))
 
     def download(self, cloud_path, local_path):
         """
-        下载文件
+        下载文件，下载的同时计算摘要，并与对象的摘要元信息校验
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :return: (文件摘要, 下载完成后本地文件的 stat 信息)
         """
-        temp_local_path = local_path + str(uuid())
-        response = self._client.get_object(Bucket=self._bucket, Key=cloud_path)
-        # 先下载到临时文件，再替换。避免因为本地文件已存在而导致异常的情况。
-        response['Body'].get_stream_to_file(temp_local_path)
-        os.replace(temp_local_path, local_path)
+        def get_range(start, end):
+            response = self._client.get_object(Bucket=self._bucket, Key=cloud_path,
+                                               Range='bytes={start}-{end}'.format(start=start, end=end))
+            return response['Body'].get_raw_stream().read()
+
+        # 先下载到临时文件，再替换。避免因为本地文件已存在而导致异常的情况。大文件分段并行下载，并支持断点续传
+        return transfer.download_object(cloud_path, local_path, lambda: self.head_object(cloud_path),
+                                        lambda: self.open_object(cloud_path), get_range)
 
     def delete(self, cloud_path):
         """
@@ -90,73 +113,168 @@ class CloudFileSystem:
         """
         self._client.delete_object(Bucket=self._bucket, Key=cloud_path)
 
-    def update(self, cloud_path, local_path):
+    def delete_many(self, cloud_paths):
+        """
+        批量删除文件
+        使用批量删除接口，每次请求最多删除 1000 个文件
+        :param cloud_paths: 云端文件路径列表
+        :return: 删除失败的云端文件路径列表
+        """
+        cloud_paths = list(cloud_paths)
+        failed = []
+        for index in range(0, len(cloud_paths), 1000):
+            batch = cloud_paths[index:index + 1000]
+            try:
+                response = self._client.delete_objects(Bucket=self._bucket, Delete={
+                    'Object': [{'Key': cloud_path} for cloud_path in batch],
+                    'Quiet': 'true'
+                })
+                failed += [error['Key'] for error in response.get('Error', [])]
+            except qcloud_cos.cos_exception.CosException:
+                failed += batch
+        return failed
+
+    def abort_multipart_upload(self, cloud_path, upload_id):
+        """
+        取消分片上传，删除已上传的分片
+        :param cloud_path: 云端文件路径
+        :param upload_id: 分片上传 ID
+        :return: None
+        """
+        self._client.abort_multipart_upload(Bucket=self._bucket, Key=cloud_path, UploadId=upload_id)
+
+    def update(self, cloud_path, local_path, stat=None, file_hash=None):
         """
         使用本地文件的内容更新云端文件的内容
         要求附加自定义属性修改时间 mtime 、摘要 hash 和 文件ID
         - 修改时间 mtime 使用当前的时间
-        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得
+        - 摘要 hash 使用选定算法对新本地文件内容计算散列值而得，由 _put_file 在上传的同时计算
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端文件路径
         :param local_path: 本地文件路径
-        :return: None
+        :param stat: 被更新的云端文件当前的元信息，为 None 时通过 stat_file 获取
+        :param file_hash: 已知的本地文件摘要，为 None 时在上传的同时计算
+        :return: 写入的文件元信息，云端文件不存在时返回 None
         """
-        if cloud_path.endswith('/') or not self._client.object_exists(Bucket=self._bucket, Key=cloud_path):
-            return
+        if cloud_path.endswith('/'):
+            return None
+        if stat is None:
+            stat = self.stat_file(cloud_path)
+            if stat is None:
+                return None
 
-        # get file metadata
-        file_hash = ''
-        try:
-            file_hash = utils.get_local_file_hash(local_path)
-        except Exception as e:
-            print(e)
-        file_mtime = str(int(time.time()))
-        file_id = self.stat_file(cloud_path)['uuid']
+        return self._put_file(cloud_path, local_path, {
+            'hash': file_hash or '',
+            'mtime': str(int(time.time())),
+            'uuid': stat['uuid']
+        })
 
-        # upload file
-        with open(local_path, 'rb') as f:
-            self._client.put_object(Bucket=self._bucket,
-                                    Key=cloud_path,
-                                    Body=f,
-                                    Metadata={
-                                        'x-cos-meta-hash': file_hash,
-                                        'x-cos-meta-mtime': file_mtime,
-                                        'x-cos-meta-uuid': file_id
-                                    })
+    def _put_file(self, cloud_path, local_path, stat):
+        """
+        上传本地文件的内容，并写入元信息
+        - 文件大小小于 transfer.multipart_threshold 时，上传的同时计算摘要，文件只读取一次；
+          实际摘要与 stat 中给出的摘要不一致（未给出或文件在上传前发生了变化）时，上传完成后再修改一次元信息
+        - 否则使用可断点续传的分片并行上传，元信息在初始化时写入，未给出摘要时先计算摘要
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param stat: 要写入的元信息（包括 hash、mtime、uuid），hash 可以为空
+        :return: 实际写入的文件元信息
+        """
+        if os.path.getsize(local_path) < transfer.multipart_threshold:
+            with open(local_path, 'rb') as f:
+                reader = utils.HashingReader(f)
+                self._client.put_object(Bucket=self._bucket, Key=cloud_path, Body=reader,
+                                        Metadata=self._make_metadata(stat))
+            file_hash = reader.hexdigest() or utils.get_local_file_hash(local_path)
+            if file_hash != stat['hash']:
+                stat = dict(stat, hash=file_hash)
+                self.set_stat(cloud_path, stat)
+            return stat
 
-    def rename(self, old_cloud_path, new_cloud_path):
+        if not stat['hash']:
+            stat = dict(stat, hash=utils.get_local_file_hash(local_path))
+        metadata = transfer.multipart_upload(
+            cloud_path, local_path, self._make_metadata(stat),
+            init_upload=lambda metadata_: self._client.create_multipart_upload(
+                Bucket=self._bucket, Key=cloud_path, Metadata=metadata_)['UploadId'],
+            upload_part=lambda upload_id, part_number, data: self._client.upload_part(
+                Bucket=self._bucket, Key=cloud_path, Body=data, PartNumber=part_number, UploadId=upload_id)['ETag'],
+            complete_upload=lambda upload_id, parts: self._client.complete_multipart_upload(
+                Bucket=self._bucket, Key=cloud_path, UploadId=upload_id,
+                MultipartUpload={'Part': [{'PartNumber': part_number, 'ETag': etag} for part_number, etag in parts]}),
+            abort_upload=lambda upload_id: self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=cloud_path, UploadId=upload_id)
+        )
+        # 从断点处继续上传时，对象使用的是断点记录中的元信息
+        return {
+            'hash': metadata['x-cos-meta-hash'],
+            'mtime': metadata['x-cos-meta-mtime'],
+            'uuid': metadata['x-cos-meta-uuid']
+        }
+
+    @staticmethod
+    def _make_metadata(stat):
+        """
+        :param stat: 文件元信息（包括 hash、mtime、uuid，分块存储的清单对象另有 chunked）
+        :return: 对象的自定义元信息
+        """
+        metadata = {
+            'x-cos-meta-hash': stat['hash'],
+            'x-cos-meta-mtime': stat['mtime'],
+            'x-cos-meta-uuid': stat['uuid']
+        }
+        if stat.get('chunked'):
+            metadata['x-cos-meta-chunked'] = stat['chunked']
+        return metadata
+
+    def rename(self, old_cloud_path, new_cloud_path, stat_of=None):
         """
         重命名文件或目录
         如果是目录，需要对目录下的所有子文件都重命名
         要求重命名完成后，设置最新的修改时间 mtime
         :param old_cloud_path: 重命名前的云端文件路径
         :param new_cloud_path: 重命名后的云端文件路径
-        :return: None
+        :param stat_of: 获取对象元信息的函数，未提供或返回 None 时通过 stat_file 获取
+        :return: 重命名文件时返回新文件的元信息，重命名目录时返回 None
         """
-        if old_cloud_path.endswith('/'):
-            for filename in self.list_files(old_cloud_path):
-                self.rename(old_cloud_path + filename, new_cloud_path + filename)
+        def get_stat(cloud_path):
+            stat = stat_of(cloud_path) if stat_of is not None else None
+            return stat if stat is not None else self.stat_file(cloud_path)
 
-        self._client.copy_object(Bucket=self._bucket,
-                                 Key=new_cloud_path,
-                                 CopySource={
-                                     'Appid': self._app_id,
-                                     'Bucket': self._bucket_name,
-                                     'Key': old_cloud_path,
-                                     'Region': self._region
-                                 },
-                                 CopyStatus='Copy')
+        if old_cloud_path.endswith('/'):
+            # 并行复制目录下的所有对象，复制的同时设置新的修改时间，再批量删除旧对象
+            cloud_paths = [entry['key'] for entry in self.iter_all_files(old_cloud_path)]
+            transfer.rename_folder(old_cloud_path, new_cloud_path, cloud_paths,
+                                   get_stat, self._copy_object, self.delete_many)
+            return None
+        stat = dict(get_stat(old_cloud_path))
+        stat['mtime'] = str(int(time.time()))
+        self._copy_object(old_cloud_path, new_cloud_path, stat)
         self.delete(old_cloud_path)
-        self.set_mtime(cloud_path=new_cloud_path, mtime=str(int(time.time())))
+        return stat
 
-    def copy(self, src_path: str, dist_path: str):
+    def copy(self, src_path: str, dist_path: str, stat=None, file_uuid=None):
         """
         复制文件
+        通过一次服务端复制写入目标文件，同时写入源文件的摘要、当前时间作为修改时间 mtime，以及目标文件的文件ID
         :param src_path: 复制的源文件
         :param dist_path: 复制的目标文件
-        :return: None
+        :param stat: 源文件的元信息，为 None 时通过 stat_file 获取
+        :param file_uuid: 目标文件的文件ID，为 None 时使用 uuid.uuid1() 生成新的文件ID
+        :return: 目标文件的元信息（包括 hash、mtime、uuid，源文件是清单对象时另有 chunked）
         """
-        pass
+        if stat is None:
+            stat = self.stat_file(src_path)
+        dist_stat = {
+            'hash': stat['hash'],
+            'mtime': str(int(time.time())),
+            'uuid': file_uuid if file_uuid is not None else str(uuid())
+        }
+        if stat.get('chunked'):
+            # 复制清单对象即复制整个文件，块对象由两个清单共享
+            dist_stat['chunked'] = stat['chunked']
+        self._copy_object(src_path, dist_path, dist_stat)
+        return dist_stat
 
     def create_folder(self, cloud_path: str):
         """
@@ -166,7 +284,7 @@ class CloudFileSystem:
         - 摘要 hash 使用选定算法对空字符串计算散列值而得
         - 文件ID 使用被更新的云端文件的文件ID
         :param cloud_path: 云端目录路径
-        :return: None
+        :return: 写入的目录元信息（包括 hash、mtime、uuid）
         """
         # cloud_path 结尾若不是 / , 上传之后不会表现为文件夹
         if not cloud_path.endswith('/'):
@@ -186,6 +304,7 @@ class CloudFileSystem:
                                     'x-cos-meta-mtime': file_mtime,
                                     'x-cos-meta-uuid': file_id
                                 })
+        return {'hash': file_hash, 'mtime': file_mtime, 'uuid': file_id}
 
     def list_files(self, cloud_path):
         """
@@ -194,22 +313,83 @@ class CloudFileSystem:
         :param cloud_path: 云端目录路径
         :return: 由子目录名和子文件名组成的数组
         """
-        files = []
-        items = self._client.list_objects(Bucket=self._bucket, Prefix=cloud_path, Delimiter='/')
-        # 添加目录名
-        if 'CommonPrefixes' in items.keys():
-            dirs = [item['Prefix'] for item in items['CommonPrefixes']]
-            files += [filename.split('/')[-2] + '/' for filename in dirs if filename.endswith('/')]
-        # 添加文件名
-        items = [item['Key'] for item in items['Contents']]
-        files += [filename.split('/')[-1] for filename in items if not filename.endswith('/')]
-        return files
+        return list(self.iter_files(cloud_path))
+
+    def iter_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        分页迭代子目录和文件，逐页产出子目录名（以 / 结尾）和子文件名
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出子目录名和子文件名的生成器
+        """
+        for items in self._iter_pages(cloud_path, '/', page_size, prefetch):
+            # 产出目录名
+            for item in items.get('CommonPrefixes', []):
+                if item['Prefix'].endswith('/'):
+                    yield item['Prefix'].split('/')[-2] + '/'
+            # 产出文件名
+            for item in items.get('Contents', []):
+                if not item['Key'].endswith('/'):
+                    yield item['Key'].split('/')[-1]
+
+    def list_all_files(self, cloud_path):
+        """
+        不使用分隔符，分页列出 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        要求返回值为对象信息字典所组成的数组，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :return: 由对象信息字典组成的数组
+        """
+        return list(self.iter_all_files(cloud_path))
+
+    def iter_all_files(self, cloud_path, page_size=None, prefetch=None):
+        """
+        不使用分隔符，分页迭代 cloud_path 前缀下的所有对象（包括各级子目录中的对象）
+        逐页产出对象信息字典，字典包括 key、etag、size、last_modified
+        :param cloud_path: 云端目录路径
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出对象信息字典的生成器
+        """
+        for items in self._iter_pages(cloud_path, '', page_size, prefetch):
+            for item in items.get('Contents', []):
+                yield {
+                    'key': item['Key'],
+                    'etag': item['ETag'],
+                    'size': int(item['Size']),
+                    'last_modified': item['LastModified']
+                }
+
+    def _iter_pages(self, cloud_path, delimiter, page_size, prefetch):
+        """
+        分页列举 cloud_path 前缀下的对象，逐页产出 list_objects 的响应，并跟随 NextMarker 获取后续页
+        :param cloud_path: 云端目录路径
+        :param delimiter: 分隔符，为空字符串时列出所有层级的对象
+        :param page_size: 每页的对象数量，为 None 时使用 utils.list_page_size
+        :param prefetch: 是否预取下一页，为 None 时使用 utils.list_prefetch
+        :return: 产出 list_objects 响应字典的生成器
+        """
+        page_size = utils.list_page_size if page_size is None else page_size
+
+        def fetch_page(marker):
+            items = self._client.list_objects(Bucket=self._bucket, Prefix=cloud_path, Delimiter=delimiter,
+                                              Marker=marker, MaxKeys=page_size)
+            if items.get('IsTruncated') != 'true':
+                return items, None
+            # 未返回 NextMarker 时，以本页最后一个对象名或公共前缀作为下一页的起点
+            keys = [item['Key'] for item in items.get('Contents', [])]
+            keys += [item['Prefix'] for item in items.get('CommonPrefixes', [])]
+            next_marker = items.get('NextMarker') or (max(keys) if keys else None)
+            return items, next_marker
+
+        return utils.iterate_pages(fetch_page, prefetch)
 
     def stat_file(self, cloud_path):
         """
         查询并返回文件元信息
         若文件不存在，则返回 None
         若文件元信息存在空值，则设置该文件的此项的元信息
+        分块存储的清单对象另有 chunked 标记，其 hash 是整个文件的摘要
         :param cloud_path: 云端文件路径
         :return: None 或 含有文件元信息（包括 hash、mtime、uuid）的字典
         """
@@ -219,20 +399,23 @@ class CloudFileSystem:
         except qcloud_cos.cos_exception.CosServiceError:
             return None
 
-        # get hash
-        if 'x-cos-meta-hash' in metadata.keys():
+        # get hash，空值视为缺失
+        if metadata.get('x-cos-meta-hash'):
             hash_value = metadata['x-cos-meta-hash']
+        elif utils.cloud_hash_mode == 'crc64' and metadata.get('x-cos-hash-crc64ecma'):
+            # 使用云端计算的 CRC64 作为指纹，不写回元信息
+            hash_value = utils.crc64_prefix + metadata['x-cos-hash-crc64ecma']
         else:
             hash_value = utils.get_cloud_file_hash(cloud_path, self)
             set_stat_flag = True
         # get mtime
-        if 'x-cos-meta-mtime' in metadata.keys():
+        if metadata.get('x-cos-meta-mtime'):
             mtime = metadata['x-cos-meta-mtime']
         else:
             mtime = str(int(time.time()))
             set_stat_flag = True
         # get uuid
-        if 'x-cos-meta-uuid' in metadata.keys():
+        if metadata.get('x-cos-meta-uuid'):
             file_id = metadata['x-cos-meta-uuid']
         else:
             file_id = str(uuid())
@@ -244,8 +427,10 @@ class CloudFileSystem:
             'mtime': mtime,
             'uuid': file_id
         }
+        if metadata.get('x-cos-meta-chunked'):
+            stat['chunked'] = metadata['x-cos-meta-chunked']
         if set_stat_flag:
-            self.set_stat(cloud_path, stat)
+            self.set_stat(cloud_path, dict(stat, hash='') if utils.is_crc64_fingerprint(hash_value) else stat)
         return stat
 
     def set_stat(self, cloud_path, stat):
@@ -255,21 +440,26 @@ class CloudFileSystem:
         :param stat: 文件元信息
         :return: None
         """
-        metadata = {
-            'x-cos-meta-hash': stat['hash'],
-            'x-cos-meta-mtime': stat['mtime'],
-            'x-cos-meta-uuid': stat['uuid'],
-        }
+        self._copy_object(cloud_path, cloud_path, stat)
+
+    def _copy_object(self, src_path, dist_path, stat):
+        """
+        复制对象，并在同一个请求中将目标对象的元信息替换为 stat
+        :param src_path: 复制的源文件
+        :param dist_path: 复制的目标文件
+        :param stat: 目标对象的元信息
+        :return: None
+        """
         self._client.copy_object(Bucket=self._bucket,
-                                 Key=cloud_path,
+                                 Key=dist_path,
                                  CopySource={
                                      'Appid': self._app_id,
                                      'Bucket': self._bucket_name,
-                                     'Key': cloud_path,
+                                     'Key': src_path,
                                      'Region': self._region
                                  },
                                  CopyStatus='Replaced',
-                                 Metadata=metadata)
+                                 Metadata=self._make_metadata(stat))
 
     def set_hash(self, cloud_path, hash_value):
         """
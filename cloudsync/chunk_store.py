@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import hashlib
+import calendar
+import logging
+import inspect
+from uuid import uuid1 as uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import transfer
+
+# 是否启用分块存储，启用后不小于 chunked_threshold 的文件按内容分块上传，云端只保存块对象和清单对象
+# 下载清单对象不受此开关影响
+chunked_enabled = False
+# 文件大小不小于此值时使用分块存储，单位为字节
+chunked_threshold = 256 * 1024 * 1024
+# 块的最小、平均、最大大小，单位为字节
+chunk_min_size = 1024 * 1024
+chunk_avg_size = 2 * 1024 * 1024
+chunk_max_size = 8 * 1024 * 1024
+# 块对象的保存位置，位于同步目录之下，元信息树不包含此目录
+chunk_prefix = '.cloudsync_chunks/'
+# 并行上传、下载块对象的数量
+chunk_workers = 4
+# 用于在参考清单中定位块起点的前缀长度，单位为字节
+chunk_probe_size = 64
+# 垃圾回收的最长间隔，单位为秒；本程序覆盖或删除了清单对象时，在下一次云端扫描之后立即回收
+chunk_gc_interval = 24 * 3600
+# 最后修改时间距今不足此值的块对象不会被回收，避免删除正在上传、尚未写入清单的块，单位为秒
+chunk_gc_grace = 24 * 3600
+
+
+def _class_table():
+    """
+    将 256 个字节值按固定种子的摘要排序后轮流分为 4 类，保证不同机器、不同版本的分块结果一致
+    :return: 供 bytes.translate 使用的映射表
+    """
+    order = sorted(range(256), key=lambda value: hashlib.sha256(b'cloudsync-class' + bytes([value])).digest())
+    table = bytearray(256)
+    for rank, value in enumerate(order):
+        table[value] = rank % 4
+    return bytes(table)
+
+
+# 切分条件：字节映射为类别之后，类别序列中出现 _ANCHOR 时在其末尾切分
+# 每个字节提供 2 位，_ANCHOR 在随机数据中出现的概率约为 1 / (chunk_avg_size - chunk_min_size)
+_CLASS_TABLE = _class_table()
+_ANCHOR_LENGTH = max(1, ((chunk_avg_size - chunk_min_size).bit_length() - 1) // 2)
+_ANCHOR = bytes(byte % 4 for byte in hashlib.sha256(b'cloudsync-anchor').digest()[:_ANCHOR_LENGTH])
+
+
+def _find_cut(data, length):
+    """
+    在 data[:length] 中寻找块的切分点
+    切分点只由其前 _ANCHOR_LENGTH 个字节的内容决定，插入、删除内容之后切分点随内容移动。
+    映射和查找都由 bytes.translate、bytes.find 完成，不逐字节执行 Python 代码；
+    每次只映射约 chunk_avg_size - chunk_min_size 个字节，找到切分点即停止
+    :param data: 字节数组
+    :param length: 可用的长度，不超过 chunk_max_size
+    :return: 切分点，即块的长度
+    """
+    if length <= chunk_min_size:
+        return length
+    start = max(0, chunk_min_size - _ANCHOR_LENGTH)
+    step = chunk_avg_size - chunk_min_size
+    with memoryview(data) as view:
+        while start + _ANCHOR_LENGTH <= length:
+            # 相邻的两段重叠 _ANCHOR_LENGTH - 1 个字节，跨越两段的切分条件不会被遗漏
+            end = min(length, start + step + _ANCHOR_LENGTH)
+            index = view[start:end].tobytes().translate(_CLASS_TABLE).find(_ANCHOR)
+            if index >= 0:
+                return start + index + _ANCHOR_LENGTH
+            start = end - _ANCHOR_LENGTH + 1
+    return length
+
+
+def _timestamp(last_modified):
+    """
+    :param last_modified: 列举结果中的最后修改时间，为时间戳或 ISO 8601 格式的 UTC 时间字符串
+    :return: 时间戳，无法解析时为 None
+    """
+    if isinstance(last_modified, (int, float)):
+        return last_modified
+    try:
+        return calendar.timegm(time.strptime(str(last_modified)[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def _probe(data):
+    """
+    :param data: 块开头的 chunk_probe_size 个字节
+    :return: 用于定位块起点的短指纹
+    """
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def _chunk_digest(data):
+    """
+    :param data: 块的内容
+    :return: 块的摘要
+    """
+    return getattr(hashlib, utils.hash_type)(data).hexdigest()
+
+
+def chunk_key(cloud_root, digest):
+    """
+    :param cloud_root: 同步目录，以 / 结尾，同步目录为存储桶根目录时为空字符串
+    :param digest: 块的摘要
+    :return: 块对象在云端的路径
+    """
+    return '{root}{prefix}{fanout}/{digest}'.format(root=cloud_root, prefix=chunk_prefix, fanout=digest[:2],
+                                                    digest=digest)
+
+
+def chunk_file(local_path, reference=None):
+    """
+    对本地文件进行基于内容的分块，同时计算整个文件的摘要
+    给出参考清单（通常是同一文件的另一个版本）时，每个块的起点先尝试与参考清单中的块对齐：
+    按偏移量或块开头的短指纹找到候选块，整块摘要一致即直接采用，只有与参考版本不同的区域才需要寻找切分点。
+    由于切分点由内容决定，修改之后的第一个切分点通常就与参考版本重新对齐
+    :param local_path: 本地文件路径
+    :param reference: 参考清单中的块列表，元素为 [摘要, 大小, 短指纹]
+    :return: (文件摘要, 块列表)，块列表的元素为 (偏移量, 大小, 摘要, 短指纹)
+    """
+    by_offset = dict()
+    by_probe = dict()
+    offset = 0
+    for digest, size, probe in reference or ():
+        by_offset.setdefault(offset, (digest, size))
+        by_probe.setdefault(probe, []).append((digest, size))
+        offset += size
+
+    hash_obj = getattr(hashlib, utils.hash_type)()
+    chunks = []
+    buffer = bytearray()
+    position = 0
+    with open(local_path, 'rb') as f:
+        def fill(size):
+            while len(buffer) < size:
+                data = f.read(max(size - len(buffer), utils.hash_chunk_size))
+                if not data:
+                    break
+                buffer.extend(data)
+
+        while True:
+            fill(chunk_probe_size)
+            if len(buffer) == 0:
+                break
+            probe = _probe(bytes(buffer[:chunk_probe_size]))
+            length = digest = None
+            candidates = [by_offset[position]] if position in by_offset else []
+            candidates += by_probe.get(probe, [])
+            for candidate_digest, candidate_size in candidates:
+                fill(candidate_size)
+                if len(buffer) >= candidate_size:
+                    with memoryview(buffer) as view:
+                        matched = _chunk_digest(view[:candidate_size]) == candidate_digest
+                    if matched:
+                        length, digest = candidate_size, candidate_digest
+                        break
+            if length is None:
+                fill(chunk_max_size)
+                length = _find_cut(buffer, min(len(buffer), chunk_max_size))
+                with memoryview(buffer) as view:
+                    digest = _chunk_digest(view[:length])
+
+            with memoryview(buffer) as view:
+                hash_obj.update(view[:length])
+            chunks.append((position, length, digest, probe))
+            del buffer[:length]
+            position += length
+    return hash_obj.hexdigest(), chunks
+
+
+class ChunkStore:
+    """
+    分块存储
+    文件被切分为基于内容的块，每个块以其摘要为名保存为一个对象，文件本身保存为记录块列表的清单对象，
+    清单对象的元信息中 hash 仍然是整个文件的摘要，另有 chunked 标记，因此元信息树和历史记录仍然跟踪逻辑上的文件。
+    更新文件时只需上传、下载两个版本之间不同的块。
+    块对象被多个清单共享（例如复制得到的文件），因此不在覆盖、删除清单时直接删除，
+    而是由 collect_garbage 以一次完整扫描得到的所有清单为根进行标记-清除
+    """
+
+    def __init__(self, cfs, cloud_root=''):
+        """
+        :param cfs: 云文件系统，需要提供 open_object、put_object、iter_all_files、delete_many 函数
+        :param cloud_root: 同步目录，块对象保存在其下的 chunk_prefix 中
+        """
+        self._cfs = cfs
+        self._root = cloud_root if cloud_root == '' or cloud_root.endswith('/') else cloud_root + '/'
+        # 本程序覆盖或删除过清单对象，有待回收的块对象
+        self.garbage_pending = False
+        # 上次垃圾回收的时间，为 None 时尚未回收过
+        self._last_collected = None
+
+    @staticmethod
+    def should_chunk(local_path):
+        """
+        :param local_path: 本地文件路径
+        :return: 是否应以分块存储的方式上传该文件
+        """
+        return chunked_enabled and os.path.getsize(local_path) >= chunked_threshold
+
+    def load_manifest(self, cloud_path):
+        """
+        读取清单对象
+        :param cloud_path: 云端文件路径
+        :return: 清单字典
+        """
+        stream = self._cfs.open_object(cloud_path)[0]
+        try:
+            return json.loads(stream.read().decode('utf-8'))
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+
+    def upload(self, cloud_path, local_path, file_uuid=None, reference=None):
+        """
+        分块上传文件，只上传参考清单中没有的块，最后写入清单对象
+        参考清单之外的块即使已存在于云端也重新写入，刷新其最后修改时间，使其不会被同时进行的垃圾回收删除
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param file_uuid: 文件ID，为 None 时使用 uuid.uuid1() 生成
+        :param reference: 云端当前版本的清单，为 None 时没有参考版本
+        :return: 写入的文件元信息（包括 hash、mtime、uuid、chunked）
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        start_time = time.time()
+        file_hash, chunks = chunk_file(local_path, reference['chunks'] if reference is not None else None)
+        stored = {digest for digest, _, _ in reference['chunks']} if reference is not None else set()
+        pending = dict()
+        for offset, size, digest, _ in chunks:
+            if digest not in stored:
+                pending.setdefault(digest, (offset, size))
+
+        def put_chunk(digest):
+            offset, size = pending[digest]
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+            if _chunk_digest(data) != digest:
+                raise IOError('本地文件 {local_path} 在上传过程中发生了变化'.format(local_path=local_path))
+            self._cfs.put_object(chunk_key(self._root, digest), data)
+            return size
+
+        with ThreadPoolExecutor(max_workers=max(1, chunk_workers)) as executor:
+            uploaded = sum(executor.map(put_chunk, list(pending)))
+
+        manifest = {
+            'version': 1,
+            'hash': file_hash,
+            'size': sum(size for _, size, _, _ in chunks),
+            'chunks': [[digest, size, probe] for _, size, digest, probe in chunks]
+        }
+        stat = {
+            'hash': file_hash,
+            'mtime': str(int(time.time())),
+            'uuid': file_uuid if file_uuid is not None else str(uuid()),
+            'chunked': '1'
+        }
+        self._cfs.put_object(cloud_path, json.dumps(manifest).encode('utf-8'), stat)
+        logger.info('分块上传 {local_path} 到 {cloud_path} 完成，耗时 {seconds:.2f} 秒，共 {count} 个块，'
+                    '上传 {uploaded} 字节，复用 {reused} 个块'
+                    .format(local_path=local_path, cloud_path=cloud_path, seconds=time.time() - start_time,
+                            count=len(chunks), uploaded=uploaded, reused=len(chunks) - len(pending)))
+        return stat
+
+    def download(self, cloud_path, local_path, stat):
+        """
+        下载清单对象表示的文件，本地已有的同名文件中与清单相同的块直接从本地复制，只下载其余的块
+        先写入临时文件，校验整个文件的摘要之后再替换目标文件
+        :param cloud_path: 云端文件路径
+        :param local_path: 本地文件路径
+        :param stat: 清单对象的元信息
+        :return: (文件摘要, 下载完成后本地文件的 stat 信息)
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        start_time = time.time()
+        manifest = self.load_manifest(cloud_path)
+        local_chunks = dict()
+        if os.path.isfile(local_path):
+            for offset, size, digest, _ in chunk_file(local_path, manifest['chunks'])[1]:
+                local_chunks.setdefault(digest, (offset, size))
+
+        temp_path = transfer.get_temp_path(local_path)
+        with open(temp_path, 'wb') as f:
+            f.truncate(manifest['size'])
+        targets = []
+        offset = 0
+        for digest, size, _ in manifest['chunks']:
+            targets.append((offset, size, digest))
+            offset += size
+
+        def write_chunk(target):
+            target_offset, size, digest = target
+            if digest in local_chunks:
+                with open(local_path, 'rb') as f:
+                    f.seek(local_chunks[digest][0])
+                    data = f.read(size)
+                downloaded = 0
+            else:
+                stream = self._cfs.open_object(chunk_key(self._root, digest))[0]
+                try:
+                    data = stream.read()
+                finally:
+                    close = getattr(stream, 'close', None)
+                    if close is not None:
+                        close()
+                downloaded = len(data)
+            if len(data) != size or _chunk_digest(data) != digest:
+                raise IOError('块 {digest} 的内容与清单不一致'.format(digest=digest))
+            with open(temp_path, 'r+b') as f:
+                f.seek(target_offset)
+                f.write(data)
+            return downloaded
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, chunk_workers)) as executor:
+                downloaded = sum(executor.map(write_chunk, targets))
+            file_hash = utils.get_local_file_hash(temp_path)
+            transfer.verify_download(cloud_path, temp_path, stat['hash'], file_hash)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        os.replace(temp_path, local_path)
+        logger.info('分块下载 {cloud_path} 到 {local_path} 完成，耗时 {seconds:.2f} 秒，共 {count} 个块，'
+                    '下载 {downloaded} 字节，复用本地 {reused} 个块'
+                    .format(cloud_path=cloud_path, local_path=local_path, seconds=time.time() - start_time,
+                            count=len(targets), downloaded=downloaded,
+                            reused=sum(1 for _, _, digest in targets if digest in local_chunks)))
+        return file_hash, os.stat(local_path)
+
+    def collect_garbage(self, manifests, force=False):
+        """
+        回收不被任何清单引用的块对象
+        只在本程序覆盖或删除过清单对象、或距上次回收超过 chunk_gc_interval 时执行。
+        最后修改时间距今不足 chunk_gc_grace 的块对象不会被回收，其他客户端正在上传的块因此得以保留；
+        列举和删除之间仍有短暂的窗口，其间被其他客户端重新写入的块可能被删除
+        :param manifests: 同步目录下所有清单对象的路径，必须来自一次完整的扫描
+        :param force: 是否忽略执行条件，立即回收
+        :return: 删除的块对象数量
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if not force and not self.garbage_pending and self._last_collected is not None \
+                and time.monotonic() - self._last_collected < chunk_gc_interval:
+            return 0
+        start_time = time.time()
+        # 标记：任一清单读取失败时放弃本次回收，以免删除其引用的块
+        referenced = set()
+        for cloud_path in manifests:
+            referenced.update(digest for digest, _, _ in self.load_manifest(cloud_path)['chunks'])
+        # 清除
+        garbage = []
+        chunk_count = 0
+        for entry in self._cfs.iter_all_files(self._root + chunk_prefix):
+            chunk_count += 1
+            if entry['key'].rsplit('/', 1)[-1] in referenced:
+                continue
+            modified = _timestamp(entry['last_modified'])
+            if modified is None or start_time - modified < chunk_gc_grace:
+                continue
+            garbage.append(entry['key'])
+        failed = self._cfs.delete_many(garbage) if garbage else []
+        if failed:
+            logger.warning('{count} 个块对象删除失败，下次回收时重试'.format(count=len(failed)))
+        else:
+            self.garbage_pending = False
+        self._last_collected = time.monotonic()
+        logger.info('块对象垃圾回收完成，耗时 {seconds:.2f} 秒，{manifests} 个清单引用 {referenced} 个块，'
+                    '云端共 {count} 个块对象，删除 {deleted} 个'
+                    .format(seconds=time.time() - start_time, manifests=len(manifests), referenced=len(referenced),
+                            count=chunk_count, deleted=len(garbage) - len(failed)))
+        return len(garbage) - len(failed)
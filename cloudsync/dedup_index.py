@@ -0,0 +1,117 @@
+import threading
+
+
+class DedupIndex:
+    """
+    内容寻址的去重索引
+    同时维护 摘要 -> 路径集合 和 路径 -> 摘要 两个方向的映射，
+    路径的内容变化或路径被删除时，旧摘要下的记录随之移除，不会积累过期路径。
+    索引不写入磁盘：它完全由元信息树推导而来，每次全量扫描（云端的每次扫描，本地的首次扫描及没有监听器时的每次扫描）
+    都以扫描结果重建，两次全量扫描之间由同步任务和本地增量扫描逐项维护
+    """
+
+    def __init__(self):
+        self._paths_by_hash = dict()
+        self._hash_by_path = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hash_by_path)
+
+    def rebuild(self, entries):
+        """
+        用一次完整扫描的结果替换整个索引
+        :param entries: (路径, 摘要) 的可迭代对象
+        :return: None
+        """
+        paths_by_hash = dict()
+        hash_by_path = dict()
+        for path, file_hash in entries:
+            if not file_hash:
+                continue
+            hash_by_path[path] = file_hash
+            paths_by_hash.setdefault(file_hash, set()).add(path)
+        with self._lock:
+            self._paths_by_hash = paths_by_hash
+            self._hash_by_path = hash_by_path
+
+    def add(self, path, file_hash):
+        """
+        记录路径的内容摘要，路径原有的记录被替换
+        :param path: 文件路径
+        :param file_hash: 文件摘要
+        :return: None
+        """
+        with self._lock:
+            self._discard(path)
+            if not file_hash:
+                return
+            self._hash_by_path[path] = file_hash
+            self._paths_by_hash.setdefault(file_hash, set()).add(path)
+
+    def remove(self, path):
+        """
+        移除路径的记录
+        :param path: 文件路径
+        :return: None
+        """
+        with self._lock:
+            self._discard(path)
+
+    def remove_tree(self, dirname, recursive=True):
+        """
+        移除目录下的文件记录
+        :param dirname: 以 / 结尾的目录路径
+        :param recursive: 是否包括子目录中的文件，为 False 时只移除直接位于该目录中的文件
+        :return: None
+        """
+        with self._lock:
+            paths = [path for path in self._hash_by_path if path.startswith(dirname)
+                     and (recursive or '/' not in path[len(dirname):])]
+            for path in paths:
+                self._discard(path)
+
+    def rename(self, old_path, new_path):
+        """
+        将文件或目录下的记录移动到新路径
+        :param old_path: 原路径，目录以 / 结尾
+        :param new_path: 新路径，目录以 / 结尾
+        :return: None
+        """
+        with self._lock:
+            if old_path.endswith('/'):
+                moved = [(path, new_path + path[len(old_path):]) for path in self._hash_by_path
+                         if path.startswith(old_path)]
+            else:
+                moved = [(old_path, new_path)] if old_path in self._hash_by_path else []
+            for path, renamed in moved:
+                file_hash = self._hash_by_path[path]
+                self._discard(path)
+                self._discard(renamed)
+                self._hash_by_path[renamed] = file_hash
+                self._paths_by_hash.setdefault(file_hash, set()).add(renamed)
+
+    def lookup(self, file_hash, exclude=None):
+        """
+        查询具有指定摘要的文件路径
+        :param file_hash: 文件摘要
+        :param exclude: 需要排除的路径
+        :return: 路径列表
+        """
+        with self._lock:
+            return [path for path in self._paths_by_hash.get(file_hash, ()) if path != exclude]
+
+    def _discard(self, path):
+        """
+        移除路径的记录，调用方需持有锁
+        :param path: 文件路径
+        :return: None
+        """
+        file_hash = self._hash_by_path.pop(path, None)
+        if file_hash is None:
+            return
+        paths = self._paths_by_hash.get(file_hash)
+        if paths is not None:
+            paths.discard(path)
+            if len(paths) == 0:
+                del self._paths_by_hash[file_hash]
@@ -1,8 +1,14 @@
 # 文件操作都对应常量标志
 from enum import unique, Enum
 
-hash_table_local = dict()
-hash_table_cloud = dict()
+from stat_cache import StatCache
+from dedup_index import DedupIndex
+
+# 本地、云端的去重索引（摘要 -> 路径），由全量扫描重建，不写入磁盘
+dedup_local = DedupIndex()
+dedup_cloud = DedupIndex()
+# 本地文件摘要缓存，在 Synchronize.initialize 中从磁盘加载
+stat_cache = StatCache()
 
 
 @unique
@@ -0,0 +1,307 @@
+import os
+import sys
+import time
+import errno
+import ctypes
+import select
+import struct
+import logging
+import inspect
+import ctypes.util
+
+import transfer
+
+# 是否启用本地目录实时监听，仅在 Linux 下可用，不可用时退回到定时全量扫描
+watch_enabled = True
+# 最后一个文件事件之后等待的时间，期间没有新事件才触发同步，单位为秒
+watch_debounce = 2.0
+# 一次从 inotify 文件描述符读取的最大字节数
+watch_read_size = 64 * 1024
+
+# inotify 事件掩码，取值见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+             | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class LocalWatcher:
+    """
+    基于 inotify 的本地目录监听器
+    监听 local_path 下的所有目录，把发生变化的目录记录为脏目录，同步时只需重新扫描脏目录：
+    - 目录内的文件发生变化时，只重新扫描该目录本身
+    - 新建或移入的目录、无法添加监听的目录（超出 max_user_watches）需要重新扫描整个子树
+    - 事件队列溢出时无法得知丢失了哪些事件，需要重新扫描整个 local_path
+    """
+
+    def __init__(self, local_path, debounce=None):
+        """
+        :param local_path: 要监听的本地根目录，以 / 结尾
+        :param debounce: 去抖时间，为 None 时使用 watch_debounce
+        """
+        self.local_path = local_path
+        self.debounce = watch_debounce if debounce is None else debounce
+        self._libc = None
+        self._fd = -1
+        # 监听描述符与目录路径的双向映射
+        self._paths = dict()
+        self._descriptors = dict()
+        # 因达到监听数量上限而无法监听的目录，每次同步都要重新扫描其子树
+        self._unwatched = set()
+        # 脏目录，值为是否需要递归扫描
+        self._dirty = dict()
+        self._last_event = 0.0
+        self.overflows = 0
+        # 用于唤醒 wait 的管道，与 inotify 文件描述符一起等待
+        self._wake_fds = None
+        self._woken = False
+
+    @staticmethod
+    def available():
+        """
+        :return: 当前平台是否支持 inotify
+        """
+        return watch_enabled and sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def start(self):
+        """
+        初始化 inotify 并监听 local_path 下的所有目录
+        :return: 是否启动成功
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            self._fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        except (OSError, AttributeError) as err:
+            logger.warning('无法加载 inotify，错误信息为 {err}'.format(err=err))
+            return False
+        if self._fd < 0:
+            logger.warning('初始化 inotify 失败，错误信息为 {err}'.format(err=os.strerror(ctypes.get_errno())))
+            return False
+        self._wake_fds = os.pipe()
+        os.set_blocking(self._wake_fds[0], False)
+        os.set_blocking(self._wake_fds[1], False)
+        self._watch_tree(self.local_path)
+        logger.info('开始监听本地目录 {local_path}，共 {count} 个目录'
+                    .format(local_path=self.local_path, count=len(self._descriptors)))
+        return True
+
+    def stop(self):
+        """
+        关闭 inotify 文件描述符
+        :return: None
+        """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        if self._wake_fds is not None:
+            for fd in self._wake_fds:
+                os.close(fd)
+            self._wake_fds = None
+        self._paths.clear()
+        self._descriptors.clear()
+
+    def wake(self):
+        """
+        唤醒正在进行的 wait，使其立即返回，可在信号处理函数或其他线程中调用
+        :return: None
+        """
+        if self._wake_fds is None:
+            return
+        try:
+            os.write(self._wake_fds[1], b'\0')
+        except BlockingIOError:
+            # 管道已满，说明已经有未处理的唤醒
+            pass
+
+    def wait(self, timeout):
+        """
+        等待本地文件变化
+        有脏目录且距离最后一个事件超过去抖时间时立即返回，否则最多等待 timeout 秒；被 wake 唤醒时也立即返回
+        :param timeout: 最长等待时间，单位为秒
+        :return: 是否有待处理的本地变化
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._woken:
+                self._woken = False
+                return bool(self._dirty)
+            now = time.monotonic()
+            if self._dirty and now - self._last_event >= self.debounce:
+                return True
+            if now >= deadline:
+                return bool(self._dirty)
+            if self._dirty:
+                remaining = min(deadline, self._last_event + self.debounce) - now
+            else:
+                remaining = deadline - now
+            self.read_events(max(0.0, remaining))
+
+    def read_events(self, timeout=0.0):
+        """
+        读取并处理 inotify 事件，最多等待 timeout 秒
+        :param timeout: 最长等待时间，单位为秒
+        :return: None
+        """
+        if self._fd < 0:
+            return
+        fds = [self._fd] if self._wake_fds is None else [self._fd, self._wake_fds[0]]
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if self._wake_fds is not None and self._wake_fds[0] in readable:
+            self._drain_wake()
+            readable = [fd for fd in readable if fd == self._fd]
+        while readable:
+            try:
+                buffer = os.read(self._fd, watch_read_size)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'surrogateescape')
+                offset += length
+                self._handle_event(wd, mask, name)
+            readable, _, _ = select.select([self._fd], [], [], 0)
+
+    def _drain_wake(self):
+        """
+        清空唤醒管道，并记录 wait 应当返回
+        :return: None
+        """
+        try:
+            while os.read(self._wake_fds[0], 64):
+                pass
+        except BlockingIOError:
+            pass
+        self._woken = True
+
+    def take_dirty(self):
+        """
+        取出需要重新扫描的目录，无法监听的目录总是包含在内
+        :return: 字典，键为以 / 结尾的目录路径，值为是否需要递归扫描
+        """
+        dirty = self._dirty
+        self._dirty = dict()
+        for path in self._unwatched:
+            dirty[path] = True
+        return dirty
+
+    def _handle_event(self, wd, mask, name):
+        """
+        根据单个 inotify 事件更新脏目录和监听列表
+        :param wd: 监听描述符
+        :param mask: 事件掩码
+        :param name: 发生变化的文件名，目录自身的事件为空
+        :return: None
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        self._last_event = time.monotonic()
+        if mask & IN_Q_OVERFLOW:
+            self.overflows += 1
+            logger.warning('inotify 事件队列溢出，将重新扫描整个本地目录 {local_path}'.format(local_path=self.local_path))
+            self._mark_dirty(self.local_path, True)
+            return
+        path = self._paths.get(wd)
+        if path is None:
+            return
+        if mask & IN_IGNORED:
+            self._forget(wd)
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # 目录自身被删除或移走，由父目录的事件负责更新
+            return
+        if transfer.is_temp_name(name):
+            return
+        logger.debug('本地目录 {path} 中的 {name} 发生变化，事件掩码为 {mask:#x}'.format(path=path, name=name, mask=mask))
+        self._mark_dirty(path, False)
+        if mask & IN_ISDIR:
+            subdir = path + name + '/'
+            if mask & IN_MOVED_FROM:
+                self._unwatch_tree(subdir)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(subdir)
+                self._mark_dirty(subdir, True)
+
+    def _mark_dirty(self, path, recursive):
+        """
+        :param path: 以 / 结尾的目录路径
+        :param recursive: 是否需要递归扫描
+        :return: None
+        """
+        self._dirty[path] = self._dirty.get(path, False) or recursive
+
+    def _watch_tree(self, root):
+        """
+        为目录子树中的所有目录添加监听，达到监听数量上限时，将无法监听的目录记为需要递归扫描
+        :param root: 以 / 结尾的目录路径
+        :return: None
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    logger.warning('inotify 监听数量达到上限 (fs.inotify.max_user_watches)，'
+                                   '目录 {path} 将在每次同步时重新扫描'.format(path=path))
+                    self._unwatched.add(path)
+                elif err not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning('监听本地目录 {path} 失败，错误信息为 {err}'.format(path=path, err=os.strerror(err)))
+                    self._unwatched.add(path)
+                continue
+            self._unwatched.discard(path)
+            self._paths[wd] = path
+            self._descriptors[path] = wd
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(path + entry.name + '/')
+            except OSError as err:
+                logger.warning('遍历本地目录 {path} 失败，错误信息为 {err}'.format(path=path, err=err))
+
+    def _unwatch_tree(self, root):
+        """
+        移除目录子树中所有目录的监听
+        :param root: 以 / 结尾的目录路径
+        :return: None
+        """
+        for path in [path for path in self._descriptors if path.startswith(root)]:
+            wd = self._descriptors.pop(path)
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._unwatched = {path for path in self._unwatched if not path.startswith(root)}
+
+    def _forget(self, wd):
+        """
+        内核已移除监听描述符（目录被删除），清理映射
+        :param wd: 监听描述符
+        :return: None
+        """
+        path = self._paths.pop(wd, None)
+        if path is not None and self._descriptors.get(path) == wd:
+            del self._descriptors[path]
@@ -0,0 +1,93 @@
+import time
+import threading
+from collections import OrderedDict
+
+# 云端元信息缓存的最大条目数，超出时淘汰最久未使用的条目
+metadata_cache_size = 200000
+# 云端元信息缓存条目的有效期，单位为秒
+metadata_cache_ttl = 600
+
+
+class MetadataCache:
+    """
+    云端对象元信息缓存
+    以对象路径为键，保存 stat_file 的结果（对象不存在时为 None），条目超过有效期后视为未命中，
+    条目数超过上限时按 LRU 淘汰
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        """
+        :param max_size: 最大条目数，为 None 时使用 metadata_cache_size
+        :param ttl: 条目有效期，为 None 时使用 metadata_cache_ttl
+        """
+        self.max_size = metadata_cache_size if max_size is None else max_size
+        self.ttl = metadata_cache_ttl if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        # 键为对象路径，值为 (写入时间, 元信息)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cloud_path):
+        """
+        查询对象元信息
+        :param cloud_path: 云端文件路径
+        :return: (是否命中, 元信息)，命中且对象不存在时元信息为 None
+        """
+        with self._lock:
+            entry = self._entries.get(cloud_path)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[cloud_path]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(cloud_path)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, cloud_path, stat):
+        """
+        写入对象元信息
+        :param cloud_path: 云端文件路径
+        :param stat: 元信息字典，对象不存在时为 None
+        :return: None
+        """
+        with self._lock:
+            self._entries[cloud_path] = (time.monotonic(), dict(stat) if stat is not None else None)
+            self._entries.move_to_end(cloud_path)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, cloud_path):
+        """
+        删除对象的缓存条目
+        :param cloud_path: 云端文件路径
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(cloud_path, None)
+
+    def invalidate_prefix(self, prefix):
+        """
+        删除以 prefix 开头的所有缓存条目，用于目录级别的操作
+        :param prefix: 路径前缀
+        :return: None
+        """
+        with self._lock:
+            for cloud_path in [cloud_path for cloud_path in self._entries if cloud_path.startswith(prefix)]:
+                del self._entries[cloud_path]
+
+    def begin_cycle(self):
+        """
+        开始新一轮同步，重置命中计数
+        :return: None
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: 命中数、未命中数和当前条目数
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
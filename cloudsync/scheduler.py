@@ -0,0 +1,91 @@
+import time
+import random
+import logging
+import inspect
+
+# 云端扫描（PULL）的最小、最大间隔，单位为秒
+cloud_min_interval = 10.0
+cloud_max_interval = 300.0
+# 本地扫描（PUSH）的最小、最大间隔，单位为秒；监听本地目录时，本地变化会立即触发推送，这里只是兜底
+local_min_interval = 5.0
+local_max_interval = 300.0
+# 间隔的随机抖动比例，避免多个客户端同时请求云端
+interval_jitter = 0.1
+# 没有变化时间隔的增长倍数
+idle_backoff = 2.0
+# 下次间隔不小于本次耗时的倍数，避免耗时很长的周期之后立即开始下一个周期
+duration_factor = 1.0
+
+
+class SyncScheduler:
+    """
+    自适应同步调度器
+    分别为云端和本地维护扫描间隔：
+    - 上一周期有变化时，按变化数量缩短间隔，变化越多间隔越短
+    - 上一周期没有变化时，按 idle_backoff 倍数退避
+    - 间隔不小于上一周期耗时的 duration_factor 倍，并限制在最小、最大间隔之间
+    """
+
+    CLOUD = 'cloud'
+    LOCAL = 'local'
+
+    def __init__(self):
+        self._limits = {
+            SyncScheduler.CLOUD: (cloud_min_interval, cloud_max_interval),
+            SyncScheduler.LOCAL: (local_min_interval, local_max_interval)
+        }
+        self._intervals = {side: limits[0] for side, limits in self._limits.items()}
+        # 每一侧下次扫描的时间，启动时立即扫描
+        now = time.monotonic()
+        self._next_due = {side: now for side in self._limits}
+
+    def due(self, side):
+        """
+        :param side: SyncScheduler.CLOUD 或 SyncScheduler.LOCAL
+        :return: 这一侧是否到了扫描的时间
+        """
+        return time.monotonic() >= self._next_due[side]
+
+    def trigger(self, side):
+        """
+        要求立即扫描某一侧，例如监听到本地变化时
+        :param side: SyncScheduler.CLOUD 或 SyncScheduler.LOCAL
+        :return: None
+        """
+        self._next_due[side] = min(self._next_due[side], time.monotonic())
+
+    def next_delay(self):
+        """
+        :return: 距离下一次扫描（任意一侧）的秒数
+        """
+        return max(0.0, min(self._next_due.values()) - time.monotonic())
+
+    def record(self, side, changes, duration):
+        """
+        记录某一侧本周期的结果，并决定下次扫描的时间
+        :param side: SyncScheduler.CLOUD 或 SyncScheduler.LOCAL
+        :param changes: 本周期提交的同步任务数量
+        :param duration: 本周期耗时，单位为秒
+        :return: 下次扫描的间隔，单位为秒
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        min_interval, max_interval = self._limits[side]
+        previous = self._intervals[side]
+        if changes > 0:
+            interval = previous / (1 + changes)
+            reason = '有 {changes} 项变化，缩短间隔'.format(changes=changes)
+        else:
+            interval = previous * idle_backoff
+            reason = '没有变化，退避'
+        if interval < duration * duration_factor:
+            interval = duration * duration_factor
+            reason += '，本周期耗时 {duration:.2f} 秒，间隔不小于耗时'.format(duration=duration)
+        interval = min(max_interval, max(min_interval, interval))
+        self._intervals[side] = interval
+
+        delay = interval * (1 + random.uniform(-interval_jitter, interval_jitter))
+        self._next_due[side] = time.monotonic() + delay
+        logger.info('{side} 下次扫描在 {delay:.2f} 秒后（间隔 {previous:.2f} -> {interval:.2f} 秒，{reason}）'
+                    .format(side=side, delay=delay, previous=previous, interval=interval, reason=reason))
+        return delay
@@ -0,0 +1,155 @@
+import os
+import pickle
+import logging
+import inspect
+import threading
+
+
+class StatCache:
+    """
+    本地文件摘要缓存
+    以 (device, inode, size, mtime_ns) 作为键保存文件摘要，
+    文件的 stat 信息未发生变化时直接复用上一次计算的摘要，避免每个周期重复读取整个文件
+    每个缓存项同时记录文件路径：同一路径出现新的键时旧缓存项随即淘汰，保存时还可以按当前存在的路径淘汰已删除的文件
+    """
+
+    def __init__(self, cache_path=''):
+        """
+        :param cache_path: 缓存文件在磁盘中的路径
+        """
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        # 上一次保存的缓存项，键为缓存键，值为 (文件路径, 文件摘要)
+        self._entries = dict()
+        # 本轮扫描中被访问或新增的缓存项，保存时只写入这部分，从而淘汰已经不存在的文件
+        self._fresh = dict()
+        # 文件路径 -> 该路径当前的缓存键
+        self._key_by_path = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(stat_result: os.stat_result):
+        """
+        根据 os.stat 的结果生成缓存键
+        :param stat_result: os.stat / DirEntry.stat 的返回值
+        :return: (device, inode, size, mtime_ns)
+        """
+        return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+    def load(self):
+        """
+        从磁盘加载缓存，缓存文件不存在或损坏时从空缓存开始
+        :return: None
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if not os.path.exists(self.cache_path) or os.path.getsize(self.cache_path) == 0:
+            logger.info('未在磁盘找到本地摘要缓存 {cache_path}，将从空缓存开始'.format(cache_path=self.cache_path))
+            return
+        try:
+            with open(self.cache_path, 'rb') as f:
+                entries = pickle.load(f)
+            # 旧格式的缓存项没有路径，首次全量扫描时补上
+            self._entries = {key: value if isinstance(value, tuple) else (None, value)
+                             for key, value in entries.items()}
+            self._key_by_path = {path: key for key, (path, _) in self._entries.items() if path is not None}
+            logger.info('成功加载本地摘要缓存，共 {count} 项'.format(count=len(self._entries)))
+        except Exception as err:
+            self._entries = dict()
+            logger.exception('读取本地摘要缓存出现错误，错误信息为 {err}'.format(err=err))
+
+    def save(self, prune=True, live_paths=None):
+        """
+        将本轮扫描中用到的缓存项写入磁盘
+        :param prune: 是否淘汰本轮未用到的缓存项，只扫描了部分目录时（如监听模式下的增量扫描）应为 False
+        :param live_paths: 当前存在的文件路径集合，提供时淘汰路径不在其中的缓存项，
+                           用于增量扫描时淘汰已删除或已移走的文件
+        :return: None
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        with self._lock:
+            if prune and self._fresh:
+                self._entries = self._fresh
+            else:
+                self._entries.update(self._fresh)
+            self._fresh = dict()
+            if live_paths is not None:
+                self._entries = {key: entry for key, entry in self._entries.items() if entry[0] in live_paths}
+            self._key_by_path = {path: key for key, (path, _) in self._entries.items() if path is not None}
+            entries = dict(self._entries)
+        try:
+            with open(self.cache_path, 'wb') as f:
+                pickle.dump(entries, f)
+            logger.info('本地摘要缓存写入成功，共 {count} 项'.format(count=len(entries)))
+        except Exception as err:
+            logger.exception('本地摘要缓存写入失败，错误信息为 {err}'.format(err=err))
+
+    def begin_scan(self):
+        """
+        开始新一轮扫描，重置命中计数
+        :return: None
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def lookup(self, stat_result: os.stat_result, path=None):
+        """
+        查询文件摘要
+        :param stat_result: 文件的 stat 信息
+        :param path: 文件路径，为 None 时沿用缓存项中记录的路径
+        :return: 命中时返回文件摘要，否则返回 None
+        """
+        key = self.make_key(stat_result)
+        with self._lock:
+            entry = self._fresh.get(key)
+            if entry is None:
+                entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            path = path if path is not None else entry[0]
+            self._bind(key, path)
+            self._fresh[key] = (path, entry[1])
+            return entry[1]
+
+    def update(self, stat_result: os.stat_result, file_hash: str, path=None):
+        """
+        记录文件摘要
+        :param stat_result: 计算摘要时文件的 stat 信息
+        :param file_hash: 文件摘要
+        :param path: 文件路径
+        :return: None
+        """
+        if not file_hash:
+            return
+        key = self.make_key(stat_result)
+        with self._lock:
+            self._bind(key, path)
+            self._fresh[key] = (path, file_hash)
+
+    def _bind(self, key, path):
+        """
+        将路径指向新的缓存键，并淘汰该路径原有的缓存项（文件内容已变化），调用方需持有锁
+        :param key: 缓存键
+        :param path: 文件路径，为 None 时不做任何操作
+        :return: None
+        """
+        if path is None:
+            return
+        old_key = self._key_by_path.get(path)
+        if old_key is not None and old_key != key:
+            for entries in (self._entries, self._fresh):
+                entry = entries.get(old_key)
+                if entry is not None and entry[0] == path:
+                    del entries[old_key]
+        self._key_by_path[path] = key
+
+    def stats(self):
+        """
+        :return: 本轮扫描的命中数和未命中数
+        """
+        return {'hits': self.hits, 'misses': self.misses}
@@ -3,13 +3,19 @@ import pickle
 import signal
 import logging
 import inspect
+import functools
+import threading
 import time
 
-from global_value import OP, hash_table_local, hash_table_cloud
-from catalog import Catalog, DirectoryStatus, initialize_metatree_cloud, initialize_metatree_local
+import transfer
+from global_value import OP, dedup_local, dedup_cloud, stat_cache
+from catalog import Catalog, DirectoryStatus, initialize_metatree_cloud, initialize_metatree_local, diff_directory, \
+    refresh_metatree_local, find_catalog, rebase_catalog, replace_catalog, iter_files, get_directory_fingerprint
 from cfs import CloudFileSystem
 from synchronize_event_emitter import SynchronizeEventEmitter
 from synchronize_event_handler import SynchronizeEventHandler
+from local_watcher import LocalWatcher
+from scheduler import SyncScheduler
 
 
 class Synchronize:
@@ -30,6 +36,18 @@ class Synchronize:
         self.metatree_local = None
         self.metatree_local_history = None
         self.close = True
+        # 关闭时被设置，用于立即结束周期之间的等待
+        self._stop_event = threading.Event()
+        # 本地目录监听器，可用时本地只重新扫描发生变化的目录
+        self.watcher = LocalWatcher(os.path.join(self.local_path, '')) if LocalWatcher.available() else None
+        # 最近一次本地扫描是否为全量扫描
+        self.local_scan_full = True
+        # 下一次本地扫描是否必须为全量扫描，例如增量扫描失败之后
+        self.local_rescan_all = False
+        # 本阶段提交的任务及其执行成功后对另一侧造成的影响，元素为 (同步任务, [(目标路径, 源元信息或 None), ...])
+        self._effects = []
+        # 本阶段提交的目录重命名任务，及其无法执行时改为提交的新建、删除任务，元素为 (同步任务, [提交任务的函数, ...])
+        self._rename_fallbacks = []
 
         self.tasks.register(SynchronizeEventHandler(self.cfs))
         # 将工作目录切换成 local_path
@@ -49,10 +67,25 @@ class Synchronize:
         logger.info('云同步系统启动')
         print('输入 Ctrl + C ，即可离开同步系统')
         self.close = False
+        self._stop_event.clear()
         self.initialize()
+        scheduler = SyncScheduler()
         while not self.close:
-            self.synchronize()
-            time.sleep(29)
+            pull = scheduler.due(SyncScheduler.CLOUD)
+            push = scheduler.due(SyncScheduler.LOCAL)
+            for side, (changes, duration) in self.synchronize(pull=pull, push=push).items():
+                scheduler.record(side, changes, duration)
+            # 退避后的间隔可能长达数分钟，等待必须能被关闭操作立即打断
+            if self.close:
+                break
+            if self.watcher is None:
+                self._stop_event.wait(scheduler.next_delay())
+            elif self.watcher.wait(scheduler.next_delay()) and not self.close:
+                # 本地发生变化时，在去抖时间后立即推送，不必等到下一次本地扫描
+                logger.info('监听到本地变化，开始推送')
+                scheduler.trigger(SyncScheduler.LOCAL)
+        if self.watcher is not None:
+            self.watcher.stop()
         print('同步关闭')
         logger.info('云同步系统关闭')
 
@@ -60,6 +93,9 @@ class Synchronize:
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
         self.close = True
+        self._stop_event.set()
+        if self.watcher is not None:
+            self.watcher.wake()
         logger.debug('云同步系统关闭标志设置为 True')
 
     def initialize(self):
@@ -71,13 +107,20 @@ class Synchronize:
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
         logger.info('开始初始化云同步系统')
+        # 加载本地文件摘要缓存
+        stat_cache.cache_path = self.history_path + '.stat'
+        stat_cache.load()
+        # 清理中断后遗留的断点记录，本地目录中遗留的临时文件在扫描时清理
+        transfer.sweep_checkpoints(self.cfs.abort_multipart_upload)
+        # 先开始监听，再扫描本地目录，避免遗漏扫描期间发生的变化
+        if self.watcher is not None and not self.watcher.start():
+            logger.warning('本地目录监听启动失败，将使用定时全量扫描')
+            self.watcher = None
         # 获取最新树结构
         logger.info('获取最新的云端元信息树')
-        self.metatree_cloud = initialize_metatree_cloud(self.cloud_path, self.cfs, hash_table_cloud)
+        self.metatree_cloud = initialize_metatree_cloud(self.cloud_path, self.cfs, dedup_cloud)
         logger.debug('云端元信息树的值为 {metatree_cloud}'.format(metatree_cloud=self.metatree_cloud))
-        logger.info('获取最新的本地元信息树')
-        self.metatree_local = initialize_metatree_local(self.local_path, hash_table_local)
-        logger.debug('本地元信息树的值为 {metatree_local}'.format(metatree_local=self.metatree_local))
+        self.metatree_local = self.scan_local()
         # 获取云端历史树结构
         cloud_history_path = self.history_path + '.cloud'
         if not os.path.exists(cloud_history_path):
@@ -116,44 +159,266 @@ class Synchronize:
             logger.info('根据本地路径 {local_path} 创建本地历史元信息树'.format(local_path=self.local_path))
         logger.info('云同步系统初始化完成')
 
-    def synchronize(self):
+    def synchronize(self, pull=True, push=True):
         """
         同步本地和云端指定的目录 包括算法 AlgorithmPULL | AlgorithmPUSH
-        :return: None
+        :param pull: 是否扫描云端并运行 PULL 算法
+        :param push: 是否扫描本地并运行 PUSH 算法
+        :return: 字典，键为运行过的一侧 (SyncScheduler.CLOUD | SyncScheduler.LOCAL)，值为 (提交的任务数量, 耗时秒数)
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        result = dict()
+        self.cfs.metadata_cache.begin_cycle()
+        self.cfs.head_skips = 0
 
-        # Build Cloud Current Tree
-        logger.info('获取最新的云端元信息树')
-        self.metatree_cloud = initialize_metatree_cloud(self.cloud_path, self.cfs, hash_table_cloud)
-        logger.debug('云端元信息树的值为 {metatree_cloud}'.format(metatree_cloud=self.metatree_cloud))
-        # Run PULL Algorithm
-        logger.info('开始运行 PULL 算法')
-        self.algorithm_pull(self.metatree_cloud, self.metatree_cloud_history,
-                            self.cloud_path, self.local_path)
-        logger.info('PULL 算法运行结束')
+        if pull:
+            start_time, submitted = time.monotonic(), self.tasks.submitted
+            # Build Cloud Current Tree
+            logger.info('获取最新的云端元信息树')
+            try:
+                metatree_cloud = initialize_metatree_cloud(self.cloud_path, self.cfs, dedup_cloud,
+                                                           self.metatree_cloud_history)
+            except Exception as err:
+                # 不完整的元信息树会让 PULL 把缺少的对象当作云端已删除
+                logger.exception('获取云端元信息树失败，跳过本周期的 PULL，错误信息为 {err}'.format(err=err))
+                result[SyncScheduler.CLOUD] = (0, time.monotonic() - start_time)
+                pull = False
 
-        # Build Local Current Tree
-        logger.info('获取最新的本地元信息树')
-        self.metatree_local = initialize_metatree_local(self.local_path, hash_table_local)
-        logger.debug('本地元信息树的值为 {metatree_local}'.format(metatree_local=self.metatree_local))
-        # Run PUSH Algorithm
-        logger.info('开始运行 PUSH 算法')
-        self.algorithm_push(self.metatree_local, self.metatree_local_history,
-                            self.cloud_path, self.local_path)
-        logger.info('PUSH 算法运行结束')
+        if pull:
+            self.metatree_cloud = metatree_cloud
+            logger.debug('云端元信息树的值为 {metatree_cloud}'.format(metatree_cloud=self.metatree_cloud))
+            # 刚完成的扫描包含了所有清单对象，此时回收不再被引用的块对象
+            try:
+                self.cfs.collect_chunk_garbage()
+            except Exception as err:
+                logger.exception('块对象垃圾回收失败，错误信息为 {err}'.format(err=err))
+            # Run PULL Algorithm
+            logger.info('开始运行 PULL 算法')
+            self.algorithm_pull(self.metatree_cloud, self.metatree_cloud_history,
+                                self.cloud_path, self.local_path)
+            pull_failed = self.tasks.drain()
+            pull_failed += self.retry_renames()
+            logger.info('PULL 算法运行结束')
+            result[SyncScheduler.CLOUD] = (self.tasks.submitted - submitted, time.monotonic() - start_time)
+            # PULL 对本地所做的修改写入本地历史，PUSH 不会再把它们当作本地变化
+            pulled_effects, pull_failed_targets = self.take_effects(pull_failed)
+            self.metatree_local_history = self.apply_effects(self.metatree_local_history, pulled_effects)
+
+        if push:
+            start_time, submitted = time.monotonic(), self.tasks.submitted
+            # Build Local Current Tree
+            try:
+                metatree_local = self.scan_local()
+            except Exception as err:
+                # 不完整的元信息树会让 PUSH 把缺少的文件当作本地已删除，进而删除云端文件
+                logger.exception('获取本地元信息树失败，跳过本周期的 PUSH，错误信息为 {err}'.format(err=err))
+                result[SyncScheduler.LOCAL] = (0, time.monotonic() - start_time)
+                # 监听器记录的脏目录已被取出，下一次改为全量扫描
+                self.local_rescan_all = True
+                push = False
+
+        if push:
+            self.metatree_local = metatree_local
+            if pull and len(pulled_effects) > 0:
+                logger.info('PULL 产生的 {echoes} 项本地变化被识别为本程序自身的修改，PUSH 将跳过它们'
+                            .format(echoes=self.count_echoes(self.metatree_local, pulled_effects)))
+            # Run PUSH Algorithm
+            logger.info('开始运行 PUSH 算法')
+            self.algorithm_push(self.metatree_local, self.metatree_local_history,
+                                self.cloud_path, self.local_path)
+            push_failed = self.tasks.drain()
+            push_failed += self.retry_renames()
+            logger.info('PUSH 算法运行结束')
+            result[SyncScheduler.LOCAL] = (self.tasks.submitted - submitted, time.monotonic() - start_time)
 
         # Update and Save History Tree
-        self.metatree_cloud_history = self.metatree_cloud
-        logger.info('将云端元信息树赋值给云端历史元信息树')
-        self.metatree_local_history = self.metatree_local
-        logger.info('将本地元信息树赋值给本地历史元信息树')
-        self.save_history()
+        if pull:
+            # 执行失败的任务所对应的云端路径保留原来的历史记录，下一次 PULL 会再次发现这些变化并重试
+            self.metatree_cloud_history = self.restore_history(
+                self.metatree_cloud, self.metatree_cloud_history,
+                [self.cloud_path + target[len(self.local_path):] for target in pull_failed_targets])
+            logger.info('将云端元信息树赋值给云端历史元信息树')
+        if push:
+            # PUSH 对云端所做的修改写入云端历史，下一次 PULL 不会再把它们当作云端变化
+            pushed_effects, push_failed_targets = self.take_effects(push_failed)
+            self.metatree_cloud_history = self.apply_effects(self.metatree_cloud_history, pushed_effects)
+            if len(pushed_effects) > 0:
+                logger.info('PUSH 产生的 {count} 项云端变化已写入云端历史，下一次 PULL 将跳过它们'
+                            .format(count=len(pushed_effects)))
+            self.metatree_local_history = self.restore_history(
+                self.metatree_local, self.metatree_local_history,
+                [self.local_path + target[len(self.cloud_path):] for target in push_failed_targets])
+            logger.info('将本地元信息树赋值给本地历史元信息树')
+            # 增量扫描只访问了发生变化的目录，按当前本地元信息树中的文件淘汰已删除、已移走的文件的缓存项
+            stat_cache.save(prune=self.local_scan_full,
+                            live_paths=None if self.local_scan_full
+                            else {filename for filename, _ in iter_files(self.metatree_local, recursive=True)})
+        if result:
+            self.save_history()
+        logger.info('云端元信息缓存命中 {hits} 次，未命中 {misses} 次，当前共 {size} 项'
+                    .format(**self.cfs.metadata_cache.stats()))
+        logger.info('云端对象键过滤器省去 HEAD 请求 {skips} 次'.format(skips=self.cfs.head_skips))
+        return result
+
+    def emit(self, effects, task_index, *args, **kwargs):
+        """
+        提交同步任务，并记录任务执行成功后另一侧应有的状态
+        :param effects: 任务执行成功后另一侧的变化，元素为 (目标路径, 源元信息)，源元信息为 None 表示目标被删除
+        :param task_index: 任务序号
+        :param args: 任务参数
+        :param kwargs: 额外参数
+        :return: 同步任务
+        """
+        task = self.tasks.set_data(task_index, *args, **kwargs)
+        self._effects.append((task, effects))
+        return task
+
+    def retry_renames(self):
+        """
+        被观察者中止的目录重命名（例如源目录在云端已不存在）改为新建目标目录、删除原目录，
+        否则新的历史记录会把重命名当作已经完成，两侧从此不再一致
+        :return: 改为提交的任务中执行失败（抛出异常）的任务列表
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        fallbacks, self._rename_fallbacks = self._rename_fallbacks, []
+        aborted = [(task, emits) for task, emits in fallbacks if not task.applied and task.error is None]
+        if len(aborted) == 0:
+            return []
+        for task, emits in aborted:
+            logger.warning('{task} 未能执行，改为新建目标目录并删除原目录'.format(task=task))
+            for emit in emits:
+                emit()
+        return self.tasks.drain()
+
+    def take_effects(self, failed):
+        """
+        取出本阶段提交的任务的影响
+        :param failed: drain 返回的执行失败（抛出异常）的任务
+        :return: (已成功执行的任务的影响 [(目标路径, 源元信息或 None), ...], 执行失败的任务的目标路径列表)
+                 被观察者中止（未抛出异常但也未执行）的任务不计入其中任何一项
+        """
+        failed = set(failed)
+        applied = [effect for task, task_effects in self._effects if task.applied for effect in task_effects]
+        failed_targets = [filename for task, task_effects in self._effects if task in failed
+                          for filename, _ in task_effects]
+        self._effects = []
+        return applied, failed_targets
+
+    def restore_history(self, current, history, filenames):
+        """
+        用当前元信息树作为新的历史元信息树，但指定路径保留原历史元信息树中的记录（不存在时删除），
+        使执行失败的任务对应的变化在下一个周期被再次发现
+        :param current: 当前元信息树
+        :param history: 原历史元信息树
+        :param filenames: 需要保留原记录的路径
+        :return: 新的历史元信息树
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if history is None or len(filenames) == 0:
+            return current
+        for filename in filenames:
+            catalog = find_catalog(history, filename)
+            current = replace_catalog(current, filename,
+                                      rebase_catalog(catalog, filename) if catalog is not None else None)
+        logger.info('{count} 项执行失败的变化保留原历史记录，下一个周期重试'.format(count=len(filenames)))
+        return current
+
+    def apply_effects(self, history, effects):
+        """
+        将本程序自身造成的变化写入历史元信息树，只复制受影响路径上的目录，不需要网络请求
+        :param history: 历史元信息树
+        :param effects: [(目标路径, 源元信息或 None), ...]
+        :return: 更新后的历史元信息树
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if history is None or len(effects) == 0:
+            return history
+        for filename, catalog in effects:
+            history = replace_catalog(history, filename,
+                                      rebase_catalog(catalog, filename) if catalog is not None else None)
+        logger.info('将 {count} 项本程序自身造成的变化写入历史元信息树 {filename}'
+                    .format(count=len(effects), filename=history.filename))
+        return history
+
+    @staticmethod
+    def count_echoes(current, effects):
+        """
+        统计本程序自身造成、在当前元信息树中仍保持原样的变化，即被识别为回声而跳过的变化
+        :param current: 当前元信息树
+        :param effects: [(目标路径, 源元信息或 None), ...]
+        :return: 回声数量
+        """
+        echoes = 0
+        for filename, catalog in effects:
+            found = find_catalog(current, filename)
+            if (catalog is None and found is None) or \
+                    (catalog is not None and found is not None and catalog.file_id == found.file_id):
+                echoes += 1
+        return echoes
+
+    def scan_local(self):
+        """
+        扫描本地目录，构建本地元信息树，并统计摘要缓存的命中情况
+        有目录遍历失败时抛出异常
+        :return: 本地元信息树
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        logger.info('获取最新的本地元信息树')
+        stat_cache.begin_scan()
+        if self.watcher is not None and self.metatree_local is not None and not self.local_rescan_all:
+            metatree_local = self.rescan_local(self.metatree_local)
+            self.local_scan_full = False
+        else:
+            metatree_local = initialize_metatree_local(self.local_path, dedup_local, stat_cache)
+            self.local_scan_full = True
+            self.local_rescan_all = False
+        logger.debug('本地元信息树的值为 {metatree_local}'.format(metatree_local=metatree_local))
+        logger.info('本地摘要缓存命中 {hits} 次，未命中 {misses} 次'.format(**stat_cache.stats()))
+        return metatree_local
+
+    def rescan_local(self, metatree_local):
+        """
+        只重新扫描监听器记录的脏目录，得到新的本地元信息树
+        脏目录不在树中时（例如其父目录的事件尚未处理），改为扫描其最近的父目录
+        :param metatree_local: 上一次的本地元信息树，保持不变
+        :return: 更新后的本地元信息树
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        self.watcher.read_events()
+        dirty = self.watcher.take_dirty()
+        logger.info('本地共有 {count} 个目录发生变化'.format(count=len(dirty)))
+        rescanned = []
+        for dirname in sorted(dirty, key=len):
+            recursive = dirty[dirname]
+            if any(dirname.startswith(subtree) for subtree in rescanned):
+                continue
+            while True:
+                try:
+                    refreshed = refresh_metatree_local(metatree_local, dirname, dedup_local, stat_cache, recursive)
+                except FileNotFoundError as err:
+                    # 目录已被删除，由其父目录的事件负责更新；其他错误（如没有权限）向上抛出，放弃本次扫描
+                    logger.info('重新扫描本地目录 {dirname} 失败，错误信息为 {err}'.format(dirname=dirname, err=err))
+                    break
+                if refreshed is not None:
+                    metatree_local = refreshed
+                    break
+                if len(dirname) <= len(metatree_local.filename):
+                    break
+                dirname = dirname[:dirname.rstrip('/').rfind('/') + 1]
+                recursive = False
+            if recursive:
+                rescanned.append(dirname)
+        return metatree_local
 
     def save_history(self):
         """
-        将云端历史树以及本地历史树保存到磁盘中
+        将云端历史树、本地历史树保存到磁盘中
         :return: None
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
@@ -179,6 +444,9 @@ class Synchronize:
         找出不一致的项，识别不一致的原因，并将任务提交给任务管理对象进行处理，任务包括：
         创建云端目录, 删除本地目录
         上传文件, 更新云端文件, 删除本地文件
+        Merkle 指纹与历史记录相同的目录子树被整体跳过
+        新增项和删除项按内容配对（文件按摘要，目录按 Merkle 指纹），配对成功的识别为重命名，任务包括：
+        重命名云端文件, 重命名云端目录
         :param local: 本地元信息树
         :param local_history: 本地历史元信息树
         :param cloud_path: 云路径
@@ -187,58 +455,121 @@ class Synchronize:
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
-        # 新增、修改部分
-        logger.info('遍历本地当前元信息树的每一项，判断是否需要进行同步操作')
-        for catalog_local in local.children:
-            filename = catalog_local.filename
-            next_local_path = local_path + filename[len(local_path):]
-            next_cloud_path = cloud_path + filename[len(local_path):]
-            next_local_history = local_history.find_catalog(next_local_path) if local_history is not None else None
-            logger.info('当前项 catalog_local 为 {}'.format(catalog_local))
-            logger.debug('对应本地文件路径 next_local_path 为 {}'.format(next_local_path))
-            logger.debug('对应云端文件路径 next_cloud_path 为 {}'.format(next_cloud_path))
-            logger.debug('在本地历史树搜索的结果 next_local_history 为 {}'.format(next_local_history))
+        added = []
+        removed = []
+        self._algorithm_push(local, local_history, cloud_path, local_path, added, removed)
+
+        renamed, added, removed = self.pair_renames(added, removed, lambda catalog: catalog.file_id)
+        for catalog_local, (_, next_local_path, next_cloud_path), old_item in renamed:
+            old_cloud_path = old_item[2]
+            logger.info('本地 {next_local_path} 由重命名得到，重命名云端的 {old_cloud_path}'
+                        .format(next_local_path=next_local_path, old_cloud_path=old_cloud_path))
             if catalog_local.file_type == Catalog.IS_FOLDER:
-                logger.debug('当前项为目录')
-                # 如果历史树中存在，则直接递归进去目录处理
-                if next_local_history is not None:
-                    self.algorithm_push(catalog_local, next_local_history,
-                                        next_cloud_path, next_local_path)
-                # 在本地历史中利用文件名和文件ID都找不到记录，上传此云目录
-                if next_local_history is None:
-                    self.tasks.set_data(OP.CREATE_CLOUD_FOLDER,
-                                        next_local_path, next_cloud_path)
-            elif catalog_local.file_type == Catalog.IS_FILE:
-                logger.debug('当前项为文件')
-                # 在历史记录，名字和摘要都不存在，上传新文件
-                if next_local_history is None:
-                    self.tasks.set_data(OP.UPLOAD_FILE,
-                                        next_local_path, next_cloud_path, file_id=catalog_local.file_id)
-                # 历史记录中存在此文件名，此历史文件与本地文件摘要值不相同，且本地最新，则更新云端文件
-                if next_local_history is not None \
-                        and int(next_local_history.mtime) < int(catalog_local.mtime) \
-                        and next_local_history.file_id != catalog_local.file_id:
-                    self.tasks.set_data(OP.UPDATE_CLOUD_FILE,
-                                        next_local_path, next_cloud_path, file_id=catalog_local.file_id)
-            logger.info('当前项 {filename} 处理完毕'.format(filename=filename))
-        # 删除部分
-        if local_history is None:
+                task = self.emit([(old_cloud_path, None), (next_cloud_path, catalog_local)],
+                                 OP.RENAME_CLOUD_FOLDER, old_cloud_path, next_cloud_path)
+                self._rename_fallbacks.append((task, [
+                    functools.partial(self.emit_push_added, catalog_local, next_local_path, next_cloud_path),
+                    functools.partial(self.emit_push_removed, *old_item)
+                ]))
+            else:
+                self.emit([(old_cloud_path, None), (next_cloud_path, catalog_local)],
+                          OP.RENAME_CLOUD_FILE, old_cloud_path, next_cloud_path)
+        for catalog_local, next_local_path, next_cloud_path in added:
+            self.emit_push_added(catalog_local, next_local_path, next_cloud_path)
+        for next_local_history, next_local_path, next_cloud_path in removed:
+            self.emit_push_removed(next_local_history, next_local_path, next_cloud_path)
+
+    @staticmethod
+    def empty_folder(catalog):
+        """
+        复制目录状态但不含孩子，作为创建目录任务的影响；孩子由各自的任务写入，
+        未执行的孩子不会出现在历史元信息树中，下一个周期会被再次发现
+        :param catalog: 目录状态
+        :return: 不含孩子的目录状态，指纹为空目录的指纹
+        """
+        folder = DirectoryStatus(catalog.filename, mtime=catalog.mtime, uuid=catalog.uuid)
+        folder.file_id = get_directory_fingerprint(folder)
+        return folder
+
+    def emit_push_added(self, catalog_local, next_local_path, next_cloud_path):
+        """
+        提交本地新增项对应的任务
+        新增目录只创建目录本身，其中的每个文件(夹)各自提交任务，由任务图排在目录任务之后并行执行
+        :param catalog_local: 本地元信息
+        :param next_local_path: 本地路径
+        :param next_cloud_path: 云端路径
+        :return: None
+        """
+        if catalog_local.file_type == Catalog.IS_FOLDER:
+            # 在本地历史中利用文件名和文件ID都找不到记录，上传此云目录
+            self.emit([(next_cloud_path, self.empty_folder(catalog_local))],
+                      OP.CREATE_CLOUD_FOLDER, next_local_path, next_cloud_path)
+            for child in catalog_local.children:
+                name = child.filename[len(catalog_local.filename):]
+                self.emit_push_added(child, next_local_path + name, next_cloud_path + name)
+        else:
+            # 在历史记录，名字和摘要都不存在，上传新文件
+            self.emit([(next_cloud_path, catalog_local)],
+                      OP.UPLOAD_FILE, next_local_path, next_cloud_path, file_id=catalog_local.file_id)
+
+    def emit_push_removed(self, next_local_history, next_local_path, next_cloud_path):
+        """
+        提交本地删除项对应的任务
+        :param next_local_history: 本地历史元信息
+        :param next_local_path: 本地路径
+        :param next_cloud_path: 云端路径
+        :return: None
+        """
+        if next_local_history.file_type == Catalog.IS_FOLDER:
+            self.emit([(next_cloud_path, None)], OP.DELETE_CLOUD_FOLDER, next_cloud_path)
+        else:
+            self.emit([(next_cloud_path, None)], OP.DELETE_CLOUD_FILE, next_cloud_path)
+
+    def _algorithm_push(self, local, local_history, cloud_path, local_path, added, removed):
+        """
+        对比本地元信息树和本地历史元信息树，直接提交更新任务，新增项和删除项先收集起来，等待重命名配对
+        使用显式栈逐个目录处理，每个目录通过 diff_directory 线性对比当前和历史的孩子列表，指纹相同的子目录不入栈
+        :param local: 本地元信息树
+        :param local_history: 本地历史元信息树
+        :param cloud_path: 云路径
+        :param local_path: 本地路径
+        :param added: 新增项列表，元素为 (本地元信息, 本地路径, 云端路径)
+        :param removed: 删除项列表，元素为 (本地历史元信息, 本地路径, 云端路径)
+        :return:
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if local_history is not None and local.file_id != '' and local.file_id == local_history.file_id:
+            logger.debug('目录 {filename} 的指纹与历史记录相同，跳过此子树'.format(filename=local.filename))
             return
-        logger.info('遍历本地历史元信息树的每一项，判断是否需要进行本地删除操作')
-        for next_local_history in local_history.children:
-            filename = next_local_history.filename
-            next_local_path = local_path + filename[len(local_path):]
-            next_cloud_path = cloud_path + filename[len(local_path):]
-            catalog_local = local.find_catalog(next_local_path) if local is not None else None
-            logger.info('当前项 next_local_history 为 {}'.format(next_local_history))
-            logger.debug('对应本地文件路径 next_local_path 为 {}'.format(next_local_path))
-            logger.debug('在本地树搜索的结果 catalog_local 为 {}'.format(catalog_local))
-            if catalog_local is None:
-                if next_local_history.file_type == Catalog.IS_FOLDER:
-                    self.tasks.set_data(OP.DELETE_CLOUD_FOLDER, next_cloud_path)
-                else:
-                    self.tasks.set_data(OP.DELETE_CLOUD_FILE, next_cloud_path)
-            logger.info('当前项 {filename} 处理完毕'.format(filename=filename))
+        stack = [(local, local_history, cloud_path, local_path)]
+        while stack:
+            local, local_history, cloud_path, local_path = stack.pop()
+            logger.info('对比本地目录 {filename} 与历史记录'.format(filename=local.filename))
+            added_children, removed_children, modified_children = diff_directory(local, local_history)
+            # 新增部分
+            for catalog_local in added_children:
+                filename = catalog_local.filename
+                logger.debug('本地新增项 {catalog_local}'.format(catalog_local=catalog_local))
+                added.append((catalog_local, local_path + filename[len(local_path):], cloud_path + filename[len(local_path):]))
+            # 删除部分
+            for next_local_history in removed_children:
+                filename = next_local_history.filename
+                logger.debug('本地删除项 {next_local_history}'.format(next_local_history=next_local_history))
+                removed.append((next_local_history, local_path + filename[len(local_path):], cloud_path + filename[len(local_path):]))
+            # 修改部分
+            for catalog_local, next_local_history in modified_children:
+                filename = catalog_local.filename
+                next_local_path = local_path + filename[len(local_path):]
+                next_cloud_path = cloud_path + filename[len(local_path):]
+                logger.debug('本地修改项 {catalog_local}'.format(catalog_local=catalog_local))
+                if catalog_local.file_type == Catalog.IS_FOLDER:
+                    # 目录指纹不同，继续对比目录内部
+                    stack.append((catalog_local, next_local_history, next_cloud_path, next_local_path))
+                elif int(next_local_history.mtime) < int(catalog_local.mtime):
+                    # 历史记录中存在此文件名，此历史文件与本地文件摘要值不相同，且本地最新，则更新云端文件
+                    self.emit([(next_cloud_path, catalog_local)], OP.UPDATE_CLOUD_FILE,
+                              next_local_path, next_cloud_path, file_id=catalog_local.file_id)
 
     def algorithm_pull(self, cloud, cloud_history, cloud_path, local_path):
         """
@@ -246,6 +577,9 @@ class Synchronize:
         找出不一致的项，识别不一致的原因，并将任务提交给任务管理对象进行处理，任务包括：
         创建本地目录, 删除云端目录
         下载文件, 更新本地文件, 删除云端文件
+        Merkle 指纹与历史记录相同的目录子树被整体跳过
+        新增项和删除项按内容配对（文件按 uuid 和摘要，目录按 Merkle 指纹），配对成功的识别为重命名，任务包括：
+        重命名本地文件, 重命名本地目录
         :param cloud: 云端元信息树
         :param cloud_history: 云端历史元信息树
         :param cloud_path: 云路径
@@ -254,55 +588,142 @@ class Synchronize:
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
-        # 新增、修改部分
-        logger.info('遍历云端当前元信息树的每一项，判断是否需要进行同步操作')
-        for catalog_cloud in cloud.children:
-            filename = catalog_cloud.filename
-            next_local_path = local_path + filename[len(cloud_path):]
-            next_cloud_path = cloud_path + filename[len(cloud_path):]
-            next_cloud_history = cloud_history.find_catalog(next_cloud_path) if cloud_history is not None else None
-            logger.info('当前项 catalog_cloud 为 {}'.format(catalog_cloud))
-            logger.debug('对应本地文件路径 next_local_path 为 {}'.format(next_local_path))
-            logger.debug('对应云端文件路径 next_cloud_path 为 {}'.format(next_cloud_path))
-            logger.debug('在云端历史树搜索的结果 next_cloud_history 为 {}'.format(next_cloud_history))
+        added = []
+        removed = []
+        self._algorithm_pull(cloud, cloud_history, cloud_path, local_path, added, removed)
+
+        renamed, added, removed = self.pair_renames(
+            added, removed, lambda catalog: catalog.uuid + catalog.file_id if catalog.uuid != '' else '')
+        for catalog_cloud, (_, next_cloud_path, next_local_path), old_item in renamed:
+            old_local_path = old_item[2]
+            logger.info('云端 {next_cloud_path} 由重命名得到，重命名本地的 {old_local_path}'
+                        .format(next_cloud_path=next_cloud_path, old_local_path=old_local_path))
             if catalog_cloud.file_type == Catalog.IS_FOLDER:
-                logger.debug('当前项为目录')
-                # 如果历史树中存在，则直接递归进去目录处理
-                if next_cloud_history is not None:
-                    self.algorithm_pull(catalog_cloud, next_cloud_history,
-                                        next_cloud_path, next_local_path)
-                # 在云端历史中利用文件名和文件ID都找不到记录，创建此本地目录
-                if next_cloud_history is None:
-                    self.tasks.set_data(OP.CREATE_LOCAL_FOLDER,
-                                        next_cloud_path, next_local_path)
-            elif catalog_cloud.file_type == Catalog.IS_FILE:
-                logger.debug('当前项为文件')
-                # 在历史记录，名字和摘要都不存在，下载新文件
-                if next_cloud_history is None:
-                    self.tasks.set_data(OP.DOWNLOAD_FILE,
-                                        next_cloud_path, next_local_path, file_id=catalog_cloud.file_id)
-                # 历史记录中存在此文件名，此历史文件与本地文件摘要值不相同，且云端最新，则更新本地文件
-                elif next_cloud_history is not None \
-                        and int(next_cloud_history.mtime) < int(catalog_cloud.mtime) \
-                        and next_cloud_history.file_id != catalog_cloud.file_id:
-                    self.tasks.set_data(OP.UPDATE_LOCAL_FILE,
-                                        next_cloud_path, next_local_path, file_id=catalog_cloud.file_id)
-            logger.info('当前项 {filename} 处理完毕'.format(filename=filename))
-        # 删除部分
-        if cloud_history is None:
+                task = self.emit([(old_local_path, None), (next_local_path, catalog_cloud)],
+                                 OP.RENAME_LOCAL_FOLDER, old_local_path, next_local_path)
+                self._rename_fallbacks.append((task, [
+                    functools.partial(self.emit_pull_added, catalog_cloud, next_cloud_path, next_local_path),
+                    functools.partial(self.emit_pull_removed, *old_item)
+                ]))
+            else:
+                self.emit([(old_local_path, None), (next_local_path, catalog_cloud)],
+                          OP.RENAME_LOCAL_FILE, old_local_path, next_local_path)
+        for catalog_cloud, next_cloud_path, next_local_path in added:
+            self.emit_pull_added(catalog_cloud, next_cloud_path, next_local_path)
+        for next_cloud_history, next_cloud_path, next_local_path in removed:
+            self.emit_pull_removed(next_cloud_history, next_cloud_path, next_local_path)
+
+    def emit_pull_added(self, catalog_cloud, next_cloud_path, next_local_path):
+        """
+        提交云端新增项对应的任务
+        新增目录只创建目录本身，其中的每个文件(夹)各自提交任务，由任务图排在目录任务之后并行执行
+        :param catalog_cloud: 云端元信息
+        :param next_cloud_path: 云端路径
+        :param next_local_path: 本地路径
+        :return: None
+        """
+        if catalog_cloud.file_type == Catalog.IS_FOLDER:
+            # 在云端历史中利用文件名和文件ID都找不到记录，创建此本地目录
+            self.emit([(next_local_path, self.empty_folder(catalog_cloud))],
+                      OP.CREATE_LOCAL_FOLDER, next_cloud_path, next_local_path)
+            for child in catalog_cloud.children:
+                name = child.filename[len(catalog_cloud.filename):]
+                self.emit_pull_added(child, next_cloud_path + name, next_local_path + name)
+        else:
+            # 在历史记录，名字和摘要都不存在，下载新文件
+            self.emit([(next_local_path, catalog_cloud)],
+                      OP.DOWNLOAD_FILE, next_cloud_path, next_local_path, file_id=catalog_cloud.file_id)
+
+    def emit_pull_removed(self, next_cloud_history, next_cloud_path, next_local_path):
+        """
+        提交云端删除项对应的任务
+        :param next_cloud_history: 云端历史元信息
+        :param next_cloud_path: 云端路径
+        :param next_local_path: 本地路径
+        :return: None
+        """
+        if next_cloud_history.file_type == Catalog.IS_FOLDER:
+            self.emit([(next_local_path, None)], OP.DELETE_LOCAL_FOLDER, next_local_path)
+        else:
+            self.emit([(next_local_path, None)], OP.DELETE_LOCAL_FILE, next_local_path)
+
+    def _algorithm_pull(self, cloud, cloud_history, cloud_path, local_path, added, removed):
+        """
+        对比云端元信息树和云端历史元信息树，直接提交更新任务，新增项和删除项先收集起来，等待重命名配对
+        使用显式栈逐个目录处理，每个目录通过 diff_directory 线性对比当前和历史的孩子列表，指纹相同的子目录不入栈
+        :param cloud: 云端元信息树
+        :param cloud_history: 云端历史元信息树
+        :param cloud_path: 云路径
+        :param local_path: 本地路径
+        :param added: 新增项列表，元素为 (云端元信息, 云端路径, 本地路径)
+        :param removed: 删除项列表，元素为 (云端历史元信息, 云端路径, 本地路径)
+        :return:
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        if cloud_history is not None and cloud.file_id != '' and cloud.file_id == cloud_history.file_id:
+            logger.debug('目录 {filename} 的指纹与历史记录相同，跳过此子树'.format(filename=cloud.filename))
             return
-        logger.info('遍历云端历史元信息树的每一项，判断是否需要进行云端删除操作')
-        for next_cloud_history in cloud_history.children:
-            filename = next_cloud_history.filename
-            next_local_path = local_path + filename[len(cloud_path):]
-            next_cloud_path = cloud_path + filename[len(cloud_path):]
-            catalog_cloud = cloud.find_catalog(next_cloud_path) if cloud is not None else None
-            logger.info('当前项 next_cloud_history 为 {}'.format(next_cloud_history))
-            logger.debug('对应云端文件路径 next_cloud_path 为 {}'.format(next_cloud_path))
-            logger.debug('在云端树搜索的结果 catalog_cloud 为 {}'.format(catalog_cloud))
-            if catalog_cloud is None:
-                if next_cloud_history.file_type == Catalog.IS_FOLDER:
-                    self.tasks.set_data(OP.DELETE_LOCAL_FOLDER, next_local_path)
-                else:
-                    self.tasks.set_data(OP.DELETE_LOCAL_FILE, next_local_path)
-            logger.info('当前项 {filename} 处理完毕'.format(filename=filename))
+        stack = [(cloud, cloud_history, cloud_path, local_path)]
+        while stack:
+            cloud, cloud_history, cloud_path, local_path = stack.pop()
+            logger.info('对比云端目录 {filename} 与历史记录'.format(filename=cloud.filename))
+            added_children, removed_children, modified_children = diff_directory(cloud, cloud_history)
+            # 新增部分
+            for catalog_cloud in added_children:
+                filename = catalog_cloud.filename
+                logger.debug('云端新增项 {catalog_cloud}'.format(catalog_cloud=catalog_cloud))
+                added.append((catalog_cloud, cloud_path + filename[len(cloud_path):], local_path + filename[len(cloud_path):]))
+            # 删除部分
+            for next_cloud_history in removed_children:
+                filename = next_cloud_history.filename
+                logger.debug('云端删除项 {next_cloud_history}'.format(next_cloud_history=next_cloud_history))
+                removed.append((next_cloud_history, cloud_path + filename[len(cloud_path):], local_path + filename[len(cloud_path):]))
+            # 修改部分
+            for catalog_cloud, next_cloud_history in modified_children:
+                filename = catalog_cloud.filename
+                next_local_path = local_path + filename[len(cloud_path):]
+                next_cloud_path = cloud_path + filename[len(cloud_path):]
+                logger.debug('云端修改项 {catalog_cloud}'.format(catalog_cloud=catalog_cloud))
+                if catalog_cloud.file_type == Catalog.IS_FOLDER:
+                    # 目录指纹不同，继续对比目录内部
+                    stack.append((catalog_cloud, next_cloud_history, next_cloud_path, next_local_path))
+                elif int(next_cloud_history.mtime) < int(catalog_cloud.mtime):
+                    # 历史记录中存在此文件名，此历史文件与云端文件摘要值不相同，且云端最新，则更新本地文件
+                    self.emit([(next_local_path, catalog_cloud)], OP.UPDATE_LOCAL_FILE,
+                              next_cloud_path, next_local_path, file_id=catalog_cloud.file_id)
+
+    @staticmethod
+    def pair_renames(added, removed, file_key):
+        """
+        将消失的项和新出现的项按内容配对，识别重命名和移动
+        文件使用 file_key 计算配对键，目录使用 Merkle 指纹作为配对键；配对键为空的项不参与配对
+        :param added: 新增项列表，元素的第一项为元信息
+        :param removed: 删除项列表，元素的第一项为元信息
+        :param file_key: 计算文件配对键的函数
+        :return: (重命名列表, 未配对的新增项列表, 未配对的删除项列表)，重命名列表的元素为 (新元信息, 新增项, 删除项)
+        """
+        def key_of(catalog):
+            if catalog.file_type == Catalog.IS_FOLDER:
+                return catalog.file_type, catalog.file_id
+            return catalog.file_type, file_key(catalog)
+
+        candidates = dict()
+        for item in removed:
+            key = key_of(item[0])
+            if key[1] != '':
+                candidates.setdefault(key, []).append(item)
+
+        renamed = []
+        unmatched_added = []
+        matched_removed = set()
+        for item in added:
+            key = key_of(item[0])
+            if key[1] != '' and len(candidates.get(key, [])) > 0:
+                old_item = candidates[key].pop()
+                matched_removed.add(id(old_item))
+                renamed.append((item[0], item, old_item))
+            else:
+                unmatched_added.append(item)
+        unmatched_removed = [item for item in removed if id(item) not in matched_removed]
+        return renamed, unmatched_added, unmatched_removed
@@ -1,5 +1,40 @@
 import logging
 import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 并行执行同步任务的工作者数量，不大于 1 时在调用 set_data 的线程中逐个执行任务
+task_workers = 8
+
+
+class SynchronizeTask:
+    """
+    任务图中的一个同步任务
+    与 SynchronizeEventEmitter 一样提供 task_index、from_path、to_path、kwargs，观察者可以直接使用
+    """
+
+    def __init__(self, task_index, from_path, to_path, kwargs):
+        self.task_index = task_index
+        self.from_path = from_path
+        self.to_path = to_path
+        self.kwargs = kwargs
+        # 任务涉及的路径
+        self.paths = [path for path in (from_path, to_path) if path != '']
+        # 尚未完成的前置任务数量
+        self.remaining = 0
+        # 依赖于此任务的后续任务
+        self.dependents = []
+        # 观察者是否报告任务已成功执行
+        self.applied = False
+        # 执行任务时抛出的异常，没有异常时为 None
+        self.error = None
+
+    def __str__(self):
+        return '[SynchronizeTask: task_index={task_index} from_path={from_path} to_path={to_path}]'.format(
+            task_index=self.task_index,
+            from_path=self.from_path,
+            to_path=self.to_path
+        )
 
 
 class SynchronizeEventEmitter:
@@ -7,14 +42,34 @@ class SynchronizeEventEmitter:
     任务参数管理，中介对象
     存储任务需要的信息，以及通知相应任务
     作为可观察者 Observable
+    工作者数量大于 1 时，任务被放入任务图中并由线程池并行执行：
+    - 父目录上的任务（如 OP.CREATE_CLOUD_FOLDER、OP.CREATE_LOCAL_FOLDER）完成后，才会执行其子路径上的任务
+    - 同一路径上的任务（如删除和创建）按提交顺序执行
+    两种模式下观察者抛出的异常都只记录日志，任务视为失败，由 drain 返回
     """
 
-    def __init__(self):
+    def __init__(self, workers=None):
+        """
+        :param workers: 并行执行任务的工作者数量，为 None 时使用 task_workers
+        """
         self._observers = []
         self.task_index = 0
         self.from_path = ''
         self.to_path = ''
         self.kwargs = {}
+        # 已提交的任务总数，调度器据此估计变化的频率
+        self.submitted = 0
+
+        self.workers = task_workers if workers is None else workers
+        self._executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        # 未完成的任务，键为任务涉及的路径
+        self._pending = dict()
+        # 未完成的任务，键为任务涉及的路径的各级父目录，用于查找目录下的任务
+        self._pending_under = dict()
+        self._pending_count = 0
+        # 自上次 drain 以来执行失败（抛出异常）的任务
+        self._failed = []
+        self._condition = threading.Condition()
 
     def register(self, observer):
         """
@@ -46,31 +101,36 @@ class SynchronizeEventEmitter:
         else:
             logger.warning('解绑失败！观察者 {observer} 不存在于观察者列表中'.format(observer=observer))
 
-    def notify(self):
+    def notify(self, task=None):
         """
         通知观察者列表中的观察者
-        :return: None
+        :param task: 要执行的任务，为 None 时观察者从被观察者自身读取任务信息
+        :return: 是否所有观察者都报告任务已成功执行
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
         logger.debug('被观察者将通知所有已注册的观察者')
+        applied = len(self._observers) > 0
         for observer in self._observers:
-            observer.update(self)
+            applied = observer.update(self if task is None else task) is True and applied
             logger.debug('已通知 {observer}'.format(observer=observer))
         logger.debug('通知完毕')
+        return applied
 
     def set_data(self, task_index, *args, **kwargs):
         """
         更新被观察者的数据，并调用 notify() 更新观察者
+        并行模式下，任务被放入任务图，待其依赖的任务完成后再由线程池通知观察者
         :param task_index: 任务序号
         :param args: 观察者执行参数， 1~2个
         :param kwargs: 额外参数，可能包含有 file_id
-        :return: None
+        :return: 同步任务，任务执行完毕后可通过其 applied 属性得知是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__,
                                            function_name=inspect.stack()[0].function))
         logger.info('被观察者状态发生变化。')
+        self.submitted += 1
         self.task_index = task_index
         self.from_path = args[0]
         try:
@@ -86,4 +146,111 @@ class SynchronizeEventEmitter:
             logger.info('新值为: task_index={task_index}, from_path={from_path}'
                         .format(task_index=self.task_index, from_path=self.from_path))
 
-        self.notify()
+        task = SynchronizeTask(self.task_index, self.from_path, self.to_path, self.kwargs)
+        if self._executor is None:
+            self._execute(task, None)
+        else:
+            self._schedule(task)
+        return task
+
+    def drain(self):
+        """
+        等待所有已提交的任务执行完毕
+        :return: 自上次 drain 以来执行失败（抛出异常）的任务列表
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        with self._condition:
+            if self._pending_count > 0:
+                logger.info('等待 {count} 个同步任务执行完毕'.format(count=self._pending_count))
+            self._condition.wait_for(lambda: self._pending_count == 0)
+            failed = self._failed
+            self._failed = []
+        if failed:
+            logger.warning('{count} 个同步任务执行失败'.format(count=len(failed)))
+        logger.debug('所有同步任务执行完毕')
+        return failed
+
+    def _execute(self, task: SynchronizeTask, target):
+        """
+        通知观察者执行任务，异常只记录日志，并将任务记为失败
+        :param task: 同步任务
+        :param target: 传给 notify 的任务，为 None 时观察者从被观察者自身读取任务信息
+        :return: None
+        """
+        try:
+            task.applied = self.notify(target)
+        except Exception as err:
+            logger = logging.getLogger('{class_name} -> {function_name}'
+                                       .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+            logger.exception('执行任务 {task} 失败，错误信息为 {err}'.format(task=task, err=err))
+            task.error = err
+            with self._condition:
+                self._failed.append(task)
+
+    @staticmethod
+    def _parents(path):
+        """
+        :param path: 路径
+        :return: 路径的各级父目录（以 / 结尾，不含路径本身）的生成器
+        """
+        index = path.find('/')
+        while 0 <= index < len(path) - 1:
+            yield path[:index + 1]
+            index = path.find('/', index + 1)
+
+    def _schedule(self, task: SynchronizeTask):
+        """
+        将任务加入任务图，找出它依赖的未完成任务；没有依赖时立即提交到线程池
+        :param task: 同步任务
+        :return: None
+        """
+        with self._condition:
+            dependencies = set()
+            for path in task.paths:
+                # 同一路径上的任务
+                dependencies.update(self._pending.get(path, []))
+                # 父目录上的任务
+                for parent in self._parents(path):
+                    dependencies.update(self._pending.get(parent, []))
+                # 子路径上的任务
+                if path.endswith('/'):
+                    dependencies.update(self._pending_under.get(path, ()))
+            for dependency in dependencies:
+                dependency.dependents.append(task)
+            task.remaining = len(dependencies)
+            for path in task.paths:
+                self._pending.setdefault(path, []).append(task)
+                for parent in self._parents(path):
+                    self._pending_under.setdefault(parent, set()).add(task)
+            self._pending_count += 1
+            if task.remaining == 0:
+                self._executor.submit(self._run, task)
+
+    def _run(self, task: SynchronizeTask):
+        """
+        在线程池中执行任务，完成后释放依赖于它的任务
+        :param task: 同步任务
+        :return: None
+        """
+        try:
+            self._execute(task, task)
+        finally:
+            with self._condition:
+                for path in task.paths:
+                    tasks = self._pending[path]
+                    tasks.remove(task)
+                    if len(tasks) == 0:
+                        del self._pending[path]
+                    for parent in self._parents(path):
+                        tasks = self._pending_under.get(parent)
+                        if tasks is not None:
+                            tasks.discard(task)
+                            if len(tasks) == 0:
+                                del self._pending_under[parent]
+                for dependent in task.dependents:
+                    dependent.remaining -= 1
+                    if dependent.remaining == 0:
+                        self._executor.submit(self._run, dependent)
+                self._pending_count -= 1
+                self._condition.notify_all()
@@ -1,24 +1,59 @@
 import os
 import logging
 import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from global_value import OP, hash_table_local, hash_table_cloud
+import utils
+import transfer
+from global_value import OP, dedup_local, dedup_cloud, stat_cache
 from synchronize_event_emitter import SynchronizeEventEmitter
 
+# 批量删除云端对象时每批的对象数量，不能超过批量删除接口的上限 1000
+delete_batch_size = 1000
+# 并行发送批量删除请求的数量
+delete_workers = 4
+
 
 class SynchronizeEventHandler:
     def __init__(self, cfs):
         self.cfs = cfs
+        # 任务参数按线程保存，使多个任务可以在线程池中并行执行
+        self._context = threading.local()
         self.from_path = ''
         self.to_path = ''
         self.kwargs = {}
 
+    @property
+    def from_path(self):
+        return getattr(self._context, 'from_path', '')
+
+    @from_path.setter
+    def from_path(self, value):
+        self._context.from_path = value
+
+    @property
+    def to_path(self):
+        return getattr(self._context, 'to_path', '')
+
+    @to_path.setter
+    def to_path(self, value):
+        self._context.to_path = value
+
+    @property
+    def kwargs(self):
+        return getattr(self._context, 'kwargs', {})
+
+    @kwargs.setter
+    def kwargs(self, value):
+        self._context.kwargs = value
+
     def create_cloud_folder(self, from_path=None, to_path=None):
         """
-        上传本地目录到云端
+        在云端创建本地新增的目录，目录中的内容由各自的任务上传
         :param from_path: 本地目录路径
         :param to_path: 云端目录路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -29,31 +64,22 @@ class SynchronizeEventHandler:
         # check if folders exist
         if not os.path.exists(from_path):
             logger.warning('本地不存在文件夹 {from_path}，操作中止'.format(from_path=from_path))
-            return
-        if self.cfs.stat_file(to_path) is not None:
+            return False
+        if self._cloud_folder_exists(to_path):
             logger.warning('云端已存在文件夹 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # create folder
         self.cfs.create_folder(to_path)
-        logger.info('已创建云端文件夹 {to_path}'.format(to_path=to_path))
-        logger.info('遍历本地文件夹 {from_path} 中的内容，递归上传'.format(from_path=from_path))
-        for filename in os.listdir(from_path):
-            filename = from_path + filename
-            if os.path.isdir(filename):
-                logger.info('发现本地文件夹 {filename}'.format(filename=filename + '/'))
-                self.create_cloud_folder(filename + '/', to_path + filename[len(from_path):] + '/')
-            else:
-                logger.info('发现本地文件 {filename}'.format(filename=filename))
-                self.upload(filename, to_path + filename[len(from_path):])
-        logger.info('上传本地文件夹 {from_path} 到云端文件夹 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        logger.info('已创建云端文件夹 {to_path}，其中的内容由各自的任务上传'.format(to_path=to_path))
+        return True
 
     def create_local_folder(self, from_path=None, to_path=None):
         """
-        下载云端目录到本地
+        在本地创建云端新增的目录，目录中的内容由各自的任务下载
         :param from_path: 云端目录路径
         :param to_path: 本地目录路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -62,32 +88,24 @@ class SynchronizeEventHandler:
         logger.info('准备将云端文件夹 {from_path} 下载到本地文件夹 {to_path}'.format(from_path=from_path, to_path=to_path))
 
         # check if folders exist
-        if self.cfs.stat_file(from_path) is None:
+        if not self._cloud_folder_exists(from_path):
             logger.warning('云端不存在文件夹 {from_path}，操作中止'.format(from_path=from_path))
-            return
+            return False
         if os.path.exists(to_path):
             logger.warning('本地已存在文件夹 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # create folder
         os.mkdir(to_path)
-        logger.info('已创建本地文件夹 {to_path}'.format(to_path=to_path))
-        logger.info('遍历云端文件夹 {from_path} 中的内容，递归下载'.format(from_path=from_path))
-        for filename in self.cfs.list_files(from_path):
-            if filename.endswith('/'):
-                logger.info('发现云端文件夹 {from_path}{filename}'.format(from_path=from_path, filename=filename))
-                self.create_local_folder(from_path + filename, to_path + filename)
-            else:
-                logger.info('发现云端文件 {from_path}{filename}'.format(from_path=from_path, filename=filename))
-                self.download(from_path + filename, to_path + filename)
-        logger.info('下载云端文件夹 {from_path} 到本地文件夹 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        logger.info('已创建本地文件夹 {to_path}，其中的内容由各自的任务下载'.format(to_path=to_path))
+        return True
 
     def upload(self, from_path=None, to_path=None):
         """
         上传本地文件到云端
         :param from_path: 本地文件路径
         :param to_path: 云端文件路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -97,36 +115,29 @@ class SynchronizeEventHandler:
         # check if files exist
         if not os.path.exists(from_path):
             logger.warning('本地不存在文件 {from_path}，操作中止'.format(from_path=from_path))
-            return
-        if self.cfs.stat_file(to_path) is not None:
+            return False
+        # 写入前的存在性判断决定是否会覆盖其他客户端新写入的对象，不能使用布隆过滤器或缓存中的“不存在”
+        if self.cfs.stat_file(to_path, cached=False) is not None:
             logger.warning('云端已存在文件 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
-        if 'file_id' in self.kwargs:
-            records = hash_table_cloud.get(self.kwargs['file_id'], [])
-            if len(records) > 0:
-                logger.info('发现云端存在相同 file_id 的文件，准备复制')
-                for record in records:
-                    try:
-                        self.cfs.copy(record, to_path)
-                        logger.info('复制成功')
-                        return
-                    except Exception as e:
-                        print(e)
-                        logger.info('复制失败')
-                        pass
+        if 'file_id' in self.kwargs and self._copy_cloud_duplicate(self.kwargs['file_id'], to_path):
+            return True
 
         # upload file
         logger.info('准备将本地文件 {from_path} 上传到云端文件 {to_path}'.format(from_path=from_path, to_path=to_path))
-        self.cfs.upload(to_path, from_path)
+        stat = self.cfs.upload(to_path, from_path, file_hash=self._cached_local_hash(from_path))
+        if stat is not None:
+            dedup_cloud.add(to_path, stat['hash'])
         logger.info('上传本地文件 {from_path} 到云端文件 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def download(self, from_path=None, to_path=None):
         """
         下载云端文件到本地
         :param from_path: 云端文件路径
         :param to_path: 本地文件路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -136,34 +147,24 @@ class SynchronizeEventHandler:
         # check if files exist
         if self.cfs.stat_file(from_path) is None:
             logger.warning('云端不存在文件 {from_path}，操作中止'.format(from_path=from_path))
-            return
+            return False
         if os.path.exists(to_path):
             logger.warning('本地已存在文件 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
-        if 'file_id' in self.kwargs:
-            records = hash_table_local.get(self.kwargs['file_id'], [])
-            if len(records) > 0:
-                logger.info('发现本地存在相同 file_id 的文件，准备复制')
-                for record in records:
-                    try:
-                        os.rename(record, to_path)
-                        logger.info('复制成功')
-                        return
-                    except Exception as e:
-                        print(e)
-                        logger.info('复制失败')
-                        pass
+        if 'file_id' in self.kwargs and self._clone_local_duplicate(self.kwargs['file_id'], to_path):
+            return True
 
         # download file
         logger.info('准备将云端文件 {from_path} 下载到本地文件 {to_path}'.format(from_path=from_path, to_path=to_path))
-        self.cfs.download(from_path, to_path)
+        self._download_file(from_path, to_path)
         logger.info('下载云端文件 {from_path} 到本地文件 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def delete_cloud_file(self):
         """
         删除云端文件
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -172,17 +173,19 @@ class SynchronizeEventHandler:
         # check if the cloud file exists
         if self.cfs.stat_file(cloud_path) is None:
             logger.warning('云端不存在文件 {cloud_path}，操作中止'.format(cloud_path=cloud_path))
-            return
+            return False
 
         # delete file
         logger.info('准备删除云端文件 {cloud_path}'.format(cloud_path=cloud_path))
         self.cfs.delete(cloud_path)
+        dedup_cloud.remove(cloud_path)
         logger.info('删除云端文件 {cloud_path} 完成'.format(cloud_path=cloud_path))
+        return True
 
     def delete_local_file(self):
         """
         删除本地文件
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -191,46 +194,66 @@ class SynchronizeEventHandler:
         # check if the local file exists
         if not os.path.exists(local_path):
             logger.warning('本地不存在文件 {local_path}，操作中止'.format(local_path=local_path))
-            return
+            return False
 
         # delete file
         logger.info('准备删除本地文件 {local_path}'.format(local_path=local_path))
         os.remove(local_path)
+        dedup_local.remove(local_path)
         logger.info('删除本地文件 {local_path} 完成'.format(local_path=local_path))
+        return True
 
     def delete_cloud_folder(self, cloud_path=None):
         """
         删除云端目录
         :param cloud_path: 云端目录路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
         cloud_path = self.from_path if cloud_path is None else cloud_path
 
-        # check if the cloud folder exists
-        if self.cfs.stat_file(cloud_path) is None:
-            logger.warning('云端不存在文件夹 {cloud_path}，操作中止'.format(cloud_path=cloud_path))
-            return
-
         # delete folder
+        # 文件夹是否存在由列举结果判断，不再单独发送 HEAD 请求
         logger.info('准备删除云端文件夹 {cloud_path}'.format(cloud_path=cloud_path))
-        logger.info('遍历云端文件夹 {cloud_path} 中的内容，递归删除'.format(cloud_path=cloud_path))
-        for filename in self.cfs.list_files(cloud_path):
-            if filename.endswith('/'):
-                logger.info('发现云端文件夹 {cloud_path}{filename}'.format(cloud_path=cloud_path, filename=filename))
-                self.delete_cloud_folder(cloud_path + filename)
-            else:
-                logger.info('发现云端文件 {cloud_path}{filename}'.format(cloud_path=cloud_path, filename=filename))
-                self.cfs.delete(cloud_path + filename)
-        self.cfs.delete(cloud_path)
-        logger.info('删除云端文件夹 {cloud_path} 完成'.format(cloud_path=cloud_path))
+        logger.info('流式列举云端文件夹 {cloud_path} 中的所有对象，并行批量删除'.format(cloud_path=cloud_path))
+        failed = []
+        deleted_count = 0
+        with ThreadPoolExecutor(max_workers=max(1, delete_workers)) as executor:
+            futures = set()
+            batch = []
+            for entry in self.cfs.iter_all_files(cloud_path):
+                batch.append(entry['key'])
+                if len(batch) < delete_batch_size:
+                    continue
+                # 控制同时进行中的批量删除请求数量
+                if len(futures) >= delete_workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    failed += [key for future in done for key in future.result()]
+                futures.add(executor.submit(self.cfs.delete_many, batch))
+                deleted_count += len(batch)
+                batch = []
+            if len(batch) > 0:
+                futures.add(executor.submit(self.cfs.delete_many, batch))
+                deleted_count += len(batch)
+            failed += [key for future in futures for key in future.result()]
+        dedup_cloud.remove_tree(cloud_path)
+
+        if deleted_count == 0:
+            logger.warning('云端不存在文件夹 {cloud_path}，操作中止'.format(cloud_path=cloud_path))
+            return False
+        if len(failed) > 0:
+            logger.error('删除云端文件夹 {cloud_path} 时，{count} 个对象删除失败: {failed}'
+                         .format(cloud_path=cloud_path, count=len(failed), failed=failed))
+            return False
+        logger.info('删除云端文件夹 {cloud_path} 完成，共删除 {count} 个对象'.format(cloud_path=cloud_path, count=deleted_count))
+        return True
 
     def delete_local_folder(self, local_path=None):
         """
         删除本地目录
         :param local_path: 本地目录路径
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -239,7 +262,7 @@ class SynchronizeEventHandler:
         # check if the local folder exists
         if not os.path.exists(local_path):
             logger.warning('本地不存在文件夹 {local_path}，操作中止'.format(local_path=local_path))
-            return
+            return False
 
         # delete folder
         logger.info('准备删除本地文件夹 {local_path}'.format(local_path=local_path))
@@ -253,12 +276,14 @@ class SynchronizeEventHandler:
                 logger.info('发现本地文件 {filename}'.format(filename=filename))
                 os.remove(filename)
         os.rmdir(local_path)
+        dedup_local.remove_tree(local_path)
         logger.info('删除本地文件夹 {local_path} 完成'.format(local_path=local_path))
+        return True
 
     def update_cloud_file(self):
         """
         更新云文件
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -266,54 +291,44 @@ class SynchronizeEventHandler:
         to_path = self.to_path
 
         if 'file_id' in self.kwargs:
-            records = hash_table_cloud.get(self.kwargs['file_id'], [])
-            if len(records) > 0:
-                logger.info('发现云端存在相同 file_id 的文件，准备复制')
-                for record in records:
-                    try:
-                        self.cfs.copy(record, to_path)
-                        logger.info('复制成功')
-                        return
-                    except Exception as e:
-                        print(e)
-                        logger.info('复制失败')
-                        pass
+            # 复制覆盖被更新的文件时沿用它的文件ID
+            target_stat = self.cfs.stat_file(to_path)
+            if target_stat is None:
+                logger.warning('云端不存在文件 {to_path}，操作中止'.format(to_path=to_path))
+                return False
+            if self._copy_cloud_duplicate(self.kwargs['file_id'], to_path, target_stat['uuid']):
+                return True
 
         logger.info('准备将本地文件 {from_path} 上传到云端文件 {to_path}'.format(from_path=from_path, to_path=to_path))
-        self.cfs.update(to_path, from_path)
+        stat = self.cfs.update(to_path, from_path, file_hash=self._cached_local_hash(from_path))
+        if stat is None:
+            logger.warning('云端不存在文件 {to_path}，操作中止'.format(to_path=to_path))
+            return False
+        dedup_cloud.add(to_path, stat['hash'])
         logger.info('上传本地文件 {from_path} 到云端文件 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def update_local_file(self):
         """
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
         from_path = self.from_path
         to_path = self.to_path
 
-        if 'file_id' in self.kwargs:
-            records = hash_table_local.get(self.kwargs['file_id'], [])
-            if len(records) > 0:
-                logger.info('发现本地存在相同 file_id 的文件，准备复制')
-                for record in records:
-                    try:
-                        os.rename(record, to_path)
-                        logger.info('复制成功')
-                        return
-                    except Exception as e:
-                        print(e)
-                        logger.info('复制失败')
-                        pass
+        if 'file_id' in self.kwargs and self._clone_local_duplicate(self.kwargs['file_id'], to_path):
+            return True
 
         logger.info('准备将云端文件 {from_path} 下载到本地文件 {to_path}'.format(from_path=from_path, to_path=to_path))
-        self.cfs.download(from_path, to_path)
+        self._download_file(from_path, to_path)
         logger.info('下载云端文件 {from_path} 到本地文件 {to_path} 完成'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def rename_cloud_file(self):
         """
         重命名云端文件
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -323,20 +338,22 @@ class SynchronizeEventHandler:
         # check if the cloud files exist
         if self.cfs.stat_file(from_path) is None:
             logger.warning('云端不存在文件 {from_path}，操作中止'.format(from_path=from_path))
-            return
-        if self.cfs.stat_file(to_path) is not None:
+            return False
+        if self.cfs.stat_file(to_path, cached=False) is not None:
             logger.warning('云端已存在文件 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # rename file
         logger.info('准备将云端文件 {from_path} 重命名为 {to_path}'.format(from_path=from_path, to_path=to_path))
         self.cfs.rename(from_path, to_path)
+        dedup_cloud.rename(from_path, to_path)
         logger.info('重命名云端文件 {from_path} 为 {to_path} 成功'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def rename_local_file(self):
         """
         重命名本地文件
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -346,20 +363,22 @@ class SynchronizeEventHandler:
         # check if the local files exist
         if not os.path.exists(from_path):
             logger.warning('本地不存在文件 {from_path}，操作中止'.format(from_path=from_path))
-            return
+            return False
         if os.path.exists(to_path):
             logger.warning('本地已存在文件 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # rename file
         logger.info('准备将本地文件 {from_path} 重命名为 {to_path}'.format(from_path=from_path, to_path=to_path))
         os.rename(from_path, to_path)
+        dedup_local.rename(from_path, to_path)
         logger.info('重命名本地文件 {from_path} 为 {to_path} 成功'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def rename_cloud_folder(self):
         """
         重命名云端目录
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -367,22 +386,24 @@ class SynchronizeEventHandler:
         to_path = self.to_path
 
         # check if the cloud folders exist
-        if self.cfs.stat_file(from_path) is None:
+        if not self._cloud_folder_exists(from_path):
             logger.warning('云端不存在文件夹 {from_path}，操作中止'.format(from_path=from_path))
-            return
-        if self.cfs.stat_file(to_path) is not None:
+            return False
+        if self._cloud_folder_exists(to_path):
             logger.warning('云端已存在文件夹 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # rename folder
         logger.info('准备将云端文件夹 {from_path} 重命名为 {to_path}'.format(from_path=from_path, to_path=to_path))
         self.cfs.rename(from_path, to_path)
+        dedup_cloud.rename(from_path, to_path)
         logger.info('重命名云端文件夹 {from_path} 为 {to_path} 成功'.format(from_path=from_path, to_path=to_path))
+        return True
 
     def rename_local_folder(self):
         """
         重命名本地目录
-        :return: None
+        :return: 是否执行成功
         """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
@@ -392,17 +413,121 @@ class SynchronizeEventHandler:
         # check if the local folders exist
         if not os.path.exists(from_path):
             logger.warning('本地不存在文件夹 {from_path}，操作中止'.format(from_path=from_path))
-            return
+            return False
         if os.path.exists(to_path):
             logger.warning('本地已存在文件夹 {to_path}，操作中止'.format(to_path=to_path))
-            return
+            return False
 
         # rename folder
         logger.info('准备将本地文件夹 {from_path} 重命名为 {to_path}'.format(from_path=from_path, to_path=to_path))
         os.rename(from_path, to_path)
+        dedup_local.rename(from_path, to_path)
         logger.info('重命名本地文件夹 {from_path} 为 {to_path} 成功'.format(from_path=from_path, to_path=to_path))
+        return True
+
+    def _cloud_folder_exists(self, cloud_path):
+        """
+        云端目录可能只以对象键前缀的形式存在（没有 dir/ 目录对象），因此通过列举前缀判断，而不是对目录对象发送 HEAD 请求
+        :param cloud_path: 云端目录路径，以 / 结尾
+        :return: 云端目录是否存在
+        """
+        return next(iter(self.cfs.iter_all_files(cloud_path, page_size=1, prefetch=False)), None) is not None
+
+    def _download_file(self, from_path, to_path):
+        """
+        下载文件，并将下载时计算的摘要记入本地摘要缓存和去重索引，下一次扫描时无需重新计算摘要
+        :param from_path: 云端文件路径
+        :param to_path: 本地文件路径
+        :return: None
+        """
+        file_hash, stat_result = self.cfs.download(from_path, to_path)
+        stat_cache.update(stat_result, file_hash, to_path)
+        dedup_local.add(to_path, file_hash)
+
+    @staticmethod
+    def _cached_local_hash(local_path):
+        """
+        从本地摘要缓存中获取文件摘要，扫描时已计算过摘要且文件此后未发生变化时命中，上传时无需再计算
+        :param local_path: 本地文件路径
+        :return: 文件摘要，未命中时返回 None
+        """
+        try:
+            return stat_cache.lookup(os.stat(local_path), local_path)
+        except OSError:
+            return None
+
+    def _copy_cloud_duplicate(self, file_id, to_path, file_uuid=None):
+        """
+        在云端查找内容相同的文件，找到时通过一次服务端复制写入目标文件，代替上传
+        候选文件使用前先校验其当前摘要（优先使用元信息缓存），已经变化或不存在的候选文件从去重索引中移除
+        :param file_id: 文件摘要
+        :param to_path: 云端目标文件路径
+        :param file_uuid: 目标文件的文件ID，为 None 时生成新的文件ID
+        :return: 是否复制成功
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        for record in dedup_cloud.lookup(file_id, exclude=to_path):
+            try:
+                stat = self.cfs.stat_file(record)
+                if stat is None or stat['hash'] != file_id:
+                    logger.info('云端文件 {record} 已不存在或内容已变化，从去重索引中移除'.format(record=record))
+                    dedup_cloud.remove(record)
+                    continue
+                logger.info('发现云端存在相同摘要的文件 {record}，复制到 {to_path}'.format(record=record, to_path=to_path))
+                stat = self.cfs.copy(record, to_path, file_uuid=file_uuid)
+            except Exception as err:
+                logger.warning('复制云端文件 {record} 到 {to_path} 失败，错误信息为 {err}'
+                               .format(record=record, to_path=to_path, err=err))
+                continue
+            dedup_cloud.add(to_path, stat['hash'] if stat is not None else file_id)
+            return True
+        return False
+
+    def _clone_local_duplicate(self, file_id, to_path):
+        """
+        在本地查找内容相同的文件，找到时将其内容复制到目标路径，代替下载，源文件保持不变
+        复制方式见 transfer.clone_local_file，优先使用 reflink
+        候选文件使用前先校验其当前摘要（优先使用本地摘要缓存），已经变化或不存在的候选文件从去重索引中移除
+        :param file_id: 文件摘要
+        :param to_path: 本地目标文件路径
+        :return: 是否复制成功
+        """
+        logger = logging.getLogger('{class_name} -> {function_name}'
+                                   .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
+        for record in dedup_local.lookup(file_id, exclude=to_path):
+            try:
+                stat_result = os.stat(record)
+                file_hash = stat_cache.lookup(stat_result, record)
+                if file_hash is None:
+                    file_hash = utils.get_local_file_hash(record)
+                    stat_cache.update(stat_result, file_hash, record)
+            except OSError:
+                file_hash = None
+            if file_hash != file_id:
+                logger.info('本地文件 {record} 已不存在或内容已变化，从去重索引中移除'.format(record=record))
+                dedup_local.remove(record)
+                continue
+            try:
+                method = transfer.clone_local_file(record, to_path)
+                stat_result = os.stat(to_path)
+            except OSError as err:
+                logger.warning('复制本地文件 {record} 到 {to_path} 失败，错误信息为 {err}'
+                               .format(record=record, to_path=to_path, err=err))
+                continue
+            logger.info('发现本地存在相同摘要的文件 {record}，已通过 {method} 复制到 {to_path}'
+                        .format(record=record, method=method, to_path=to_path))
+            stat_cache.update(stat_result, file_id, to_path)
+            dedup_local.add(to_path, file_id)
+            return True
+        return False
 
     def update(self, observable: SynchronizeEventEmitter):
+        """
+        执行被观察者通知的任务
+        :param observable: 被观察者或同步任务
+        :return: 任务是否执行成功
+        """
         logger = logging.getLogger('{class_name} -> {function_name}'
                                    .format(class_name=__class__.__name__, function_name=inspect.stack()[0].function))
 
@@ -414,7 +539,7 @@ class SynchronizeEventHandler:
         logger.debug('任务编号: {task_index}, 参数列表: [\'{from_path}\', \'{to_path}\'], 将执行编号对应操作'
                      .format(task_index=task_index, from_path=self.from_path, to_path=self.to_path))
 
-        {
+        return {
             OP.CREATE_CLOUD_FOLDER: self.create_cloud_folder,
             OP.CREATE_LOCAL_FOLDER: self.create_local_folder,
             OP.UPLOAD_FILE: self.upload,
@@ -0,0 +1,496 @@
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import utils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 文件大小不小于此值时使用分片上传，单位为字节
+multipart_threshold = 64 * 1024 * 1024
+# 分片上传时每个分片的大小，单位为字节
+multipart_part_size = 8 * 1024 * 1024
+# 分片上传时并行上传的分片数量
+multipart_workers = 4
+# 对象大小不小于此值时使用分段并行下载，单位为字节
+download_threshold = 64 * 1024 * 1024
+# 分段下载时每个分段的大小，单位为字节
+download_part_size = 8 * 1024 * 1024
+# 分段下载时并行下载的分段数量
+download_workers = 4
+# 重命名目录时并行发送的服务端复制请求数量
+copy_workers = 8
+# 断点记录文件的保存目录
+checkpoint_dir = os.path.join(sys.path[0], 'cloudsync_checkpoints')
+# 下载中的临时文件的名称前缀，临时文件是与目标文件同目录的隐藏文件，扫描本地目录时会跳过带有此前缀的文件
+temp_prefix = '.cloudsync-partial-'
+# 临时文件和断点记录超过此时间未修改时视为中断后遗留，予以清理，单位为秒
+stale_age = 7 * 24 * 3600
+# 文件名的最大长度，单位为字节
+name_max = 255
+
+# ioctl FICLONE 的请求码，取值见 <linux/fs.h>
+FICLONE = 0x40049409
+# 克隆失败时表示当前文件系统或内核不支持该方式的错误码，遇到时改用下一种方式
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def get_temp_path(path):
+    """
+    获取写入目标文件时使用的临时文件路径，同一目标文件总是得到同一路径，中断后可以继续使用
+    临时文件名为 temp_prefix 加上目标文件名，超过文件名长度限制时改用目标文件名的摘要
+    :param path: 目标文件路径
+    :return: 与目标文件同目录的临时文件路径
+    """
+    dirname, basename = os.path.split(path)
+    name = temp_prefix + basename
+    if len(os.fsencode(name)) > name_max:
+        name = temp_prefix + utils.get_buffer_hash(os.fsencode(basename))
+    return os.path.join(dirname, name)
+
+
+def is_temp_name(name):
+    """
+    :param name: 文件名，不含目录
+    :return: 是否为本程序写入中的临时文件
+    """
+    return name.startswith(temp_prefix)
+
+
+def is_stale(path, now=None):
+    """
+    判断文件是否超过 stale_age 未修改，用于识别中断后遗留的临时文件和断点记录
+    :param path: 文件路径
+    :param now: 当前时间，为 None 时使用 time.time()
+    :return: 是否已过期，文件不存在时返回 False
+    """
+    now = time.time() if now is None else now
+    try:
+        return now - os.lstat(path).st_mtime >= stale_age
+    except FileNotFoundError:
+        return False
+
+
+def remove_if_stale(path, now=None):
+    """
+    删除超过 stale_age 未修改的文件
+    :param path: 文件路径
+    :param now: 当前时间，为 None 时使用 time.time()
+    :return: 是否已删除
+    """
+    if not is_stale(path, now):
+        return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def sweep_checkpoints(abort_upload=None):
+    """
+    清理超过 stale_age 未更新的断点记录，启动时调用
+    过期的分片上传断点记录对应的分片上传同时被取消，避免已上传的分片一直留在云端
+    :param abort_upload: 取消分片上传的函数，参数为 (云端文件路径, 分片上传 ID)，为 None 时只删除断点记录
+    :return: 删除的断点记录数量
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    try:
+        names = os.listdir(checkpoint_dir)
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    removed = 0
+    for name in names:
+        checkpoint_path = os.path.join(checkpoint_dir, name)
+        if not is_stale(checkpoint_path, now):
+            continue
+        checkpoint = load_checkpoint(checkpoint_path) if name.startswith('upload-') and name.endswith('.json') else None
+        remove_checkpoint(checkpoint_path)
+        removed += 1
+        if abort_upload is not None and checkpoint is not None:
+            try:
+                abort_upload(checkpoint['cloud_path'], checkpoint['upload_id'])
+            except Exception as err:
+                logger.warning('取消分片上传 {upload_id} 失败，错误信息为 {err}'
+                               .format(upload_id=checkpoint.get('upload_id'), err=err))
+    if removed > 0:
+        logger.info('清理了 {count} 个过期的断点记录'.format(count=removed))
+    return removed
+
+
+def get_checkpoint_path(kind, cloud_path, local_path):
+    """
+    获取断点记录文件的路径
+    :param kind: 断点记录的类型，如 upload、download
+    :param cloud_path: 云端文件路径
+    :param local_path: 本地文件路径
+    :return: 断点记录文件的路径
+    """
+    name = utils.get_buffer_hash('{kind}\n{cloud_path}\n{local_path}'
+                                 .format(kind=kind, cloud_path=cloud_path, local_path=local_path).encode())
+    return os.path.join(checkpoint_dir, '{kind}-{name}.json'.format(kind=kind, name=name))
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    读取断点记录
+    :param checkpoint_path: 断点记录文件的路径
+    :return: 断点记录字典，不存在或损坏时返回 None
+    """
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """
+    写入断点记录，先写入临时文件再替换，避免中断时留下不完整的记录
+    :param checkpoint_path: 断点记录文件的路径
+    :param checkpoint: 断点记录字典
+    :return: None
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, checkpoint_path)
+
+
+def remove_checkpoint(checkpoint_path):
+    """
+    删除断点记录
+    :param checkpoint_path: 断点记录文件的路径
+    :return: None
+    """
+    try:
+        os.remove(checkpoint_path)
+    except FileNotFoundError:
+        pass
+
+
+def multipart_upload(cloud_path, local_path, metadata, init_upload, upload_part, complete_upload, abort_upload):
+    """
+    分片并行上传本地文件，已上传的分片记录在断点记录文件中，中断后再次上传同一文件时从断点处继续
+    :param cloud_path: 云端文件路径
+    :param local_path: 本地文件路径
+    :param metadata: 对象的自定义元信息，在初始化分片上传时设置，上传完成后即为对象的元信息
+    :param init_upload: 初始化分片上传的函数，参数为 metadata，返回 upload_id
+    :param upload_part: 上传分片的函数，参数为 (upload_id, part_number, data)，返回分片的 ETag
+    :param complete_upload: 完成分片上传的函数，参数为 (upload_id, parts)，parts 为 (part_number, etag) 的列表
+    :param abort_upload: 取消分片上传的函数，参数为 upload_id
+    :return: 对象实际使用的元信息
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    checkpoint_path = get_checkpoint_path('upload', cloud_path, local_path)
+    stat_result = os.stat(local_path)
+
+    # 检查断点记录是否仍然有效：文件大小、修改时间、分片大小都没有变化
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is not None and (checkpoint['size'] != stat_result.st_size
+                                   or checkpoint['mtime_ns'] != stat_result.st_mtime_ns
+                                   or checkpoint['part_size'] != multipart_part_size):
+        logger.info('本地文件 {local_path} 已发生变化，放弃原有的断点记录'.format(local_path=local_path))
+        try:
+            abort_upload(checkpoint['upload_id'])
+        except Exception as err:
+            logger.warning('取消分片上传 {upload_id} 失败，错误信息为 {err}'.format(upload_id=checkpoint['upload_id'], err=err))
+        remove_checkpoint(checkpoint_path)
+        checkpoint = None
+
+    if checkpoint is not None:
+        logger.info('从断点处继续上传 {local_path}，已上传 {count} 个分片'
+                    .format(local_path=local_path, count=len(checkpoint['parts'])))
+        try:
+            return _upload_parts(checkpoint_path, checkpoint, upload_part, complete_upload)
+        except Exception as err:
+            logger.warning('从断点处继续上传失败，重新上传，错误信息为 {err}'.format(err=err))
+            remove_checkpoint(checkpoint_path)
+
+    checkpoint = {
+        'cloud_path': cloud_path,
+        'local_path': local_path,
+        'size': stat_result.st_size,
+        'mtime_ns': stat_result.st_mtime_ns,
+        'part_size': multipart_part_size,
+        'metadata': metadata,
+        'upload_id': init_upload(metadata),
+        'parts': {}
+    }
+    save_checkpoint(checkpoint_path, checkpoint)
+    return _upload_parts(checkpoint_path, checkpoint, upload_part, complete_upload)
+
+
+def _upload_parts(checkpoint_path, checkpoint, upload_part, complete_upload):
+    """
+    并行上传断点记录中尚未完成的分片，全部完成后合并分片并删除断点记录
+    :param checkpoint_path: 断点记录文件的路径
+    :param checkpoint: 断点记录字典
+    :param upload_part: 上传分片的函数
+    :param complete_upload: 完成分片上传的函数
+    :return: 对象实际使用的元信息
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    size = checkpoint['size']
+    part_size = checkpoint['part_size']
+    upload_id = checkpoint['upload_id']
+    part_count = max(1, (size + part_size - 1) // part_size)
+    checkpoint_lock = threading.Lock()
+
+    def upload(part_number):
+        with open(checkpoint['local_path'], 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+        etag = upload_part(upload_id, part_number, data)
+        with checkpoint_lock:
+            checkpoint['parts'][str(part_number)] = etag
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.debug('分片 {part_number}/{part_count} 上传完成'.format(part_number=part_number, part_count=part_count))
+
+    remaining = [part_number for part_number in range(1, part_count + 1) if str(part_number) not in checkpoint['parts']]
+    with ThreadPoolExecutor(max_workers=max(1, multipart_workers)) as executor:
+        for future in [executor.submit(upload, part_number) for part_number in remaining]:
+            future.result()
+
+    parts = sorted((int(part_number), etag) for part_number, etag in checkpoint['parts'].items())
+    complete_upload(upload_id, parts)
+    remove_checkpoint(checkpoint_path)
+    logger.info('分片上传 {local_path} 完成，共 {part_count} 个分片'
+                .format(local_path=checkpoint['local_path'], part_count=part_count))
+    return checkpoint['metadata']
+
+
+def download_object(cloud_path, local_path, head_object, open_object, get_range):
+    """
+    下载云端对象到本地文件，并计算下载内容的摘要
+    先通过 HEAD 请求获取对象大小、ETag 和摘要元信息，再决定下载方式：
+    先写入与目标文件同目录的临时文件，完成后通过 os.replace 原子地替换目标文件；
+    对象大小不小于 download_threshold 时，将对象按字节范围分段并行下载到预先分配好大小的临时文件中，
+    已完成的分段记录在断点记录文件中，中断后再次下载同一对象时从断点处继续。
+    流式下载时边写入边计算摘要；分段下载的分段乱序到达，全部完成后再计算临时文件的摘要。
+    对象带有摘要元信息时，摘要不一致的下载在替换目标文件之前失败
+    :param cloud_path: 云端文件路径
+    :param local_path: 本地文件路径
+    :param head_object: 获取对象信息的函数，返回 (对象大小, ETag, 摘要元信息)，对象没有摘要元信息时摘要元信息为空字符串
+    :param open_object: 打开对象的函数，返回 (响应流, 对象大小, ETag, 摘要元信息)，响应流需提供 read 方法，
+                        只在流式下载时调用
+    :param get_range: 下载指定字节范围的函数，参数为 (start, end)，包含 end，返回字节数组
+    :return: (文件摘要, 下载完成后本地文件的 stat 信息)
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    temp_path = get_temp_path(local_path)
+    size, etag, expected_hash = head_object()
+    if size < download_threshold:
+        # 以 GET 响应中的摘要元信息为准，与响应内容属于同一版本
+        stream, _, _, expected_hash = open_object()
+        hash_obj = getattr(hashlib, utils.hash_type)()
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in iter(lambda: stream.read(utils.hash_chunk_size), b''):
+                    hash_obj.update(chunk)
+                    f.write(chunk)
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        file_hash = hash_obj.hexdigest()
+        verify_download(cloud_path, temp_path, expected_hash, file_hash)
+        os.replace(temp_path, local_path)
+        return file_hash, os.stat(local_path)
+
+    checkpoint_path = get_checkpoint_path('download', cloud_path, local_path)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is None or checkpoint['size'] != size or checkpoint['etag'] != etag \
+            or checkpoint['part_size'] != download_part_size or not os.path.exists(temp_path):
+        checkpoint = {
+            'cloud_path': cloud_path,
+            'local_path': local_path,
+            'size': size,
+            'etag': etag,
+            'part_size': download_part_size,
+            'parts': []
+        }
+        # 预先分配临时文件的大小
+        with open(temp_path, 'wb') as f:
+            f.truncate(size)
+        save_checkpoint(checkpoint_path, checkpoint)
+    else:
+        logger.info('从断点处继续下载 {cloud_path}，已下载 {count} 个分段'
+                    .format(cloud_path=cloud_path, count=len(checkpoint['parts'])))
+
+    part_count = (size + download_part_size - 1) // download_part_size
+    checkpoint_lock = threading.Lock()
+
+    def download(part_index):
+        start = part_index * download_part_size
+        end = min(start + download_part_size, size) - 1
+        data = get_range(start, end)
+        if len(data) != end - start + 1:
+            raise IOError('分段 {start}-{end} 的长度不正确'.format(start=start, end=end))
+        with open(temp_path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        with checkpoint_lock:
+            checkpoint['parts'].append(part_index)
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.debug('分段 {part_index}/{part_count} 下载完成'.format(part_index=part_index + 1, part_count=part_count))
+
+    done = set(checkpoint['parts'])
+    remaining = [part_index for part_index in range(part_count) if part_index not in done]
+    with ThreadPoolExecutor(max_workers=max(1, download_workers)) as executor:
+        for future in [executor.submit(download, part_index) for part_index in remaining]:
+            future.result()
+
+    file_hash = utils.get_local_file_hash(temp_path)
+    try:
+        verify_download(cloud_path, temp_path, expected_hash, file_hash)
+    finally:
+        # 校验失败时断点记录也已不可信，下次从头下载
+        if not os.path.exists(temp_path):
+            remove_checkpoint(checkpoint_path)
+    os.replace(temp_path, local_path)
+    remove_checkpoint(checkpoint_path)
+    logger.info('分段下载 {cloud_path} 完成，共 {part_count} 个分段'.format(cloud_path=cloud_path, part_count=part_count))
+    return file_hash, os.stat(local_path)
+
+
+def verify_download(cloud_path, temp_path, expected_hash, file_hash):
+    """
+    校验下载内容的摘要，不一致时删除临时文件并抛出异常
+    对象没有摘要元信息时不校验
+    :param cloud_path: 云端文件路径
+    :param temp_path: 临时文件路径
+    :param expected_hash: 对象的摘要元信息
+    :param file_hash: 下载内容的摘要
+    :return: None
+    """
+    if not expected_hash or expected_hash == file_hash:
+        return
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+    raise IOError('下载 {cloud_path} 的内容摘要 {file_hash} 与元信息中的摘要 {expected_hash} 不一致'
+                  .format(cloud_path=cloud_path, file_hash=file_hash, expected_hash=expected_hash))
+
+
+def clone_local_file(src_path, dist_path):
+    """
+    将本地文件的内容复制到另一个路径，源文件保持不变
+    依次尝试代价最低的方式：
+    - reflink：通过 ioctl FICLONE 共享数据块（btrfs、xfs 等），不复制数据
+    - copy_file_range：在内核中复制数据，不经过用户态
+    - buffered：按块读取并写入
+    先写入与目标文件同目录的临时文件，完成后通过 os.replace 原子地替换目标文件
+    :param src_path: 源文件路径
+    :param dist_path: 目标文件路径
+    :return: 使用的方式，reflink | copy_file_range | buffered
+    """
+    temp_path = get_temp_path(dist_path)
+    try:
+        with open(src_path, 'rb') as src, open(temp_path, 'wb') as dist:
+            src_stat = os.fstat(src.fileno())
+            method = _clone_file(src, dist, src_stat.st_size)
+            os.chmod(dist.fileno(), src_stat.st_mode & 0o7777)
+        os.replace(temp_path, dist_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+
+def _clone_file(src, dist, size):
+    """
+    :param src: 以二进制模式打开的源文件
+    :param dist: 以二进制模式打开的空白目标文件
+    :param size: 源文件大小
+    :return: 使用的方式
+    """
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dist.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    if hasattr(os, 'copy_file_range'):
+        copied = 0
+        try:
+            while copied < size:
+                count = os.copy_file_range(src.fileno(), dist.fileno(), size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return 'copy_file_range'
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            # 回退前恢复到复制前的状态
+            src.seek(0)
+            dist.seek(0)
+            dist.truncate()
+
+    shutil.copyfileobj(src, dist, utils.hash_chunk_size)
+    return 'buffered'
+
+
+def rename_folder(old_cloud_path, new_cloud_path, cloud_paths, stat_of, copy_object, delete_many):
+    """
+    重命名云端目录：并行地将目录下的每个对象复制到新路径，复制时在同一个请求中写入新的修改时间，
+    全部复制完成后批量删除旧对象
+    :param old_cloud_path: 重命名前的云端目录路径
+    :param new_cloud_path: 重命名后的云端目录路径
+    :param cloud_paths: old_cloud_path 前缀下所有对象的路径
+    :param stat_of: 获取对象元信息的函数，参数为对象路径
+    :param copy_object: 复制对象并替换元信息的函数，参数为 (源路径, 目标路径, 元信息)
+    :param delete_many: 批量删除对象的函数，参数为对象路径列表，返回删除失败的对象路径列表
+    :return: None
+    """
+    logger = logging.getLogger('{function_name}'.format(function_name=inspect.stack()[0].function))
+    mtime = str(int(time.time()))
+
+    def move(cloud_path):
+        stat = stat_of(cloud_path)
+        if stat is None:
+            raise FileNotFoundError(cloud_path)
+        stat = dict(stat)
+        stat['mtime'] = mtime
+        copy_object(cloud_path, new_cloud_path + cloud_path[len(old_cloud_path):], stat)
+
+    copied = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, copy_workers)) as executor:
+        futures = {executor.submit(move, cloud_path): cloud_path for cloud_path in cloud_paths}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                copied.append(futures[future])
+            except Exception as err:
+                logger.error('复制云端对象 {cloud_path} 失败，错误信息为 {err}'.format(cloud_path=futures[future], err=err))
+                failed.append(futures[future])
+
+    # 只删除已经复制成功的旧对象
+    failed += delete_many(copied)
+    if len(failed) > 0:
+        raise IOError('重命名云端目录 {old_cloud_path} 为 {new_cloud_path} 时，{count} 个对象处理失败: {failed}'
+                      .format(old_cloud_path=old_cloud_path, new_cloud_path=new_cloud_path,
+                              count=len(failed), failed=failed))
+    logger.info('重命名云端目录 {old_cloud_path} 为 {new_cloud_path} 完成，共 {count} 个对象'
+                .format(old_cloud_path=old_cloud_path, new_cloud_path=new_cloud_path, count=len(copied)))
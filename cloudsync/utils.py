@@ -1,36 +1,190 @@
 import os
-import sys
+import mmap
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # 加密算法 (可选 sha1 | sha256 | sha512)
 hash_type = "sha256"
-# 临时文件路径，计算云文件的摘要时，预先将文件下载至临时文件
-temp_file_path = os.path.join(sys.path[0], 'cloudsync_temp_file')
+# 云端对象缺少摘要元信息时的处理方式 (可选 content | crc64)
+# - content: 流式读取对象内容计算摘要，并写回对象的元信息
+# - crc64: 使用云端计算的 CRC64 作为变化检测的指纹，不下载对象；该指纹与本地摘要不可比较，
+#          因此这类对象被下载后，下一次推送会重新上传一次，上传后对象即带有真正的摘要
+cloud_hash_mode = 'content'
+# crc64 模式下指纹的前缀，用于与真正的内容摘要区分
+crc64_prefix = 'crc64:'
+# 计算摘要时每次读取的块大小，单位为字节
+hash_chunk_size = 1024 * 1024
+# 文件大小不小于此值时通过 mmap 计算摘要，单位为字节
+hash_mmap_threshold = 64 * 1024 * 1024
+# 并行计算摘要的工作者数量
+hash_workers = os.cpu_count() or 1
+# 并行计算摘要使用的池类型 (可选 thread | process)
+hash_pool_type = 'thread'
+# 分页列举云端对象时每页的对象数量
+list_page_size = 1000
+# 分页列举云端对象时，是否在处理当前页的同时预取下一页
+list_prefetch = True
 
 
 def get_local_file_hash(file_path):
     """
     计算本地整个文件的摘要
+    按块读取文件，大文件通过 mmap 映射后分块计算，内存占用与文件大小无关
     :param file_path: 本地文件路径
     :return: 文件摘要
     """
     try:
+        hash_obj = getattr(hashlib, hash_type)()
         with open(file_path, 'rb') as f:
-            return getattr(hashlib, hash_type)(f.read()).hexdigest()
+            size = os.fstat(f.fileno()).st_size
+            if size >= hash_mmap_threshold > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    view = memoryview(m)
+                    try:
+                        for offset in range(0, size, hash_chunk_size):
+                            hash_obj.update(view[offset:offset + hash_chunk_size])
+                    finally:
+                        view.release()
+            else:
+                for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+                    hash_obj.update(chunk)
+        return hash_obj.hexdigest()
     except Exception as e:
         print(e)
         return ''
 
 
+class HashingReader:
+    """
+    边读取边计算摘要的文件包装器，上传时文件内容只需从磁盘读取一次
+    提供 __len__ 以便上传时确定 Content-Length；读取位置被移动到已读取位置之外（例如 SDK 重试时回退到中间位置）时，
+    摘要不再可信，hexdigest 返回 None，回退到开头则重新计算
+    """
+
+    def __init__(self, f):
+        """
+        :param f: 以二进制模式打开、读取位置在开头的文件
+        """
+        self._file = f
+        self._size = os.fstat(f.fileno()).st_size
+        self._hash_obj = getattr(hashlib, hash_type)()
+        # 已计入摘要的字节数，为 None 时摘要不可信
+        self._hashed = 0
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        position = self._file.tell()
+        data = self._file.read(size)
+        if self._hashed is not None:
+            if position == self._hashed:
+                self._hash_obj.update(data)
+                self._hashed += len(data)
+            elif position + len(data) > self._hashed:
+                self._hashed = None
+        return data
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        position = self._file.seek(offset, whence)
+        if position == 0:
+            self._hash_obj = getattr(hashlib, hash_type)()
+            self._hashed = 0
+        return position
+
+    def hexdigest(self):
+        """
+        :return: 已读取内容的摘要，文件未被完整地顺序读取时返回 None
+        """
+        if self._hashed != self._size:
+            return None
+        return self._hash_obj.hexdigest()
+
+
+def get_local_files_hash(file_paths):
+    """
+    使用线程池或进程池并行计算多个本地文件的摘要
+    池的宽度由 hash_workers 决定，池的类型由 hash_pool_type 决定
+    :param file_paths: 本地文件路径列表
+    :return: 与 file_paths 顺序一致的文件摘要列表
+    """
+    file_paths = list(file_paths)
+    if hash_workers <= 1 or len(file_paths) <= 1:
+        return [get_local_file_hash(file_path) for file_path in file_paths]
+    if hash_pool_type == 'process':
+        with ProcessPoolExecutor(max_workers=hash_workers) as executor:
+            chunksize = max(1, len(file_paths) // (hash_workers * 4))
+            return list(executor.map(get_local_file_hash, file_paths, chunksize=chunksize))
+    with ThreadPoolExecutor(max_workers=hash_workers) as executor:
+        return list(executor.map(get_local_file_hash, file_paths))
+
+
+def iterate_pages(fetch_page, prefetch=None):
+    """
+    按页迭代分页接口的结果
+    :param fetch_page: 获取一页数据的函数，参数为分页标记（首页为空字符串），返回值为 (当前页数据, 下一页标记)，
+                       没有下一页时下一页标记为 None
+    :param prefetch: 是否在调用方处理当前页时，在后台线程中预取下一页，为 None 时使用 list_prefetch
+    :return: 逐页产出的数据
+    """
+    prefetch = list_prefetch if prefetch is None else prefetch
+    page, marker = fetch_page('')
+    if not prefetch:
+        while True:
+            yield page
+            if marker is None:
+                return
+            page, marker = fetch_page(marker)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            future = executor.submit(fetch_page, marker) if marker is not None else None
+            yield page
+            if future is None:
+                return
+            page, marker = future.result()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def get_stream_hash(stream):
+    """
+    按块读取数据流并计算摘要，不写入临时文件
+    :param stream: 提供 read 方法的数据流
+    :return: 摘要值
+    """
+    hash_obj = getattr(hashlib, hash_type)()
+    for chunk in iter(lambda: stream.read(hash_chunk_size), b''):
+        hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
 def get_cloud_file_hash(cloud_path, cfs):
     """
-    计算云端整个文件的摘要
+    计算云端整个文件的摘要，响应体边接收边计算，不落盘
     :param cloud_path: 云端文件路径
-    :param cfs: 云文件系统
+    :param cfs: 云文件系统，包含 open_object 函数
     :return: 文件摘要
     """
-    cfs.download(cloud_path, temp_file_path)
-    return get_local_file_hash(temp_file_path)
+    stream = cfs.open_object(cloud_path)[0]
+    try:
+        return get_stream_hash(stream)
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+
+
+def is_crc64_fingerprint(file_hash):
+    """
+    :param file_hash: 文件摘要
+    :return: 是否为 crc64 模式下的指纹，而不是真正的内容摘要
+    """
+    return file_hash.startswith(crc64_prefix)
 
 
 def get_buffer_hash(buffer: bytes):
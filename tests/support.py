@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'cloudsync'))
+
+from catalog import initialize_metatree_local  # noqa: E402
+from dedup_index import DedupIndex  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+from synchronize import Synchronize  # noqa: E402
+from synchronize_event_emitter import SynchronizeEventEmitter  # noqa: E402
+
+
+class RecordingObserver:
+    """
+    只记录任务，不执行任务的观察者
+    """
+
+    def __init__(self, aborted=()):
+        """
+        :param aborted: 这些任务类型报告为中止，其余报告为执行成功
+        """
+        self.tasks = []
+        self.aborted = set(aborted)
+
+    def update(self, task):
+        self.tasks.append((task.task_index, task.from_path, task.to_path))
+        return task.task_index not in self.aborted
+
+
+class FakeCloudFileSystem:
+    """
+    只提供同步周期统计用到的属性
+    """
+
+    def __init__(self):
+        self.metadata_cache = MetadataCache()
+        self.head_skips = 0
+
+
+def make_synchronize(local_path, history_path, observer):
+    """
+    不经过 __init__（不切换工作目录、不注册信号），构造只同步本地一侧的 Synchronize
+    本地历史元信息树取自 local_path 的当前内容
+    """
+    sync = Synchronize.__new__(Synchronize)
+    sync.cfs = FakeCloudFileSystem()
+    sync.history_path = history_path
+    sync.local_path = local_path
+    sync.cloud_path = 'cloud/'
+    sync.tasks = SynchronizeEventEmitter(workers=1)
+    sync.tasks.register(observer)
+    sync.metatree_cloud = None
+    sync.metatree_cloud_history = None
+    sync.metatree_local = None
+    sync.metatree_local_history = initialize_metatree_local(local_path, DedupIndex())
+    sync.watcher = None
+    sync.local_scan_full = True
+    sync.local_rescan_all = False
+    sync._effects = []
+    sync._rename_fallbacks = []
+    return sync
@@ -0,0 +1,180 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'cloudsync'))
+
+import chunk_store  # noqa: E402
+from chunk_store import ChunkStore, chunk_file, chunk_key  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class MemoryCloudFileSystem:
+    """
+    内存中的云文件系统，只提供分块存储用到的函数
+    """
+
+    def __init__(self):
+        # 键为对象路径，值为 (内容, 元信息, 最后修改时间)
+        self.objects = dict()
+        self.puts = []
+
+    def put_object(self, cloud_path, data, stat=None):
+        self.objects[cloud_path] = (bytes(data), dict(stat) if stat is not None else None, time.time())
+        self.puts.append(cloud_path)
+
+    def open_object(self, cloud_path):
+        data, stat, _ = self.objects[cloud_path]
+        return io.BytesIO(data), len(data), '', stat['hash'] if stat is not None else ''
+
+    def iter_all_files(self, prefix):
+        for key in sorted(self.objects):
+            if key.startswith(prefix):
+                data, _, last_modified = self.objects[key]
+                yield {'key': key, 'etag': '', 'size': len(data), 'last_modified': last_modified}
+
+    def delete_many(self, cloud_paths):
+        for cloud_path in cloud_paths:
+            del self.objects[cloud_path]
+        return []
+
+    def age(self, seconds):
+        for key, (data, stat, last_modified) in list(self.objects.items()):
+            self.objects[key] = (data, stat, last_modified - seconds)
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cfs = MemoryCloudFileSystem()
+        self.store = ChunkStore(self.cfs, 'root/')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_chunk_file(self):
+        data = random_bytes(20 * MB, 1)
+        file_hash, chunks = chunk_file(self.write('a', data))
+        self.assertEqual(file_hash, hashlib.sha256(data).hexdigest())
+        offset = 0
+        for index, (chunk_offset, size, digest, _) in enumerate(chunks):
+            self.assertEqual(chunk_offset, offset)
+            self.assertLessEqual(size, chunk_store.chunk_max_size)
+            if index < len(chunks) - 1:
+                self.assertGreaterEqual(size, chunk_store.chunk_min_size)
+            self.assertEqual(digest, hashlib.sha256(data[offset:offset + size]).hexdigest())
+            offset += size
+        self.assertEqual(offset, len(data))
+
+    def test_cut_points_follow_content(self):
+        data = random_bytes(20 * MB, 2)
+        shifted = random_bytes(100, 3) + data
+        _, chunks = chunk_file(self.write('a', data))
+        _, shifted_chunks = chunk_file(self.write('b', shifted))
+        digests = {digest for _, _, digest, _ in chunks}
+        shared = [digest for _, _, digest, _ in shifted_chunks if digest in digests]
+        self.assertGreaterEqual(len(shared), len(chunks) - 2)
+
+    def test_round_trip(self):
+        data = random_bytes(20 * MB, 4)
+        stat = self.store.upload('root/file', self.write('a', data))
+        manifest = json.loads(self.cfs.objects['root/file'][0].decode('utf-8'))
+        self.assertEqual(manifest['version'], 1)
+        self.assertEqual(manifest['hash'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(manifest['size'], len(data))
+        self.assertEqual(sum(size for _, size, _ in manifest['chunks']), len(data))
+        self.assertEqual(stat['hash'], manifest['hash'])
+        self.assertEqual(stat['chunked'], '1')
+        self.assertEqual(self.cfs.objects['root/file'][1], stat)
+        for digest, _, _ in manifest['chunks']:
+            self.assertIn(chunk_key('root/', digest), self.cfs.objects)
+
+        target = os.path.join(self.directory.name, 'b')
+        file_hash, _ = self.store.download('root/file', target, stat)
+        self.assertEqual(file_hash, stat['hash'])
+        self.assertEqual(self.read(target), data)
+
+    def test_update_transfers_changed_chunks(self):
+        data = random_bytes(20 * MB, 5)
+        local_path = self.write('a', data)
+        self.store.upload('root/file', local_path)
+        modified = data[:10 * MB] + b'inserted' + data[10 * MB:]
+        self.write('a', modified)
+
+        self.cfs.puts.clear()
+        reference = self.store.load_manifest('root/file')
+        stat = self.store.upload('root/file', local_path, reference=reference)
+        chunk_puts = [key for key in self.cfs.puts if key != 'root/file']
+        self.assertLessEqual(len(chunk_puts), 2)
+
+        # 本地旧版本中未变化的块直接复用
+        target = self.write('b', data)
+        self.store.download('root/file', target, stat)
+        self.assertEqual(self.read(target), modified)
+
+    def test_download_rejects_corrupted_chunk(self):
+        data = random_bytes(4 * MB, 6)
+        stat = self.store.upload('root/file', self.write('a', data))
+        digest = self.store.load_manifest('root/file')['chunks'][0][0]
+        key = chunk_key('root/', digest)
+        content, chunk_stat, last_modified = self.cfs.objects[key]
+        self.cfs.objects[key] = (b'x' + content[1:], chunk_stat, last_modified)
+
+        target = os.path.join(self.directory.name, 'b')
+        with self.assertRaises(IOError):
+            self.store.download('root/file', target, stat)
+        self.assertFalse(os.path.exists(target))
+
+    def test_collect_garbage(self):
+        data = random_bytes(20 * MB, 7)
+        local_path = self.write('a', data)
+        self.store.upload('root/file', local_path)
+        self.store.upload('root/copy', local_path)
+        old_digests = {digest for digest, _, _ in self.store.load_manifest('root/file')['chunks']}
+        self.write('a', random_bytes(20 * MB, 8))
+        self.store.upload('root/file', local_path, reference=self.store.load_manifest('root/file'))
+
+        # 最近写入的块不会被回收
+        self.assertEqual(self.store.collect_garbage({'root/file'}, force=True), 0)
+        self.cfs.age(chunk_store.chunk_gc_grace + 1)
+
+        # 仍被复制得到的清单引用的块不会被回收
+        self.assertEqual(self.store.collect_garbage({'root/file', 'root/copy'}, force=True), 0)
+
+        new_digests = {digest for digest, _, _ in self.store.load_manifest('root/file')['chunks']}
+        deleted = self.store.collect_garbage({'root/file'}, force=True)
+        self.assertEqual(deleted, len(old_digests - new_digests))
+        for digest in new_digests:
+            self.assertIn(chunk_key('root/', digest), self.cfs.objects)
+        for digest in old_digests - new_digests:
+            self.assertNotIn(chunk_key('root/', digest), self.cfs.objects)
+
+        target = os.path.join(self.directory.name, 'b')
+        self.store.download('root/file', target, self.cfs.objects['root/file'][1])
+        self.assertEqual(self.read(target), self.read(local_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import RecordingObserver, make_synchronize
+
+from global_value import OP, stat_cache
+from synchronize_event_handler import SynchronizeEventHandler
+
+
+class PrefixOnlyCloudFileSystem:
+    """
+    目录只以对象键前缀的形式存在、没有 dir/ 目录对象的云文件系统
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.renamed = []
+
+    def stat_file(self, cloud_path, cached=True):
+        return {'hash': '', 'mtime': '0', 'uuid': ''} if cloud_path in self.keys else None
+
+    def iter_all_files(self, cloud_path, page_size=None, prefetch=None):
+        for key in sorted(self.keys):
+            if key.startswith(cloud_path):
+                yield {'key': key, 'etag': '', 'size': 0, 'last_modified': 0}
+
+    def rename(self, old_cloud_path, new_cloud_path):
+        self.renamed.append((old_cloud_path, new_cloud_path))
+        self.keys = {new_cloud_path + key[len(old_cloud_path):] if key.startswith(old_cloud_path) else key
+                     for key in self.keys}
+
+
+class RenameCloudFolderTest(unittest.TestCase):
+
+    def rename(self, cfs, from_path, to_path):
+        handler = SynchronizeEventHandler(cfs)
+        handler.from_path, handler.to_path = from_path, to_path
+        return handler.rename_cloud_folder()
+
+    def test_prefix_only_folder(self):
+        cfs = PrefixOnlyCloudFileSystem(['cloud/old/a.txt', 'cloud/old/sub/b.txt'])
+        self.assertTrue(self.rename(cfs, 'cloud/old/', 'cloud/new/'))
+        self.assertEqual(cfs.renamed, [('cloud/old/', 'cloud/new/')])
+        self.assertEqual(cfs.keys, {'cloud/new/a.txt', 'cloud/new/sub/b.txt'})
+
+    def test_existing_prefix_only_target(self):
+        cfs = PrefixOnlyCloudFileSystem(['cloud/old/a.txt', 'cloud/new/b.txt'])
+        self.assertFalse(self.rename(cfs, 'cloud/old/', 'cloud/new/'))
+        self.assertEqual(cfs.renamed, [])
+
+    def test_missing_source(self):
+        cfs = PrefixOnlyCloudFileSystem(['cloud/other/a.txt'])
+        self.assertFalse(self.rename(cfs, 'cloud/old/', 'cloud/new/'))
+
+
+class RenameFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.directory.name, 'local', '')
+        os.makedirs(self.local_path + 'old/sub')
+        for filename in ['old/a.txt', 'old/sub/b.txt']:
+            with open(self.local_path + filename, 'w') as f:
+                f.write(filename)
+        self.saved_cache_path = stat_cache.cache_path
+        stat_cache.cache_path = os.path.join(self.directory.name, 'history.stat')
+
+    def tearDown(self):
+        stat_cache.cache_path = self.saved_cache_path
+        self.directory.cleanup()
+
+    def test_aborted_rename_becomes_create_and_delete(self):
+        observer = RecordingObserver(aborted=[OP.RENAME_CLOUD_FOLDER])
+        sync = make_synchronize(self.local_path, os.path.join(self.directory.name, 'history'), observer)
+        shutil.move(self.local_path + 'old', self.local_path + 'new')
+
+        sync.synchronize(pull=False, push=True)
+        self.assertEqual(observer.tasks[0], (OP.RENAME_CLOUD_FOLDER, 'cloud/old/', 'cloud/new/'))
+        self.assertIn((OP.CREATE_CLOUD_FOLDER, self.local_path + 'new/', 'cloud/new/'), observer.tasks)
+        self.assertIn((OP.DELETE_CLOUD_FOLDER, 'cloud/old/', ''), observer.tasks)
+
+    def test_applied_rename_has_no_fallback(self):
+        observer = RecordingObserver()
+        sync = make_synchronize(self.local_path, os.path.join(self.directory.name, 'history'), observer)
+        shutil.move(self.local_path + 'old', self.local_path + 'new')
+
+        sync.synchronize(pull=False, push=True)
+        self.assertEqual(observer.tasks, [(OP.RENAME_CLOUD_FOLDER, 'cloud/old/', 'cloud/new/')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import contextlib
+import unittest
+from unittest import mock
+
+from support import RecordingObserver, make_synchronize
+
+import catalog
+import utils
+from catalog import FileStatus, initialize_metatree_local
+from dedup_index import DedupIndex
+from global_value import OP, stat_cache
+from stat_cache import StatCache
+from scheduler import SyncScheduler
+
+
+class LocalScanFailureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.directory.name, 'local', '')
+        for dirname in ['ok', 'locked/inner']:
+            os.makedirs(self.local_path + dirname)
+        for filename in ['a.txt', 'ok/b.txt', 'locked/c.txt', 'locked/inner/d.txt']:
+            with open(self.local_path + filename, 'w') as f:
+                f.write(filename)
+        self.locked = self.local_path + 'locked/'
+        self.saved_cache_path = stat_cache.cache_path
+        stat_cache.cache_path = os.path.join(self.directory.name, 'history.stat')
+
+    def tearDown(self):
+        stat_cache.cache_path = self.saved_cache_path
+        self.directory.cleanup()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        将 locked 目录设为不可读；root 用户不受权限限制，此时让 os.scandir 对该目录抛出 PermissionError
+        """
+        scandir = os.scandir
+
+        def locked_scandir(path='.'):
+            if path == self.locked:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        os.chmod(self.locked, 0)
+        try:
+            if os.access(self.locked, os.R_OK):
+                with mock.patch.object(catalog.os, 'scandir', locked_scandir):
+                    yield
+            else:
+                yield
+        finally:
+            os.chmod(self.locked, 0o755)
+
+    def make_synchronize(self):
+        self.observer = RecordingObserver()
+        return make_synchronize(self.local_path, os.path.join(self.directory.name, 'history'), self.observer)
+
+    def test_initialize_raises(self):
+        with self.lock():
+            with self.assertRaises(PermissionError):
+                initialize_metatree_local(self.local_path, DedupIndex())
+
+    def test_push_skipped_without_cloud_deletes(self):
+        sync = self.make_synchronize()
+        history = sync.metatree_local_history
+        with self.lock():
+            result = sync.synchronize(pull=False, push=True)
+        operations = [task_index for task_index, _, _ in self.observer.tasks]
+        self.assertNotIn(OP.DELETE_CLOUD_FILE, operations)
+        self.assertNotIn(OP.DELETE_CLOUD_FOLDER, operations)
+        self.assertEqual(result[SyncScheduler.LOCAL][0], 0)
+        self.assertIs(sync.metatree_local_history, history)
+        self.assertTrue(sync.local_rescan_all)
+
+        # 目录恢复可读之后，下一次扫描正常进行，没有变化
+        result = sync.synchronize(pull=False, push=True)
+        self.assertEqual(self.observer.tasks, [])
+        self.assertFalse(sync.local_rescan_all)
+
+
+class HashPendingFilesTest(unittest.TestCase):
+
+    def test_missing_stat_result(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'a.txt')
+            with open(filename, 'w') as f:
+                f.write('a')
+            child_file = FileStatus(filename)
+            cache = StatCache()
+            catalog._hash_pending_files([(child_file, None)], cache)
+            self.assertEqual(child_file.file_id, utils.get_local_files_hash([filename])[0])
+            self.assertEqual(len(cache._fresh), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
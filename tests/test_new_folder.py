@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from support import RecordingObserver, make_synchronize
+
+from catalog import DirectoryStatus, find_catalog
+from global_value import OP, stat_cache
+
+
+class NewFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.directory.name, 'local', '')
+        os.makedirs(self.local_path)
+        with open(self.local_path + 'a.txt', 'w') as f:
+            f.write('a')
+        self.saved_cache_path = stat_cache.cache_path
+        stat_cache.cache_path = os.path.join(self.directory.name, 'history.stat')
+
+    def tearDown(self):
+        stat_cache.cache_path = self.saved_cache_path
+        self.directory.cleanup()
+
+    def push_new_folder(self, observer):
+        sync = make_synchronize(self.local_path, os.path.join(self.directory.name, 'history'), observer)
+        sync.metatree_cloud_history = DirectoryStatus('cloud/')
+        os.makedirs(self.local_path + 'new/sub')
+        for filename in ['new/x.txt', 'new/sub/y.txt']:
+            with open(self.local_path + filename, 'w') as f:
+                f.write(filename)
+        sync.synchronize(pull=False, push=True)
+        return sync
+
+    def test_one_task_per_child(self):
+        observer = RecordingObserver()
+        sync = self.push_new_folder(observer)
+        self.assertCountEqual(observer.tasks, [
+            (OP.CREATE_CLOUD_FOLDER, self.local_path + 'new/', 'cloud/new/'),
+            (OP.CREATE_CLOUD_FOLDER, self.local_path + 'new/sub/', 'cloud/new/sub/'),
+            (OP.UPLOAD_FILE, self.local_path + 'new/x.txt', 'cloud/new/x.txt'),
+            (OP.UPLOAD_FILE, self.local_path + 'new/sub/y.txt', 'cloud/new/sub/y.txt'),
+        ])
+        # 目录任务先于其中的文件任务提交
+        self.assertEqual(observer.tasks[0], (OP.CREATE_CLOUD_FOLDER, self.local_path + 'new/', 'cloud/new/'))
+
+        # 历史记录与本地新目录一致
+        folder = find_catalog(sync.metatree_cloud_history, 'cloud/new/')
+        self.assertEqual(folder.file_id, find_catalog(sync.metatree_local, self.local_path + 'new/').file_id)
+
+    def test_aborted_children_stay_out_of_history(self):
+        observer = RecordingObserver(aborted=[OP.UPLOAD_FILE])
+        sync = self.push_new_folder(observer)
+        history = sync.metatree_cloud_history
+        self.assertIsNotNone(find_catalog(history, 'cloud/new/sub/'))
+        self.assertIsNone(find_catalog(history, 'cloud/new/x.txt'))
+        self.assertIsNone(find_catalog(history, 'cloud/new/sub/y.txt'))
+        folder = find_catalog(history, 'cloud/new/')
+        self.assertNotEqual(folder.file_id, find_catalog(sync.metatree_local, self.local_path + 'new/').file_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import support  # noqa: F401
+
+import transfer
+from catalog import find_catalog, initialize_metatree_local
+from dedup_index import DedupIndex
+
+
+class TempPathTest(unittest.TestCase):
+
+    def test_hidden_name_next_to_target(self):
+        temp_path = transfer.get_temp_path('/data/dir/report.pdf')
+        self.assertEqual(os.path.dirname(temp_path), '/data/dir')
+        self.assertTrue(os.path.basename(temp_path).startswith('.'))
+        self.assertTrue(transfer.is_temp_name(os.path.basename(temp_path)))
+        self.assertEqual(temp_path, transfer.get_temp_path('/data/dir/report.pdf'))
+
+    def test_long_name(self):
+        basename = 'x' * transfer.name_max
+        temp_path = transfer.get_temp_path('/data/' + basename)
+        self.assertLessEqual(len(os.path.basename(temp_path)), transfer.name_max)
+        self.assertTrue(transfer.is_temp_name(os.path.basename(temp_path)))
+        self.assertNotEqual(temp_path, transfer.get_temp_path('/data/' + 'y' * transfer.name_max))
+
+
+class StaleFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.directory.name, 'local', '')
+        os.makedirs(self.local_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def touch(self, path, age=0):
+        with open(path, 'w') as f:
+            f.write(path)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_scan_keeps_user_files_and_removes_stale_temp_files(self):
+        self.touch(self.local_path + 'notes.cloudsync-download')
+        fresh = transfer.get_temp_path(self.local_path + 'a.txt')
+        stale = transfer.get_temp_path(self.local_path + 'b.txt')
+        self.touch(fresh)
+        self.touch(stale, transfer.stale_age + 60)
+
+        root = initialize_metatree_local(self.local_path, DedupIndex())
+        self.assertIsNotNone(find_catalog(root, self.local_path + 'notes.cloudsync-download'))
+        self.assertIsNone(find_catalog(root, fresh))
+        self.assertIsNone(find_catalog(root, stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_sweep_checkpoints(self):
+        checkpoint_dir = os.path.join(self.directory.name, 'checkpoints')
+        aborted = []
+        with mock.patch.object(transfer, 'checkpoint_dir', checkpoint_dir):
+            stale_upload = transfer.get_checkpoint_path('upload', 'cloud/a', self.local_path + 'a')
+            fresh_upload = transfer.get_checkpoint_path('upload', 'cloud/b', self.local_path + 'b')
+            stale_download = transfer.get_checkpoint_path('download', 'cloud/c', self.local_path + 'c')
+            for checkpoint_path, cloud_path in [(stale_upload, 'cloud/a'), (fresh_upload, 'cloud/b')]:
+                transfer.save_checkpoint(checkpoint_path, {'cloud_path': cloud_path, 'upload_id': cloud_path + '-id'})
+            transfer.save_checkpoint(stale_download, {'cloud_path': 'cloud/c'})
+            for checkpoint_path in [stale_upload, stale_download]:
+                mtime = time.time() - transfer.stale_age - 60
+                os.utime(checkpoint_path, (mtime, mtime))
+
+            removed = transfer.sweep_checkpoints(lambda cloud_path, upload_id: aborted.append((cloud_path, upload_id)))
+        self.assertEqual(removed, 2)
+        self.assertEqual(aborted, [('cloud/a', 'cloud/a-id')])
+        self.assertFalse(os.path.exists(stale_upload))
+        self.assertFalse(os.path.exists(stale_download))
+        self.assertTrue(os.path.exists(fresh_upload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+import support  # noqa: F401
+
+from synchronize_event_handler import SynchronizeEventHandler
+
+
+class StaleCacheCloudFileSystem:
+    """
+    缓存（或布隆过滤器）认为对象不存在，而其他客户端已经写入了该对象的云文件系统
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.uploaded = []
+
+    def stat_file(self, cloud_path, cached=True):
+        if cached or cloud_path not in self.keys:
+            return None
+        return {'hash': 'other', 'mtime': '0', 'uuid': ''}
+
+    def upload(self, cloud_path, local_path, file_hash=None):
+        self.uploaded.append(cloud_path)
+        return {'hash': '', 'mtime': '0', 'uuid': ''}
+
+    def rename(self, old_cloud_path, new_cloud_path):
+        self.uploaded.append(new_cloud_path)
+
+
+class UploadPreconditionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_file = os.path.join(self.directory.name, 'a.txt')
+        with open(self.local_file, 'w') as f:
+            f.write('a')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_upload_does_not_overwrite(self):
+        cfs = StaleCacheCloudFileSystem(['cloud/a.txt'])
+        handler = SynchronizeEventHandler(cfs)
+        handler.kwargs = {}
+        self.assertFalse(handler.upload(self.local_file, 'cloud/a.txt'))
+        self.assertEqual(cfs.uploaded, [])
+
+    def test_upload_new_object(self):
+        cfs = StaleCacheCloudFileSystem([])
+        handler = SynchronizeEventHandler(cfs)
+        handler.kwargs = {}
+        self.assertTrue(handler.upload(self.local_file, 'cloud/a.txt'))
+        self.assertEqual(cfs.uploaded, ['cloud/a.txt'])
+
+    def test_rename_does_not_overwrite(self):
+        cfs = StaleCacheCloudFileSystem(['cloud/a.txt', 'cloud/b.txt'])
+        # 源文件的存在性可以使用缓存，这里令缓存命中源文件
+        stat_file = cfs.stat_file
+        cfs.stat_file = lambda cloud_path, cached=True: stat_file(cloud_path, cached and cloud_path != 'cloud/a.txt')
+        handler = SynchronizeEventHandler(cfs)
+        handler.from_path, handler.to_path = 'cloud/a.txt', 'cloud/b.txt'
+        self.assertFalse(handler.rename_cloud_file())
+        self.assertEqual(cfs.uploaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()